@@ -0,0 +1,620 @@
+#!/usr/bin/python
+
+# The MIT License
+#
+# Copyright (c) 2007 Damon Kohler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Event driven counterparts of PyRobot's Roomba and Create.
+
+A single EventLoop multiplexes any number of robots (and anything else with a
+file descriptor) without a thread per blocking call. Methods that would block
+in PyRobot (waiting for the robot to change modes, reading sensors, etc.)
+instead return a Future. Commands that only send bytes (e.g. Drive) are
+shared with PyRobot and return immediately.
+
+Generators decorated with Coroutine can wait for futures by yielding them:
+
+  @async_pyrobot.Coroutine
+  def Bump(robot):
+    yield robot.Control()
+    robot.DriveStraight(pyrobot.VELOCITY_SLOW)
+    stream = robot.StartStream()
+    while True:
+      values = yield stream.Next()
+      if values['bump-left'] or values['bump-right']:
+        break
+    robot.Stop()
+
+  loop = async_pyrobot.EventLoop()
+  loop.RunUntilComplete(Bump(async_pyrobot.AsyncCreate(loop, '/dev/ttyUSB0')))
+
+"""
+__author__ = "damonkohler@gmail.com (Damon Kohler)"
+
+import collections
+import errno
+import functools
+import heapq
+import logging
+import os
+import select
+import sys
+import threading
+import time
+import traceback
+import types
+
+import pyrobot
+
+
+# Raised by a coroutine to return a value (generators can't return one).
+Return = pyrobot.Return
+
+
+class Future(object):
+
+  """The result of an operation that has not necessarily finished yet."""
+
+  def __init__(self):
+    self._done = False
+    self._result = None
+    self._exc_info = None
+    self._callbacks = []
+
+  def Done(self):
+    return self._done
+
+  def Result(self):
+    """Return the result or raise the exception of a finished operation."""
+    if not self._done:
+      raise pyrobot.PyRobotError('Future is not done yet.')
+    if self._exc_info is not None:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._result
+
+  def AddDoneCallback(self, callback):
+    """Call 'callback' with this future once it is done."""
+    if self._done:
+      callback(self)
+    else:
+      self._callbacks.append(callback)
+
+  def SetResult(self, result):
+    self._result = result
+    self._Finish()
+
+  def SetException(self, exception):
+    """Finish with 'exception', or the one being handled if it's None."""
+    if exception is None:
+      self._exc_info = sys.exc_info()
+    else:
+      self._exc_info = (exception.__class__, exception, None)
+    self._Finish()
+
+  def _Finish(self):
+    if self._done:
+      raise pyrobot.PyRobotError('Future is already done.')
+    self._done = True
+    callbacks, self._callbacks = self._callbacks, []
+    for callback in callbacks:
+      callback(self)
+
+
+class Task(Future):
+
+  """Runs a generator that yields futures, resuming it with their results."""
+
+  def __init__(self, generator):
+    super(Task, self).__init__()
+    self._generator = generator
+    self._Step(None, None)
+
+  def _Resume(self, future):
+    self._Step(future._result, future._exc_info)
+
+  def _Wait(self, value):
+    """Return the Future to wait for when the generator yields 'value'."""
+    if isinstance(value, Future):
+      return value
+
+  def _Step(self, value, exc_info):
+    while True:
+      try:
+        if exc_info is not None:
+          future = self._generator.throw(*exc_info)
+        else:
+          future = self._generator.send(value)
+      except StopIteration:
+        self.SetResult(None)
+        return
+      except Return, e:
+        self.SetResult(e.value)
+        return
+      except Exception:
+        self.SetException(None)
+        return
+      future = self._Wait(future)
+      if future is None:
+        exc_info = (pyrobot.PyRobotError,
+                    pyrobot.PyRobotError('Coroutines must yield Futures.'),
+                    None)
+        continue
+      if not future.Done():
+        future.AddDoneCallback(self._Resume)
+        return
+      value, exc_info = future._result, future._exc_info
+
+
+class StepTask(Task):
+
+  """Runs one of PyRobot's step generators (see pyrobot.RunSteps) on 'loop'.
+
+  This is how the protocol sequences shared with PyRobot (mode changes, baud
+  rate negotiation, stream framing, etc.) run without blocking.
+
+  """
+  def __init__(self, loop, steps):
+    self.loop = loop
+    super(StepTask, self).__init__(steps)
+
+  def _Wait(self, value):
+    if isinstance(value, Future):
+      return value
+    if isinstance(value, pyrobot.Sleep):
+      return self.loop.Sleep(value.seconds)
+    if isinstance(value, types.GeneratorType):
+      return StepTask(self.loop, value)
+    future = Future()  # Already the result of a non-blocking call.
+    future.SetResult(value)
+    return future
+
+
+def Coroutine(function):
+  """Decorate a generator function to run as a Task and return its Future."""
+  @functools.wraps(function)
+  def Start(*args, **kwargs):
+    result = function(*args, **kwargs)
+    if isinstance(result, types.GeneratorType):
+      return Task(result)
+    future = Future()
+    future.SetResult(result)
+    return future
+  return Start
+
+
+class _Timer(object):
+
+  """A callback scheduled with EventLoop.CallLater."""
+
+  __slots__ = ('when', 'callback', 'args')
+
+  def __init__(self, when, callback, args):
+    self.when = when
+    self.callback = callback
+    self.args = args
+
+  def __cmp__(self, other):
+    return cmp(self.when, other.when)
+
+  def Cancel(self):
+    self.callback = None
+
+
+class EventLoop(object):
+
+  """Calls back when file descriptors are readable or timers expire.
+
+  The loop is not thread safe. Other threads must use CallFromThread or
+  RunFromThread to interact with it.
+
+  """
+  def __init__(self):
+    self._readers = {}  # Maps file descriptors to callbacks.
+    self._timers = []  # Heap of _Timers.
+    self._running = False
+    self._thread_calls = collections.deque()
+    self._wake_read, self._wake_write = os.pipe()
+    self.AddReader(self._wake_read, self._RunThreadCalls)
+
+  def AddReader(self, fd, callback):
+    """Call 'callback' whenever 'fd' is readable."""
+    self._readers[fd] = callback
+
+  def RemoveReader(self, fd):
+    self._readers.pop(fd, None)
+
+  def CallLater(self, delay, callback, *args):
+    """Call 'callback' with 'args' after 'delay' seconds.
+
+    Returns a timer that can be canceled.
+
+    """
+    timer = _Timer(time.time() + delay, callback, args)
+    heapq.heappush(self._timers, timer)
+    return timer
+
+  def CallSoon(self, callback, *args):
+    return self.CallLater(0, callback, *args)
+
+  def CallFromThread(self, callback, *args):
+    """Call 'callback' with 'args' in the loop from any thread."""
+    self._thread_calls.append((callback, args))
+    os.write(self._wake_write, 'x')
+
+  def RunFromThread(self, function, *args):
+    """Call 'function' in the loop and block until its Future is done.
+
+    Returns the result. This lets threaded code (e.g. web handlers) use
+    robots driven by a loop running in another thread.
+
+    """
+    done = threading.Event()
+    results = []
+    def Call():
+      future = function(*args)
+      future.AddDoneCallback(lambda future: (results.append(future),
+                                             done.set()))
+    self.CallFromThread(Call)
+    done.wait()
+    return results[0].Result()
+
+  def _RunThreadCalls(self):
+    os.read(self._wake_read, 4096)
+    while self._thread_calls:
+      callback, args = self._thread_calls.popleft()
+      self._Call(callback, args)
+
+  def Sleep(self, seconds):
+    """Return a Future that is done after 'seconds'."""
+    future = Future()
+    self.CallLater(seconds, future.SetResult, None)
+    return future
+
+  def _Call(self, callback, args):
+    try:
+      callback(*args)
+    except Exception:
+      logging.error('Exception in event loop callback %r.\n%s' %
+                    (callback, traceback.format_exc()))
+
+  def RunOnce(self, timeout=None):
+    """Wait up to 'timeout' seconds for events and handle them."""
+    if self._timers:
+      delay = max(0, self._timers[0].when - time.time())
+      if timeout is None or delay < timeout:
+        timeout = delay
+    try:
+      readable = select.select(self._readers.keys(), [], [], timeout)[0]
+    except select.error, e:
+      if e.args[0] != errno.EINTR:
+        raise
+      readable = []
+    for fd in readable:
+      callback = self._readers.get(fd)
+      if callback is not None:
+        self._Call(callback, ())
+    now = time.time()
+    while self._timers and self._timers[0].when <= now:
+      timer = heapq.heappop(self._timers)
+      if timer.callback is not None:
+        self._Call(timer.callback, timer.args)
+
+  def RunUntilComplete(self, future):
+    """Run the loop until 'future' is done and return its result."""
+    while not future.Done():
+      self.RunOnce()
+    return future.Result()
+
+  def Run(self):
+    """Run the loop until Stop is called."""
+    self._running = True
+    while self._running:
+      self.RunOnce()
+
+  def Stop(self):
+    self._running = False
+
+
+class AsyncSerialCommandInterface(pyrobot.SerialCommandInterface):
+
+  """An SCI whose reads return Futures instead of blocking.
+
+  Incoming bytes are buffered as the event loop sees them and handed out to
+  reads in the order the reads were made. Commands are still written
+  directly, which doesn't block for the short commands used by the SCI.
+
+  """
+  def __init__(self, loop, tty, baudrate, timeout=pyrobot.SERIAL_TIMEOUT):
+    super(AsyncSerialCommandInterface, self).__init__(tty, baudrate)
+    self.loop = loop
+    self.timeout = timeout
+    self._buffer = ''
+    self._reads = collections.deque()  # [num_bytes, future, timer] lists.
+    self._Register()
+
+  def _Register(self):
+    self.ser.timeout = 0
+    self._fd = self.ser.fileno()
+    self.loop.AddReader(self._fd, self._OnReadable)
+
+  def _Unregister(self):
+    self.loop.RemoveReader(self._fd)
+    self.CancelReads()
+
+  def Close(self):
+    """Stop reading and close the serial port."""
+    self._Unregister()
+    self.ser.close()
+
+  def _OnReadable(self):
+    data = self.ser.read(max(1, self.ser.inWaiting()))
+    if not data:
+      return
+    self._buffer += data
+    while self._reads and len(self._buffer) >= self._reads[0][0]:
+      num_bytes, future, timer = self._reads.popleft()
+      timer.Cancel()
+      data, self._buffer = self._buffer[:num_bytes], self._buffer[num_bytes:]
+      future.SetResult(data)
+
+  def _TimeOut(self, read):
+    if read in self._reads:
+      self._reads.remove(read)
+      read[1].SetException(
+          pyrobot.PyRobotError('Error reading from SCI port. No data.'))
+
+  def Read(self, num_bytes, timeout=None):
+    """Return a Future for the next 'num_bytes' bytes from the robot.
+
+    Fails if they don't arrive within 'timeout' (self.timeout by default).
+
+    """
+    future = Future()
+    if not self._reads and len(self._buffer) >= num_bytes:
+      data, self._buffer = self._buffer[:num_bytes], self._buffer[num_bytes:]
+      future.SetResult(data)
+      return future
+    read = [num_bytes, future, None]
+    read[2] = self.loop.CallLater(timeout or self.timeout, self._TimeOut, read)
+    self._reads.append(read)
+    return future
+
+  def Request(self, bytes, length, extend=None, timeout=None):
+    """Send the request 'bytes' and return an AsyncPendingResponse for its
+    'length' byte answer.
+
+    Requests may be made while others are in flight. Their reads are
+    answered in order, just like the robot answers the requests. Variable
+    length responses ('extend') aren't supported.
+
+    """
+    if extend is not None:
+      raise pyrobot.PyRobotError('Variable length responses are not '
+                                 'supported.')
+    self.FlushInput()  # Only if no other response is pending.
+    self.Send(bytes)
+    return AsyncPendingResponse(self.Read(length, timeout))
+
+  def CancelReads(self):
+    """Fail all pending reads."""
+    reads, self._reads = self._reads, collections.deque()
+    for unused_num_bytes, future, timer in reads:
+      timer.Cancel()
+      future.SetException(pyrobot.PyRobotError('SCI read canceled.'))
+
+  def FlushInput(self):
+    """Discard buffered input unless it is owed to a pending read.
+
+    Requests made while others are in flight are answered in order, so the
+    input must be kept for the earlier requests.
+
+    """
+    if not self._reads:
+      self._buffer = ''
+      super(AsyncSerialCommandInterface, self).FlushInput()
+
+  @Coroutine
+  def Wake(self):
+    """Wake up robot."""
+    self.ser.setRTS(0)
+    yield self.loop.Sleep(0.25)
+    self.ser.setRTS(1)
+    yield self.loop.Sleep(1)  # Technically it should wake after 500ms.
+
+  def Reopen(self, baudrate):
+    """Close the serial port and open it again at 'baudrate'."""
+    self._Unregister()
+    self._buffer = ''
+    super(AsyncSerialCommandInterface, self).Reopen(baudrate)
+    self._Register()
+
+
+class AsyncPendingResponse(object):
+
+  """A response owed by the robot for a request sent with
+  AsyncSerialCommandInterface.Request.
+
+  """
+  def __init__(self, future):
+    self.future = future
+
+  def Wait(self):
+    """Return a Future for the response."""
+    return self.future
+
+
+class AsyncRoombaSensors(pyrobot.RoombaSensors):
+
+  """Retrieves the Roomba's sensor data without blocking.
+
+  Requests go through the same steps as in PyRobot, including the retries
+  and link health accounting of SerialCommandInterface.Retry, but return
+  Futures.
+
+  """
+  def WaitFor(self, predicate, timeout=None, names=None):
+    """Return a Future for the first snapshot that matches 'predicate'.
+
+    See RoombaSensors.WaitFor. The result is None if no matching readings
+    are decoded within 'timeout' seconds.
+
+    """
+    future = Future()
+    def Finish(snapshot):
+      if not future.Done():
+        self.Unsubscribe(subscription)
+        if timer is not None:
+          timer.Cancel()
+        future.SetResult(snapshot)
+    timer = None
+    subscription = self.Subscribe(predicate, Finish, pyrobot.TRIGGER_LEVEL,
+                                  names)
+    if subscription.value:
+      Finish(self.snapshot)
+    elif timeout is not None:
+      timer = self.robot.loop.CallLater(timeout, Finish, None)
+    return future
+
+
+class AsyncCreateSensors(AsyncRoombaSensors, pyrobot.CreateSensors):
+
+  """Retrieves the Create's sensor data without blocking.
+
+  Queries may be made while others are in flight. The robot answers them in
+  order.
+
+  """
+
+
+class AsyncRoomba(pyrobot.Roomba):
+
+  """A Roomba driven by an EventLoop.
+
+  Methods that wait for the robot return Futures. See pyrobot.Roomba for
+  their documentation.
+
+  """
+  Sensors = AsyncRoombaSensors
+
+  def __init__(self, loop, tty='/dev/ttyUSB0'):
+    self.loop = loop
+    super(AsyncRoomba, self).__init__(tty)
+
+  def _OpenSerialCommandInterface(self, tty):
+    return AsyncSerialCommandInterface(self.loop, tty,
+                                       pyrobot.DEFAULT_BAUD_RATE)
+
+  def Close(self):
+    """Stop using the robot's serial port."""
+    self.sci.Close()
+
+  def _Run(self, steps):
+    return StepTask(self.loop, steps)
+
+
+class AsyncCreate(AsyncRoomba, pyrobot.Create):
+
+  """A Create driven by an EventLoop.
+
+  Methods that wait for the robot return Futures. See pyrobot.Create for
+  their documentation.
+
+  """
+  Sensors = AsyncCreateSensors
+
+  def StartStream(self, packet_ids=(6,)):
+    """Start streaming the sensor packets in 'packet_ids'.
+
+    Returns the AsyncSensorStream. Its Next method returns a Future for the
+    values decoded from the next frame.
+
+    """
+    if self.stream is not None:
+      self.StopStream()
+    self.stream = AsyncSensorStream(self, packet_ids)
+    self.stream.Start()
+    return self.stream
+
+
+class AsyncSensorStream(pyrobot.SensorStream):
+
+  """Decodes the Create's sensor stream in the event loop."""
+
+  def __init__(self, robot, packet_ids):
+    super(AsyncSensorStream, self).__init__(robot, packet_ids)
+    self._waiters = []  # Futures for the next frame.
+    self._task = None
+
+  def Start(self):
+    logging.info('Starting sensor stream of packets %r.' % (self.packet_ids,))
+    self.robot.sci.FlushInput()
+    self.robot.sci.stream(len(self.packet_ids), *self.packet_ids)
+    self._buffer = ''
+    self._join = False
+    self._task = self._Loop()
+
+  def Stop(self):
+    logging.info('Stopping sensor stream.')
+    self.robot.sci.pause_resume_stream(0)
+    self._join = True
+    self.robot.sci.CancelReads()
+    waiters, self._waiters = self._waiters, []
+    for future in waiters:
+      future.SetException(pyrobot.PyRobotError('Sensor stream stopped.'))
+
+  def Next(self):
+    """Return a Future for the values decoded from the next frame."""
+    future = Future()
+    if self._join:
+      future.SetException(pyrobot.PyRobotError('Sensor stream stopped.'))
+    else:
+      self._waiters.append(future)
+    return future
+
+  @Coroutine
+  def _Loop(self):
+    health = self.robot.sci.health
+    while not self._join:
+      try:
+        values = yield self.ReadFrame()
+      except pyrobot.PyRobotError, e:
+        if not self._join:
+          self.errors += 1
+          health.Failure(e)
+        continue
+      if values is None:
+        continue
+      health.Success()
+      waiters, self._waiters = self._waiters, []
+      for future in waiters:
+        future.SetResult(values)
+
+  def _Read(self, num_bytes):
+    """Return a Future for the next 'num_bytes' bytes of the stream."""
+    return self.robot.sci.Read(num_bytes)
+
+  def ReadFrame(self):
+    """Return a Future for the values of the next frame in the stream.
+
+    Bad frames are skipped as in pyrobot.SensorStream.
+
+    """
+    return StepTask(self.robot.loop, self._ReadFrameSteps())
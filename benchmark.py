@@ -0,0 +1,648 @@
+#!/usr/bin/python
+
+# The MIT License
+#
+# Copyright (c) 2007 Damon Kohler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Benchmarks for PyRobot's command and sensor hot paths.
+
+Each benchmark runs against an in-memory serial port so that no robot is
+needed. Results are printed as JSON so they can be saved and compared across
+commits:
+
+  $ ./benchmark.py --output=before.json
+  $ ./benchmark.py --output=after.json
+  $ ./benchmark.py --compare=before.json,after.json
+
+Each result also has the number of objects a call leaves for the garbage
+collector, which shows up as collection pauses in the control loops.
+
+"""
+__author__ = "damonkohler@gmail.com (Damon Kohler)"
+
+import BaseHTTPServer
+import gc
+import httplib
+import itertools
+import optparse
+import os
+import SocketServer
+import StringIO
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import urlparse
+import simplejson
+import pyrobot
+import simulator
+
+DEFAULT_ITERATIONS = 10000
+ALLOCATION_SAMPLES = 100
+PERCENTILES = (50, 90, 99)
+
+# Raw values that are not valid as zero.
+SAMPLE_SENSOR_VALUES = {
+    'remote-opcode': 255,  # none
+    'oi-mode': 3,  # full
+    'voltage': 16000,
+    'capacity': 2700,
+    'charge': 2000,
+    }
+
+OBSTACLE_SENSORS = ('bump-left', 'bump-right', 'virtual-wall')
+ODOMETRY_BATCH_SIZE = 4000  # About a minute of streamed readings.
+REPLAY_FRAMES = 4000  # About a minute of streamed group 6 frames.
+TELEOP_RATE = 50  # Setpoints per second sent by the teleop load test.
+TELEOP_POLL_RATE = 10  # Other requests per second during the load test.
+
+
+def SamplePacket(packet_id):
+  """Return a valid raw sensor group packet for 'packet_id'."""
+  decoder = pyrobot.SENSOR_GROUP_DECODERS[packet_id]
+  values = [SAMPLE_SENSOR_VALUES.get(name, 0)
+            for name, unused_format, unused_decode in decoder.fields]
+  return decoder.struct.pack(*values)
+
+
+class CannedSerial(object):
+
+  """An in-memory serial port that replays canned responses.
+
+  The response to each distinct request is computed once by a SimulatedRobot
+  and replayed after that, so that benchmarks measure PyRobot rather than the
+  simulator.
+
+  """
+  def __init__(self):
+    self._robot = simulator.SimulatedRobot()
+    self._robot.output = self._Capture
+    self._responses = {}
+    self._captured = []
+    self._buffer = ''
+
+  def _Capture(self, data):
+    self._captured.append(data)
+
+  def isOpen(self):
+    return True
+
+  def close(self):
+    pass
+
+  def setRTS(self, level):
+    pass
+
+  def write(self, data):
+    data = str(data)
+    response = self._responses.get(data)
+    if response is None:
+      self._captured = []
+      self._robot.Receive(data)
+      response = self._responses[data] = ''.join(self._captured)
+    self._buffer += response
+    return len(data)
+
+  def read(self, size=1):
+    data = self._buffer[:size]
+    self._buffer = self._buffer[size:]
+    return data
+
+  def flushInput(self):
+    self._buffer = ''
+
+
+class FakeOlpc(object):
+
+  """Stands in for olpc_controller.OlpcController off the OLPC."""
+
+  class Sensors(object):
+
+    def __init__(self):
+      self.data = {}
+
+    def GetAll(self):
+      pass
+
+  def __init__(self):
+    self.sensors = self.Sensors()
+
+
+class FakeFido(object):
+
+  """Just enough of fido.Fido to run its services."""
+
+  def __init__(self, robot):
+    self.robot = robot
+    self.olpc = FakeOlpc()
+
+
+def SetUpSend():
+  sci = pyrobot.Create(CannedSerial()).sci
+  return lambda: sci.Send([137, 0, 200, 128, 0])
+
+
+def SetUpSendBytes():
+  sci = pyrobot.Create(CannedSerial()).sci
+  return lambda: sci.Send('\x89\x00\xc8\x80\x00')
+
+
+def SetUpSendWithMetrics():
+  sci = pyrobot.Create(CannedSerial()).sci
+  sci.EnableMetrics()
+  return lambda: sci.Send('\x89\x00\xc8\x80\x00')
+
+
+def SetUpOpcodeDispatch():
+  sci = pyrobot.Create(CannedSerial()).sci
+  return lambda: sci.drive(0, 200, 128, 0)
+
+
+def SetUpDrive():
+  robot = pyrobot.Create(CannedSerial())
+  return lambda: robot.Drive(200, pyrobot.RADIUS_STRAIGHT)
+
+
+def SetUpDecode(packet_id):
+  def SetUp():
+    sensors = pyrobot.CreateSensors(None)
+    decode = getattr(sensors, '_DecodeGroupPacket%d' % packet_id)
+    packet = SamplePacket(packet_id)
+    return lambda: decode(packet)
+  return SetUp
+
+
+def SetUpRequestPacket():
+  robot = pyrobot.Create(CannedSerial())
+  return robot.sensors.GetAll
+
+
+def SetUpRequestPacketWithMetrics():
+  robot = pyrobot.Create(CannedSerial())
+  robot.sci.EnableMetrics()
+  return robot.sensors.GetAll
+
+
+def SetUpQuery():
+  robot = pyrobot.Create(CannedSerial())
+  return lambda: robot.sensors.Query(OBSTACLE_SENSORS)
+
+
+def SetUpPipelinedQueries():
+  """Several sensor queries outstanding at once."""
+  robot = pyrobot.Create(CannedSerial())
+  def PipelinedQueries():
+    queries = [robot.sensors.StartQuery(OBSTACLE_SENSORS),
+               robot.sensors.StartQuery(('voltage', 'charge')),
+               robot.sensors.StartQuery(('distance', 'angle'))]
+    for query in queries:
+      query.Wait()
+  return PipelinedQueries
+
+
+def SetUpFidoSensorsLoop():
+  import fido  # Requires the OLPC's gst module.
+  service = fido.FidoSensors(FakeFido(pyrobot.Create(CannedSerial())))
+  return service.Loop
+
+
+def SetUpOlpcSensors():
+  """Read every OLPC battery field from a fake sysfs tree."""
+  import olpc_controller  # Requires the OLPC's gst module.
+  battery_dir = tempfile.mkdtemp()
+  for unused_name, filename, convert, unused_interval in (
+      olpc_controller.OLPC_BATTERY_FIELDS):
+    contents = 'Normal\n'
+    if convert is int:
+      contents = '42\n'
+    open(os.path.join(battery_dir, filename), 'w').write(contents)
+  sensors = olpc_controller.OlpcSensors(battery_dir)
+  clock = itertools.count(0, 10)  # Every field is due on every call.
+  return lambda: sensors.Refresh(clock.next())
+
+
+def SetUpMotionPreempt():
+  """Preempt a running move and wait for the new one to start."""
+  import fido  # Requires the OLPC's gst module.
+  executor = fido.MotionExecutor(pyrobot.Create(CannedSerial()))
+  executor.Start()
+  started = threading.Event()
+  def Move():
+    started.set()
+    yield 60
+  def Preempt():
+    started.clear()
+    executor.Submit('move', Move)
+    started.wait()
+  return Preempt
+
+
+def StreamFrame(packet_ids, values):
+  """Return a sensor stream frame, less its header, for 'packet_ids'."""
+  data = ''
+  for packet_id in packet_ids:
+    decoder = pyrobot.SENSOR_PACKET_DECODERS[packet_id]
+    data += chr(packet_id) + decoder.struct.pack(
+        *[values.get(name, SAMPLE_SENSOR_VALUES.get(name, 0))
+          for name, unused_format, unused_decode in decoder.fields])
+  length = chr(len(data))
+  checksum = -(pyrobot.STREAM_HEADER + len(data) + sum(map(ord, data))) & 0xff
+  return length, data + chr(checksum)
+
+
+def SetUpReflex():
+  """Decode alternating bump and clear stream frames with a stop reflex."""
+  robot = pyrobot.Create(CannedSerial())
+  robot.AddReflex('bump')
+  stream = pyrobot.SensorStream(robot, (7,))
+  frames = itertools.cycle([StreamFrame((7,), {'bumps-wheeldrops': 0x02}),
+                            StreamFrame((7,), {'bumps-wheeldrops': 0})])
+  def DecodeFrame():
+    length, frame = frames.next()
+    stream.DecodeFrame(length, frame, time.time())
+  return DecodeFrame
+
+
+def SetUpReplay():
+  """Replay a recorded minute of streamed sensor data as fast as possible."""
+  import recorder
+  fd, path = tempfile.mkstemp(suffix='.log')
+  os.close(fd)
+  log = recorder.TrafficLogWriter(path)
+  log.Append(recorder.TX, chr(pyrobot.CREATE_OPCODES['stream']) + '\x01\x06')
+  for i in xrange(REPLAY_FRAMES):
+    length, frame = StreamFrame((6,), {'distance': i % 10})
+    log.Append(recorder.RX, chr(pyrobot.STREAM_HEADER) + length + frame,
+               i * 0.015)
+  log.Close()
+  reader = recorder.TrafficLogReader(path)
+  os.remove(path)  # The mmap keeps the data around.
+  robot = recorder.ReplayRobot()
+  return lambda: recorder.Replayer(reader, robot).Run()
+
+
+def SetUpOdometryUpdate():
+  import odometry  # Requires NumPy.
+  tracker = odometry.Odometry()
+  return lambda: tracker.UpdateFromSensors({'distance': 7, 'angle': 1})
+
+
+def SetUpOdometryBatch():
+  import odometry  # Requires NumPy.
+  tracker = odometry.Odometry()
+  distances = [7] * ODOMETRY_BATCH_SIZE
+  angles = [1] * ODOMETRY_BATCH_SIZE
+  return lambda: tracker.Batch(distances, angles)
+
+
+def SetUpControlLoop():
+  """A full sensor-to-command round trip against the simulated robot."""
+  robot = pyrobot.Create(simulator.LoopbackSerial(
+      simulator.SimulatedRobot()))
+  robot.Control()
+  def ControlLoop():
+    sensors = robot.sensors.Query(OBSTACLE_SENSORS)
+    if sensors['bump-left'] or sensors['bump-right']:
+      robot.Stop()
+    else:
+      robot.DriveStraight(pyrobot.VELOCITY_SLOW)
+  return ControlLoop
+
+
+class TeleopFido(object):
+
+  """Just enough of fido.Fido to teleoperate a simulated robot."""
+
+  def __init__(self):
+    import fido  # Requires the OLPC's gst module.
+    self.robot = pyrobot.Create(simulator.LoopbackSerial(
+        simulator.SimulatedRobot()))
+    self.robot.sci.StartWriter()
+    self.robot.sci.EnableMetrics()
+    self.robot.Control()
+    self.docking = None
+    self.motion = fido.MotionExecutor(self.robot)
+    self.motion.Start()
+    self.teleop = fido.Teleop(self.motion, self.robot)
+    self.scheduler = fido.FidoScheduler()
+
+  def CancelDocking(self):
+    pass
+
+  def Stop(self):
+    self.motion.Stop()
+    self.robot.sci.StopWriter()
+
+
+def WebApp(fido_):
+  """Return a web_ui.FidoWeb that controls 'fido_'."""
+  import web_ui  # Requires gsd.
+  class App(web_ui.FidoWeb):
+    def __init__(self):
+      self._fido = fido_
+      self._lock = threading.Lock()
+      self._comet_queues = {}
+  return App()
+
+
+class WebHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  """Calls the <METHOD>_<path> method of the server's app, as gsd does.
+
+  Query parameters are passed as lists of values. The response is buffered
+  so that the method can still Render an error.
+
+  """
+  def _Call(self):
+    url = urlparse.urlparse(self.path)
+    name = '%s_%s' % (self.command, url.path[1:].replace('.', '_'))
+    method = getattr(self.server.app, name, None)
+    if method is None:
+      self.send_error(404)
+      return
+    self.response = 200
+    output, self.wfile = self.wfile, StringIO.StringIO()
+    try:
+      method(self, **urlparse.parse_qs(url.query))
+    finally:
+      body, self.wfile = self.wfile.getvalue(), output
+    self.send_response(self.response)
+    self.end_headers()
+    self.wfile.write(body)
+
+  do_GET = do_POST = _Call
+
+  def Render(self, template, values=None, response=200):
+    self.response = response
+    self.wfile.write(template)
+
+  def log_message(self, format, *args):
+    pass  # Keep the output to the JSON results.
+
+
+class WebServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+  """Handles each request in its own thread, as gsd does."""
+
+  daemon_threads = True
+
+
+def TeleopLoad(seconds, rate=TELEOP_RATE, poll_rate=TELEOP_POLL_RATE):
+  """Post setpoints to the web UI at 'rate' Hz for 'seconds' seconds.
+
+  Each setpoint is its own POST to /teleop, as from the web UI's client, and
+  is applied to a simulated robot by web_ui.FidoWeb. Meanwhile /metrics is
+  requested 'poll_rate' times a second. Returns a dict of the achieved
+  rates, the latency of the /metrics requests and the teleop counters. The
+  load is sustained if every setpoint was applied, the robot was driven
+  without a deadman stop until the setpoints ended and no /metrics request
+  waited as long as the deadman.
+
+  """
+  fido_ = TeleopFido()
+  teleop = fido_.teleop
+  server = WebServer(('localhost', 0), WebHandler)
+  server.app = WebApp(fido_)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.start()
+  def Request(method, path, body=None):
+    """Return the status of the request and how long it took."""
+    start = time.time()
+    connection = httplib.HTTPConnection(*server.server_address)
+    connection.request(method, path, body)
+    response = connection.getresponse()
+    response.read()
+    connection.close()
+    return response.status, time.time() - start
+  polls = []  # (status, latency) of each /metrics request.
+  done = threading.Event()
+  def Poll():
+    while not done.isSet():
+      polls.append(Request('GET', '/metrics'))
+      done.wait(1.0 / poll_rate)
+  poller = threading.Thread(target=Poll)
+  poller.start()
+  count = int(seconds * rate)
+  period = 1.0 / rate
+  failed = 0
+  start = time.time()
+  for i in xrange(count):
+    delay = start + i * period - time.time()
+    if delay > 0:
+      time.sleep(delay)
+    setpoint = {'velocity': 200 + i % 100, 'radius': 500}
+    status, unused_latency = Request('POST', '/teleop',
+                                     simplejson.dumps(setpoint) + '\n')
+    if status != 200:
+      failed += 1
+  elapsed = time.time() - start
+  deadman_stops = teleop.deadman_stops  # While setpoints were arriving.
+  done.set()
+  poller.join()
+  time.sleep(teleop.deadman * 2)  # Let the deadman stop the robot.
+  server.shutdown()
+  thread.join()
+  fido_.Stop()
+  latencies = [latency for unused_status, latency in polls]
+  metrics = {'requests': len(polls),
+             'failed': len([s for s, unused_latency in polls if s != 200]),
+             'mean_latency': sum(latencies) / len(latencies),
+             'max_latency': max(latencies)}
+  status = teleop.Status()
+  status.update({
+      'rate': rate, 'seconds': elapsed, 'failed': failed,
+      'received': status['setpoints'],
+      'received_per_sec': status['setpoints'] / elapsed,
+      'applied_per_sec': status['applied'] / elapsed,
+      'motion': fido_.motion.Status(), 'metrics_requests': metrics,
+      'sustained': (status['setpoints'] == count and failed == 0 and
+                    deadman_stops == 0 and
+                    status['max_interval'] < teleop.deadman and
+                    metrics['failed'] == 0 and
+                    metrics['max_latency'] < teleop.deadman),
+      })
+  return status
+
+
+# (name, set up function returning the callable to benchmark, batch size).
+# Throughput is timed in batches so that very fast calls are not dominated by
+# the resolution of the timer. See Measure.
+BENCHMARKS = (
+    ('sci_send', SetUpSend, 100),
+    ('sci_send_bytes', SetUpSendBytes, 100),
+    ('sci_send_metrics', SetUpSendWithMetrics, 100),
+    ('sci_opcode_dispatch', SetUpOpcodeDispatch, 100),
+    ('roomba_drive', SetUpDrive, 100),
+    ('decode_group_0', SetUpDecode(0), 100),
+    ('decode_group_6', SetUpDecode(6), 100),
+    ('request_packet_decode', SetUpRequestPacket, 10),
+    ('request_packet_metrics', SetUpRequestPacketWithMetrics, 10),
+    ('sensor_query', SetUpQuery, 10),
+    ('sensor_query_pipelined', SetUpPipelinedQueries, 10),
+    ('fido_sensors_loop', SetUpFidoSensorsLoop, 10),
+    ('olpc_sensors_refresh', SetUpOlpcSensors, 10),
+    ('motion_preempt', SetUpMotionPreempt, 1),
+    ('reflex_decode_to_write', SetUpReflex, 100),
+    ('replay_stream', SetUpReplay, 1),
+    ('odometry_update', SetUpOdometryUpdate, 100),
+    ('odometry_batch', SetUpOdometryBatch, 1),
+    ('control_loop_round_trip', SetUpControlLoop, 1),
+    )
+
+
+def _Percentile(samples, percentile):
+  """Return the 'percentile' of the sorted list 'samples'."""
+  index = int(round((len(samples) - 1) * percentile / 100.0))
+  return samples[index]
+
+
+def MeasureAllocations(function, samples=ALLOCATION_SAMPLES):
+  """Return the mean number of objects one call leaves for the collector.
+
+  These are the container objects (dicts, lists, instances, frames, etc.)
+  still alive after the call, counted with gc.get_objects while collection
+  is off. Objects freed by reference counting are not counted.
+
+  """
+  function()  # Don't count objects that are only created once.
+  gc.collect()
+  gc.disable()
+  try:
+    before = len(gc.get_objects())
+    for unused_i in xrange(samples):
+      function()
+    after = len(gc.get_objects())
+  finally:
+    gc.enable()
+  return (after - before) / float(samples)
+
+
+def Measure(function, iterations=DEFAULT_ITERATIONS, batch=1):
+  """Time 'function' and return a dict of results.
+
+  Throughput is timed in batches of 'batch' calls so that very fast calls
+  are not dominated by the resolution of the timer. Latency percentiles come
+  from timing each call on its own so that slow calls aren't averaged away.
+
+  """
+  timer = timeit.default_timer
+  batches = max(1, iterations // batch)
+  for unused_i in xrange(min(batch, 100)):
+    function()  # Warm up.
+  samples = []
+  for unused_i in xrange(batches * batch):
+    start = timer()
+    function()
+    samples.append(timer() - start)
+  total = sum(samples)
+  if batch > 1:
+    start = timer()
+    for unused_i in xrange(batches):
+      for unused_j in itertools.repeat(None, batch):
+        function()
+    total = timer() - start
+  samples.sort()
+  latency = dict([('p%d' % p, _Percentile(samples, p) * 1e6)
+                  for p in PERCENTILES])
+  latency['max'] = samples[-1] * 1e6
+  return {
+      'iterations': batches * batch,
+      'ops_per_sec': batches * batch / total,
+      'latency_usec': latency,
+      'gc_objects_per_call': MeasureAllocations(
+          function, min(ALLOCATION_SAMPLES, batches * batch)),
+      }
+
+
+def RunBenchmarks(iterations=DEFAULT_ITERATIONS, names=None):
+  """Run the benchmarks in 'names' (all by default) and return the results."""
+  results = {}
+  for name, SetUp, batch in BENCHMARKS:
+    if names and name not in names:
+      continue
+    try:
+      function = SetUp()
+    except ImportError, e:
+      results[name] = {'skipped': str(e)}
+      continue
+    results[name] = Measure(function, iterations, batch)
+  return results
+
+
+def _GitCommit():
+  try:
+    process = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                               cwd=os.path.dirname(os.path.abspath(__file__)),
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  except OSError:
+    return None
+  return process.communicate()[0].strip() or None
+
+
+def Compare(before, after):
+  """Print the change in throughput between two saved results."""
+  for name in sorted(after['benchmarks']):
+    new = after['benchmarks'][name]
+    old = before['benchmarks'].get(name, {})
+    if 'ops_per_sec' not in new or 'ops_per_sec' not in old:
+      print '%-28s n/a' % name
+      continue
+    print '%-28s %12.0f -> %12.0f ops/sec (%+.1f%%)' % (
+        name, old['ops_per_sec'], new['ops_per_sec'],
+        100.0 * (new['ops_per_sec'] / old['ops_per_sec'] - 1))
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('--iterations', type='int', default=DEFAULT_ITERATIONS)
+  parser.add_option('--benchmarks', default='',
+                    help='Comma separated names of benchmarks to run.')
+  parser.add_option('--output', help='File to write JSON results to.')
+  parser.add_option('--compare',
+                    help='Two comma separated result files to compare.')
+  parser.add_option('--teleop_load', type='float',
+                    help='Seconds to run the teleop load test for instead.')
+  options, unused_args = parser.parse_args()
+  if options.teleop_load:
+    print simplejson.dumps(TeleopLoad(options.teleop_load), indent=2,
+                           sort_keys=True)
+    return
+  if options.compare:
+    before, after = options.compare.split(',')
+    Compare(simplejson.load(open(before)), simplejson.load(open(after)))
+    return
+  names = [n for n in options.benchmarks.split(',') if n]
+  results = {
+      'commit': _GitCommit(),
+      'python': sys.version.split()[0],
+      'time': time.time(),
+      'benchmarks': RunBenchmarks(options.iterations, names),
+      }
+  output = simplejson.dumps(results, indent=2, sort_keys=True)
+  if options.output:
+    open(options.output, 'w').write(output)
+  print output
+
+
+if __name__ == '__main__':
+  main()
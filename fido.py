@@ -30,37 +30,166 @@ import logging
 import sys
 import threading
 import time
+import traceback
 import pyrobot
 import arduino_controller
+import async_pyrobot
+import history
+import odometry
 import olpc_controller
 import random
+import recorder
+import simplejson
 
 SENSOR_DELAY = 0.05
 MOVE_DELAY = 1
 TURN_DELAY = 0.25
 DOCKING_TIME_LIMIT = 60
 POWER_MANAGER_DELAY = 60
+OLPC_SENSOR_DELAY = 1  # The shortest interval in OLPC_BATTERY_FIELDS.
+
+# Sensors watched by control loops.
+OBSTACLE_SENSORS = ('bump-left', 'bump-right', 'virtual-wall')
+BUMP_SENSORS = ('bump-left', 'bump-right')
+DOCK_RAMP_SENSORS = ('cliff-left-signal', 'cliff-right-signal')
+DOCK_RAMP_CLIFF_SIGNAL = 1200  # Cliff signals drop below this on the ramp.
+DOCK_FORCE_FIELD_OPCODE = 'red-buoy-and-green-buoy-and-force-field'
+FAST_DOCK_TIME_LIMIT = 10
+FAST_DOCK_SETTLE_TIME = 1  # Seconds for the sensors to update after docking.
+DOCK_RETRY_REVERSES = 3
+MOTION_TICK = 0.05  # Seconds between checks for a newer move.
+MOTION_MAX_AGE = 0.5  # Moves that waited longer than this are dropped.
+SLOW_STOP_STEP = 25  # mm/s the velocity drops by each tick of a slow stop.
+TELEOP_PERIOD = 0.02  # Seconds between drive commands while teleoperating.
+TELEOP_DEADMAN = 0.25  # Stop when no setpoint arrives for this many seconds.
+
+# States of a DockingTask.
+DOCK_SEEK = 'seek'  # Looking for the dock's force field.
+DOCK_BUOY_LOCK = 'buoy-lock'  # Following the buoys to the dock's ramp.
+DOCK_FAST_APPROACH = 'fast-approach'  # Driving up the ramp at full speed.
+DOCK_VERIFY = 'verify'  # Checking for a charging source.
+DOCK_RETRY = 'retry'  # Backing off to try again.
+DOCK_DOCKED = 'docked'
+DOCK_FAILED = 'failed'
+DOCK_CANCELED = 'canceled'
+DOCK_DONE_STATES = frozenset([DOCK_DOCKED, DOCK_FAILED, DOCK_CANCELED])
+
+# Results of a MotionCommand.
+MOTION_DONE = 'done'
+MOTION_PREEMPTED = 'preempted'  # Replaced by a newer move.
+MOTION_DROPPED = 'dropped'  # Too old by the time the robot was free.
+MOTION_FAILED = 'failed'
+# Numeric sensors whose history is kept for the web UI.
+HISTORY_SENSORS = ('voltage', 'current', 'charge', 'temperature', 'wall-signal',
+                   'cliff-left-signal', 'cliff-front-left-signal',
+                   'cliff-front-right-signal', 'cliff-right-signal',
+                   'velocity', 'right-velocity', 'left-velocity',
+                   'olpc_voltage_avg', 'olpc_current_avg')
+HISTORY_DURATION = 600
+
+
+def _Obstacle(sensors):
+  return (sensors['bump-left'] or sensors['bump-right'] or
+          sensors['virtual-wall'])
+
+
+def _Halted(robot, latches):
+  """Return True if a reflex has held drives off since the robot's
+  sci.drive_latch_count was 'latches'.
+
+  """
+  return bool(robot.sci.drive_latches or
+              robot.sci.drive_latch_count != latches)
+
+
+def _Bumped(sensors):
+  return sensors['bump-left'] or sensors['bump-right']
+
+
+def _OnDockRamp(sensors):
+  return (sensors['cliff-left-signal'] < DOCK_RAMP_CLIFF_SIGNAL or
+          sensors['cliff-right-signal'] < DOCK_RAMP_CLIFF_SIGNAL)
+
+
+def _InDockForceField(sensors):
+  return sensors['remote-opcode'] == DOCK_FORCE_FIELD_OPCODE
+
+
+def _ClampVelocity(velocity):
+  return max(-pyrobot.VELOCITY_MAX, min(pyrobot.VELOCITY_MAX, velocity))
+
+
+def _WheelVelocities(velocity, radius):
+  """Return the (left, right) wheel velocities of a drive command."""
+  if radius in (pyrobot.RADIUS_STRAIGHT, 0):
+    return velocity, velocity
+  if radius == pyrobot.RADIUS_TURN_IN_PLACE_CW:
+    return velocity, -velocity
+  if radius == pyrobot.RADIUS_TURN_IN_PLACE_CCW:
+    return -velocity, velocity
+  half = pyrobot.WHEEL_SEPARATION / 2.0
+  return (velocity * (radius - half) / radius,
+          velocity * (radius + half) / radius)
+
 
 # TODO(damonkohler): Keep some global state about our velocity and default
 # movement velocities/durations? It would be nice not to have to pass it
 # around the whole time.
 
 
+def ConfigureRobot(robot):
+  """Set up the Create 'robot' the way Fido drives it.
+
+  Also used to replay recorded traffic through Fido's reflexes.
+
+  """
+  robot.safe = False  # Use full mode for control.
+  # Back off or stop as soon as trouble shows up in the sensor stream rather
+  # than when a control loop gets around to noticing it.
+  robot.AddBackOffReflex('bump', pyrobot.VELOCITY_SLOW, MOVE_DELAY)
+  robot.AddBackOffReflex('virtual-wall', pyrobot.VELOCITY_SLOW, MOVE_DELAY)
+  robot.AddReflex('cliff')
+  robot.AddReflex('wheel-drop')
+  # Track the robot's pose from every distance and angle reading.
+  robot.sensors.odometry = odometry.Odometry(odometry.CREATE_ANGLE_SCALE)
+
+
 class Fido(object):
 
   """Fido is a telepresence robot."""
 
-  def __init__(self, arduino_tty='/dev/ttyUSB0', robot_tty='/dev/ttyUSB1'):
+  def __init__(self, arduino_tty='/dev/ttyUSB0', robot_tty='/dev/ttyUSB1',
+               traffic_log=None):
     self.arduino = arduino_controller.ArduinoController(arduino_tty)
     self.robot = pyrobot.Create(robot_tty)
-    self.robot.safe = False  # Use full mode for control.
+    # Record all serial traffic with the robot to 'traffic_log', if given, so
+    # that runs can be replayed with recorder.py.
+    self.traffic_log = None
+    if traffic_log is not None:
+      self.traffic_log = recorder.Record(self.robot.sci, traffic_log)
+    # Queue commands so that bursts of drive commands from the web UI and
+    # control loops collapse to the newest one instead of going out stale.
+    self.robot.sci.StartWriter()
+    # Metrics for the /metrics page of the web UI. They cost a few
+    # microseconds per command.
+    self.robot.sci.EnableMetrics()
+    ConfigureRobot(self.robot)
     self.olpc = olpc_controller.OlpcController()
-    # Add Fido services.
+    self.docking = None  # The last DockingTask.
+    # Teleoperation moves go through the executor so that a new one replaces
+    # whatever the robot is doing instead of waiting behind it.
+    self.motion = MotionExecutor(self.robot)
+    self.motion.Start()
+    self.teleop = Teleop(self.motion, self.robot)
+    # Add Fido services. They all run from the scheduler's thread.
+    self.scheduler = FidoScheduler()
     self.sensors = FidoSensors(self)
+    self.olpc_sensors = FidoOlpcSensors(self)
     self.power_manager = FidoPowerManager(self)
 
   def StartServices(self):
     logging.info('Starting up Fido services.')
+    self.olpc_sensors.Start()
     self.sensors.Start()
     time.sleep(5)  # Give the sensors a chance to update.
     self.power_manager.Start()
@@ -70,7 +199,11 @@ class Fido(object):
     self.arduino.PowerOlpc(False)
     self.arduino.PowerRobot(True)
     self.robot.SoftReset()
+    self.robot.NegotiateBaudRate()
     self.robot.Control()
+    # Stream sensor data so that control loops see every packet as it is
+    # decoded instead of polling.
+    self.robot.StartStream()
     if not self.arduino.CheckPower():
       logging.warn('Failed to start robot. Retrying.')
       self.StartRobot()
@@ -88,57 +221,115 @@ class Fido(object):
     self.StartServices()
 
   def Forward(self, safe=True):
-    """Drive forward, stopping for obstacles by default."""
+    """Drive forward, stopping for obstacles by default.
+
+    Returns a MotionCommand, as do Reverse, Right and Left.
+
+    """
+    self.CancelDocking()
     logging.info('Forward.')
-    self.robot.DriveStraight(pyrobot.VELOCITY_FAST)
-    if safe and (not self.StopForObstacle(MOVE_DELAY)):
-      self.robot.SlowStop(pyrobot.VELOCITY_FAST)
-    elif not safe:
-      time.sleep(MOVE_DELAY)
-      self.robot.Stop()
+    return self.motion.Submit('forward', self._ForwardMove, safe)
 
   def Reverse(self):
     """Drive in reverse."""
+    self.CancelDocking()
     logging.info('Reverse.')
-    self.robot.DriveStraight(-pyrobot.VELOCITY_FAST)
-    time.sleep(MOVE_DELAY)
-    self.robot.SlowStop(-pyrobot.VELOCITY_FAST)
+    return self.motion.Submit('reverse', self._ReverseMove)
 
   def Right(self):
     """Turn in place to the right."""
+    self.CancelDocking()
     logging.info('Right.')
-    self.robot.TurnInPlace(pyrobot.VELOCITY_SLOW, 'cw')
-    time.sleep(TURN_DELAY)
-    self.robot.Stop()
+    return self.motion.Submit('right', self._TurnMove, 'cw')
 
   def Left(self):
     """Turn in place to the left."""
+    self.CancelDocking()
     logging.info('Left.')
-    self.robot.TurnInPlace(pyrobot.VELOCITY_SLOW, 'ccw')
-    time.sleep(TURN_DELAY)
-    self.robot.Stop()
+    return self.motion.Submit('left', self._TurnMove, 'ccw')
 
-  def StopForObstacle(self, delay):
-    """If we encounter an obstacle, reverse for a moment and return True."""
-    start = time.time()
-    while time.time() < start + delay:
-      if (self.robot.sensors['bump-left'] or
-          self.robot.sensors['bump-right'] or
-          self.robot.sensors['virtual-wall']):
+  # The moves below are run by self.motion (and by DockingTask). They yield
+  # the number of seconds to hold the robot's current drive command for and
+  # are abandoned at any yield when a newer move arrives. They are timed by
+  # the host rather than played as scripts since the robot ignores newer
+  # commands while a script runs. Once a reflex (e.g. a cliff stop) holds
+  # drives off, a move gives up rather than carrying on when it lets go.
+
+  def _ForwardMove(self, safe):
+    latches = self.robot.sci.drive_latch_count
+    self.robot.DriveStraight(pyrobot.VELOCITY_FAST)
+    deadline = time.time() + MOVE_DELAY
+    while time.time() < deadline:
+      if _Halted(self.robot, latches):
+        return
+      if safe and _Obstacle(self.robot.sensors.snapshot):
         logging.info('Oof!')
-        # We have to be going forward to trip these sensors, so negative
-        # velocity has to be correct.
-        self.robot.DriveStraight(-pyrobot.VELOCITY_SLOW)
-        time.sleep(MOVE_DELAY)
-        self.robot.Stop()
-        return True
+        # The bump and virtual wall reflexes are already backing off.
+        yield MOVE_DELAY
+        return
+      yield MOTION_TICK
+    if _Halted(self.robot, latches):
+      return
+    if safe:
+      for seconds in self._SlowStopMove(pyrobot.VELOCITY_FAST):
+        yield seconds
+    else:
+      self.robot.Stop()
+
+  def _ReverseMove(self):
+    latches = self.robot.sci.drive_latch_count
+    self.robot.DriveStraight(-pyrobot.VELOCITY_FAST)
+    for seconds in self._HoldDrive(MOVE_DELAY, latches):
+      yield seconds
+    if _Halted(self.robot, latches):
+      return
+    for seconds in self._SlowStopMove(-pyrobot.VELOCITY_FAST):
+      yield seconds
+
+  def _TurnMove(self, direction, seconds=TURN_DELAY):
+    latches = self.robot.sci.drive_latch_count
+    self.robot.TurnInPlace(pyrobot.VELOCITY_SLOW, direction)
+    for tick in self._HoldDrive(seconds, latches):
+      yield tick
+    if not _Halted(self.robot, latches):
+      self.robot.Stop()
+
+  def _SlowStopMove(self, velocity):
+    """Ramp 'velocity' down to 0 one tick at a time like Roomba.SlowStop."""
+    latches = self.robot.sci.drive_latch_count
+    velocities = xrange(velocity, pyrobot.VELOCITY_SLOW, -SLOW_STOP_STEP)
+    if velocity < 0:
+      velocities = xrange(velocity, -pyrobot.VELOCITY_SLOW, SLOW_STOP_STEP)
+    for v in velocities:
+      if _Halted(self.robot, latches):
+        return
+      self.robot.Drive(v, pyrobot.RADIUS_STRAIGHT)
+      yield MOTION_TICK
+    if not _Halted(self.robot, latches):
+      self.robot.Stop()
+
+  def _HoldDrive(self, seconds, latches):
+    """Hold the current drive for 'seconds' one tick at a time, giving up
+    early if _Halted.
+
+    """
+    deadline = time.time() + seconds
+    while time.time() < deadline and not _Halted(self.robot, latches):
+      yield min(MOTION_TICK, deadline - time.time())
+
+  def EnableReflexes(self, enabled):
+    """Turn the robot's reflexes on or off."""
+    for reflex in self.robot.reflexes:
+      reflex.enabled = enabled
 
   def Restart(self):
+    self.TakeControl()
     logging.info('Restarting.')
     self.StartRobot()
 
   def Undock(self):
     """Backup out of the dock."""
+    self.TakeControl()
     logging.info('Disengaging from dock.')
     self.power_manager.Stop()
     self.StartRobot()
@@ -147,114 +338,733 @@ class Fido(object):
     self.robot.Stop()
     self.power_manager.Start()
 
-  def Dock(self):
-    """Drive the robot into the docking station.
+  def Dock(self, listener=None):
+    """Start driving the robot into the docking station in the background.
+
+    Returns the DockingTask, which any other motion command cancels.
+    'listener' is added to it before it starts (see DockingTask.AddListener).
+
+    """
+    self.TakeControl()
+    logging.info('Docking.')
+    self.docking = DockingTask(self)
+    if listener is not None:
+      self.docking.AddListener(listener)
+    self.docking.Start()
+    return self.docking
+
+  def CancelDocking(self):
+    """Stop docking, if the robot is, and wait for it to let go of the robot.
+    """
+    if self.docking is not None:
+      self.docking.Cancel()
+
+  def TakeControl(self):
+    """Stop docking and any move so that the caller can drive the robot."""
+    self.CancelDocking()
+    self.motion.Cancel()
+
+
+class DockingCanceled(Exception):
+  pass
+
 
-    This is required since the cover-and-dock demo doesn't drive the robot
-    fast enough to get into the dock when it has extra gear on it (it weighs
-    too much). It would probably work on carpet if it's squishy enough though.
+class DockingTask(object):
+
+  """Drives the robot into the docking station as a state machine.
+
+  This is required since the cover-and-dock demo doesn't drive the robot
+  fast enough to get into the dock when it has extra gear on it (it weighs
+  too much). It would probably work on carpet if it's squishy enough though.
+
+  The robot seeks the dock, follows the buoys onto the dock's ramp and then
+  drives the rest of the way in at full speed. If it isn't charging after
+  that, it backs off, turns a little and tries again until 'time_limit'
+  seconds are up.
+
+  Listeners added with AddListener are called with the task and its new
+  state on every transition, in the task's thread. The time spent in each
+  state is added up in self.timings.
+
+  """
+  def __init__(self, fido, time_limit=DOCKING_TIME_LIMIT):
+    self.fido = fido
+    self.robot = fido.robot
+    self.time_limit = time_limit
+    self.state = None
+    self.started = None
+    self.deadline = None
+    self.retries = 0
+    self.events = []  # (time, state) for every transition.
+    self.timings = {}  # Maps states to total seconds spent in them.
+    self._entered = None  # When the current state was entered.
+    self._listeners = []
+    self._handlers = {
+        DOCK_SEEK: self._Seek,
+        DOCK_BUOY_LOCK: self._BuoyLock,
+        DOCK_FAST_APPROACH: self._FastApproach,
+        DOCK_VERIFY: self._Verify,
+        DOCK_RETRY: self._Retry,
+        }
+    self._canceled = threading.Event()
+    self._wake = threading.Event()  # Set on cancel and by sensor waits.
+    self._done = threading.Event()
+    self._thread = None
+
+  def AddListener(self, listener):
+    """Call 'listener' with the task and its state on each transition."""
+    self._listeners.append(listener)
+
+  def Start(self):
+    self.started = time.time()
+    self.deadline = self.started + self.time_limit
+    self._thread = threading.Thread(target=self._Run)
+    self._thread.setDaemon(True)
+    self._thread.start()
+
+  def Cancel(self):
+    """Stop docking and wait until the task has let go of the robot."""
+    self._canceled.set()
+    self._wake.set()
+    if (self._thread is not None and
+        threading.currentThread() is not self._thread):
+      self._thread.join()
+
+  def Wait(self, timeout=None):
+    """Wait for docking to finish and return the final state.
+
+    Returns None if it's still going after 'timeout' seconds.
+
+    """
+    self._done.wait(timeout)
+    if self._done.isSet():
+      return self.state
+
+  @property
+  def done(self):
+    return self._done.isSet()
+
+  def Status(self):
+    """Return a dict of the task's progress."""
+    timings = dict(self.timings)
+    if self._entered is not None and not self.done:
+      timings[self.state] = (timings.get(self.state, 0) + time.time() -
+                             self._entered)
+    return {'state': self.state, 'done': self.done, 'retries': self.retries,
+            'elapsed': time.time() - self.started, 'timings': timings,
+            'events': [(when - self.started, state)
+                       for when, state in self.events]}
+
+  def _Enter(self, state):
+    """Move to 'state', accounting for the time spent in the last one."""
+    now = time.time()
+    if self._entered is not None:
+      self.timings[self.state] = (self.timings.get(self.state, 0) + now -
+                                  self._entered)
+    self.state = state
+    self._entered = now
+    self.events.append((now, state))
+    logging.info('Docking: %s.' % state)
+    for listener in self._listeners:
+      try:
+        listener(self, state)
+      except Exception:
+        logging.error('Exception in docking listener.\n%s' %
+                      traceback.format_exc())
+
+  def _Run(self):
+    state = DOCK_SEEK
+    # Docking means bumping into the dock and driving over its ramp.
+    self.fido.EnableReflexes(False)
+    try:
+      try:
+        self.robot.Dock()
+        while state not in DOCK_DONE_STATES:
+          self._Enter(state)
+          state = self._handlers[state]()
+      except DockingCanceled:
+        state = DOCK_CANCELED
+      except Exception:
+        logging.error('Exception while docking.\n%s' % traceback.format_exc())
+        state = DOCK_FAILED
+      if state != DOCK_DOCKED:
+        self.robot.Control()  # Take the robot back from the dock seeker.
+      if state == DOCK_FAILED:
+        self.robot.Stop()
+    finally:
+      self.fido.EnableReflexes(True)
+      self._Enter(state)
+      self._done.set()
+
+  def _Remaining(self):
+    return max(0, self.deadline - time.time())
+
+  def _CheckCanceled(self):
+    if self._canceled.isSet():
+      raise DockingCanceled()
+
+  def _Sleep(self, seconds):
+    """Sleep for 'seconds' unless canceled first."""
+    self._wake.clear()
+    self._CheckCanceled()
+    self._wake.wait(seconds)
+    self._CheckCanceled()
+
+  def _WaitFor(self, predicate, timeout, names):
+    """Wait up to 'timeout' seconds for the sensors to match 'predicate'.
+
+    Returns whether they did.
 
     """
-    def FastDock():
-      self.robot.Control()
-      self.Reverse()
-      self.robot.DriveStraight(pyrobot.VELOCITY_MAX)
-      start = time.time()
-      while (time.time() - start < 10
-             and (not self.sensors['bump-left'])
-             and (not self.sensors['bump-right'])):
-        time.sleep(SENSOR_DELAY)
+    self._wake.clear()
+    self._CheckCanceled()
+    subscription = self.robot.sensors.Subscribe(
+        predicate, lambda snapshot: self._wake.set(), pyrobot.TRIGGER_LEVEL,
+        names)
+    try:
+      if not subscription.value:
+        self._wake.wait(timeout)
+    finally:
+      self.robot.sensors.Unsubscribe(subscription)
+    self._CheckCanceled()
+    return bool(subscription.value or subscription.count)
+
+  def _Move(self, move):
+    """Run one of Fido's moves, stopping the robot if canceled first."""
+    try:
+      for seconds in move:
+        self._Sleep(seconds)
+    except DockingCanceled:
       self.robot.Stop()
-      time.sleep(1)  # Give the sensors some time to update.
-      if self.sensors['charging-sources-available']:
-        logging.info('Docking succeeded!')
-        return True
-
-    def Retry():
-      logging.info('Docking failed. Retrying.')
-      self.robot.Control()
-      [self.Reverse() for i in range(3)]
-      direction = 'cw'
-      if random.random() > 0.5:
-        direction = 'ccw'
-      self.robot.TurnInPlace(pyrobot.VELOCITY_SLOW, direction)
-      time.sleep(random.uniform(0.5, 2))
-      self.robot.Dock()
+      raise
 
-    logging.info('Docking.')
-    self.robot.Dock()
-    start = time.time()
-    while time.time() - start < DOCKING_TIME_LIMIT:
-      opcode = self.sensors['remote-opcode']
-      if opcode == 'red-buoy-and-green-buoy-and-force-field':
-        while True:
-          if (self.sensors['cliff-left-signal'] < 1200 or
-              self.sensors['cliff-right-signal'] < 1200):
-            if FastDock():
-              return
-            else:
-              Retry()
-              break
-          time.sleep(SENSOR_DELAY)
-      time.sleep(SENSOR_DELAY)
+  def _Seek(self):
+    if self._WaitFor(_InDockForceField, self._Remaining(), ['remote-opcode']):
+      return DOCK_BUOY_LOCK
+    return DOCK_FAILED
+
+  def _BuoyLock(self):
+    if self._WaitFor(_OnDockRamp, self._Remaining(), DOCK_RAMP_SENSORS):
+      return DOCK_FAST_APPROACH
+    return DOCK_FAILED
+
+  def _FastApproach(self):
+    self.robot.Control()
+    self._Move(self.fido._ReverseMove())
+    self.robot.DriveStraight(pyrobot.VELOCITY_MAX)
+    try:
+      self._WaitFor(_Bumped, min(FAST_DOCK_TIME_LIMIT, self._Remaining()),
+                    BUMP_SENSORS)
+    finally:
+      self.robot.Stop()
+    return DOCK_VERIFY
+
+  def _Verify(self):
+    self._Sleep(FAST_DOCK_SETTLE_TIME)  # Give the sensors some time to update.
+    if self.fido.sensors.get('charging-sources-available'):
+      return DOCK_DOCKED
+    if not self._Remaining():
+      return DOCK_FAILED
+    return DOCK_RETRY
+
+  def _Retry(self):
+    self.retries += 1
     self.robot.Control()
+    for unused_i in range(DOCK_RETRY_REVERSES):
+      self._Move(self.fido._ReverseMove())
+    direction = 'cw'
+    if random.random() > 0.5:
+      direction = 'ccw'
+    self._Move(self.fido._TurnMove(direction, random.uniform(0.5, 2)))
+    self.robot.Dock()
+    return DOCK_SEEK
+
+
+class MotionCommand(object):
+
+  """A move submitted to a MotionExecutor.
+
+  Wait returns the move's result (one of the MOTION_* results) once it has
+  finished or been preempted or dropped.
+
+  """
+  def __init__(self, name, move, args):
+    self.name = name
+    self.move = move
+    self.args = args
+    self.submitted = time.time()
+    self.started = None
+    self.finished = None
+    self.result = None
+    self._done = threading.Event()
+
+  def Wait(self, timeout=None):
+    """Wait for the move to finish and return its result.
+
+    Returns None if it's still queued or running after 'timeout' seconds.
+
+    """
+    self._done.wait(timeout)
+    return self.result
+
+  @property
+  def done(self):
+    return self._done.isSet()
+
+  @property
+  def age(self):
+    """Seconds since the move was submitted."""
+    return time.time() - self.submitted
+
+  def _Finish(self, result):
+    self.finished = time.time()
+    self.result = result
+    self._done.set()
+
+
+class MotionExecutor(object):
+
+  """Runs one move at a time on the robot's drive wheels from its own thread.
+
+  A move is a generator function that sends drive commands and yields the
+  number of seconds to hold them for. Submitting a move replaces any move
+  that is still queued and preempts the running one at its next yield, so at
+  most one move ever waits. Moves that have waited more than 'max_age'
+  seconds by the time the robot is free are dropped instead of run.
+
+  """
+  def __init__(self, robot, max_age=MOTION_MAX_AGE):
+    self.robot = robot
+    self.max_age = max_age
+    self.current = None  # The running MotionCommand.
+    self.completed = 0
+    self.preempted = 0
+    self.dropped = 0
+    self.failed = 0
+    self.latency = 0  # Seconds the last started move waited to start.
+    self.max_latency = 0
+    self._pending = None  # The next MotionCommand to run.
+    self._canceled = False  # Set to abandon the running move.
+    self._moving = False  # Whether a preempted move left the robot moving.
+    self._condition = threading.Condition()
+    self._thread = None
+    self._join = False
+
+  def Start(self):
+    self._join = False
+    self._thread = threading.Thread(target=self._Loop)
+    self._thread.setDaemon(True)
+    self._thread.start()
+
+  def Stop(self):
+    """Abandon any moves and wait for the executor's thread to exit."""
+    with self._condition:
+      self._join = True
+      self._condition.notifyAll()
+    self.Cancel()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+  def Submit(self, name, move, *args):
+    """Run move(*args) as soon as the robot is free and return its
+    MotionCommand.
+
+    """
+    command = MotionCommand(name, move, args)
+    with self._condition:
+      replaced = self._pending
+      self._pending = command
+      self._condition.notifyAll()
+    if replaced is not None:
+      self._Finished(replaced, MOTION_PREEMPTED)
+    return command
+
+  def Cancel(self):
+    """Abandon the queued and running moves without stopping the robot.
+
+    Returns once the running move has let go of the robot, unless called
+    from a move.
+
+    """
+    with self._condition:
+      replaced = self._pending
+      self._pending = None
+      if self.current is not None:
+        self._canceled = True
+        self._condition.notifyAll()
+        if threading.currentThread() is not self._thread:
+          while self.current is not None:
+            self._condition.wait()
+      self._moving = False  # The caller takes over the robot.
+    if replaced is not None:
+      self._Finished(replaced, MOTION_PREEMPTED)
+
+  def Status(self):
+    """Return a dict of the executor's counters."""
+    current = self.current
+    return {'current': current and current.name,
+            'completed': self.completed, 'preempted': self.preempted,
+            'dropped': self.dropped, 'failed': self.failed,
+            'latency': self.latency, 'max_latency': self.max_latency}
+
+  def _Finished(self, command, result):
+    if result == MOTION_DONE:
+      self.completed += 1
+    elif result == MOTION_PREEMPTED:
+      self.preempted += 1
+    elif result == MOTION_DROPPED:
+      self.dropped += 1
+    else:
+      self.failed += 1
+    command._Finish(result)
+
+  def _Interrupted(self):
+    return self._pending is not None or self._canceled or self._join
+
+  def _Hold(self, seconds):
+    """Sleep for 'seconds' and return True if interrupted first."""
+    deadline = time.time() + seconds
+    with self._condition:
+      while not self._Interrupted():
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          return False
+        self._condition.wait(remaining)
+      return True
+
+  def _Next(self):
+    """Wait for the next move to run and return it, or None to exit."""
+    with self._condition:
+      while self._pending is None and not self._join:
+        self._condition.wait()
+      if self._join:
+        return None
+      self.current = self._pending
+      self._pending = None
+      self._canceled = False
+      return self.current
+
+  def _Loop(self):
+    while True:
+      command = self._Next()
+      if command is None:
+        return
+      if command.age > self.max_age:
+        logging.info('Dropping stale move %s (%.2f seconds old).' %
+                     (command.name, command.age))
+        result = MOTION_DROPPED
+        if self._moving:
+          self.robot.Stop()
+          self._moving = False
+      else:
+        result = self._Run(command)
+      with self._condition:
+        self.current = None
+        self._condition.notifyAll()
+      self._Finished(command, result)
+
+  def _Run(self, command):
+    """Run 'command' until it finishes or is interrupted."""
+    command.started = time.time()
+    self.latency = command.started - command.submitted
+    self.max_latency = max(self.max_latency, self.latency)
+    self._moving = True
+    steps = command.move(*command.args)
+    try:
+      for seconds in steps:
+        if self._Hold(seconds):
+          steps.close()
+          return MOTION_PREEMPTED
+    except Exception:
+      logging.error('Exception in move %s.\n%s' %
+                    (command.name, traceback.format_exc()))
+      try:
+        self.robot.Stop()
+      except pyrobot.PyRobotError, e:
+        logging.error('Failed to stop after move: %s' % e)
+      self._moving = False
+      return MOTION_FAILED
+    self._moving = False
+    return MOTION_DONE
+
+
+class Teleop(object):
+
+  """Drives the robot from a stream of wheel velocity setpoints.
+
+  The newest setpoint is sent as a direct_drive command every 'period'
+  seconds by a move on the MotionExecutor, so discrete moves and
+  teleoperation preempt each other. When no setpoint arrives for 'deadman'
+  seconds the robot is stopped and the move ends until the next setpoint.
+
+  The move also ends as soon as a reflex (cliff, wheel drop, bump or
+  virtual wall) holds drives off, since Fido drives in full mode and gets
+  no protection from the robot itself. Setpoints are then ignored until the
+  reflex has let go, and driving resumes with the next one after that.
+
+  """
+  def __init__(self, motion, robot, period=TELEOP_PERIOD,
+               deadman=TELEOP_DEADMAN):
+    self.motion = motion
+    self.robot = robot
+    self.period = period
+    self.deadman = deadman
+    self.setpoint = (0, 0)  # (left, right) in mm/s.
+    self.received = None  # When the last setpoint arrived.
+    self.setpoints = 0
+    self.applied = 0  # direct_drive commands sent.
+    self.deadman_stops = 0
+    self.reflex_stops = 0
+    self.ignored = 0  # Setpoints ignored while a reflex held drives off.
+    self.max_interval = 0  # Most seconds between two direct_drive commands.
+    self._command = None  # The running teleop MotionCommand.
+    self._halted = False  # Whether a reflex ended the last move.
+    self._lock = threading.Lock()
+
+  def Set(self, left, right):
+    """Drive the left and right wheels at the given mm/s until the next
+    setpoint.
+
+    """
+    setpoint = (_ClampVelocity(left), _ClampVelocity(right))
+    with self._lock:
+      self.setpoints += 1
+      if self._halted:
+        if self.robot.sci.drive_latches:
+          self.ignored += 1
+          return
+        self._halted = False
+      self.setpoint = setpoint
+      self.received = time.time()
+      if self._command is None or self._command.done:
+        self._command = self.motion.Submit('teleop', self._Move)
+
+  def SetDrive(self, velocity, radius):
+    """Like Set, but from the velocity and radius of a drive command."""
+    self.Set(*_WheelVelocities(velocity, radius))
+
+  def Follow(self, stream):
+    """Apply setpoints read from the file-like 'stream' until it closes.
+
+    Each line is a JSON object with either 'left' and 'right' or 'velocity'
+    and 'radius' keys. Raises ValueError for any other line. Returns the
+    number of setpoints applied.
+
+    """
+    count = 0
+    for line in iter(stream.readline, ''):
+      if not line.strip():
+        continue
+      setpoint = simplejson.loads(line)
+      if not isinstance(setpoint, dict):
+        raise ValueError('Not a setpoint: %r' % line)
+      if 'left' in setpoint and 'right' in setpoint:
+        self.Set(setpoint['left'], setpoint['right'])
+      elif 'velocity' in setpoint and 'radius' in setpoint:
+        self.SetDrive(setpoint['velocity'], setpoint['radius'])
+      else:
+        raise ValueError('Not a setpoint: %r' % line)
+      count += 1
+    return count
+
+  def Status(self):
+    """Return a dict of teleoperation counters."""
+    return {'setpoint': self.setpoint, 'received': self.received,
+            'setpoints': self.setpoints, 'applied': self.applied,
+            'deadman_stops': self.deadman_stops,
+            'reflex_stops': self.reflex_stops, 'ignored': self.ignored,
+            'max_interval': self.max_interval}
+
+  def _Move(self):
+    latches = self.robot.sci.drive_latch_count
+    last = None
+    while True:
+      with self._lock:
+        if _Halted(self.robot, latches):
+          self._command = None
+          self._halted = True
+          self.reflex_stops += 1
+          logging.info('Teleop stopped by a reflex.')
+          return
+        if time.time() - self.received > self.deadman:
+          self._command = None
+          break
+        left, right = self.setpoint
+      self.robot.DirectDrive(right, left)
+      now = time.time()
+      if last is not None:
+        self.max_interval = max(self.max_interval, now - last)
+      last = now
+      self.applied += 1
+      yield self.period
+    logging.info('No teleop setpoint for %.2f seconds. Stopping.' %
+                 self.deadman)
+    self.deadman_stops += 1
     self.robot.Stop()
-    logging.info('Docking timed out.')
+
+
+class FidoScheduler(object):
+
+  """Runs the Loop of every started FidoService from a single thread.
+
+  Services wait on the timer heap of an async_pyrobot.EventLoop, which
+  sleeps in select until the next one is due. Idle services cost no wakeups
+  at all.
+
+  """
+  def __init__(self):
+    self.loop = async_pyrobot.EventLoop()
+    self.services = []  # Services that have been started.
+    self._lock = threading.Lock()
+    self._thread = None
+
+  def _InLoop(self):
+    return threading.currentThread() is self._thread
+
+  def _CallInLoop(self, callback, *args):
+    """Call 'callback' in the scheduler's thread and wait until it's done.
+
+    While a service's Loop is running, this waits for it to finish.
+
+    """
+    if self._InLoop():
+      callback(*args)
+      return
+    with self._lock:
+      if self._thread is None:
+        self._thread = threading.Thread(target=self.loop.Run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+    done = threading.Event()
+    def Call():
+      try:
+        callback(*args)
+      finally:
+        done.set()
+    self.loop.CallFromThread(Call)
+    done.wait()
+
+  def Schedule(self, service):
+    """Run 'service'.Loop now and then every 'service'.period seconds."""
+    self._CallInLoop(self._Schedule, service, time.time())
+
+  def Cancel(self, service):
+    """Stop running 'service', waiting for a Loop in progress to finish."""
+    self._CallInLoop(self._Cancel, service)
+
+  def _Schedule(self, service, deadline):
+    if service not in self.services:
+      self.services.append(service)
+    service.active = True
+    service.deadline = deadline
+    service._timer = self.loop.CallLater(max(0, deadline - time.time()),
+                                         self._Run, service)
+
+  def _Cancel(self, service):
+    service.active = False
+    if service._timer is not None:
+      service._timer.Cancel()
+      service._timer = None
+
+  def _Run(self, service):
+    service._timer = None
+    start = time.time()
+    service.lateness = start - service.deadline
+    try:
+      service.Loop()
+    except Exception:
+      logging.error('Exception in service %s. Stopping it.\n%s' %
+                    (service.name, traceback.format_exc()))
+      service.active = False
+      return
+    finally:
+      service.runs += 1
+      service.duration = time.time() - start
+    if not service.active or service._timer is not None:
+      return  # Stopped or restarted by its own Loop.
+    # Keep to the period, but don't try to catch up on missed runs.
+    deadline = service.deadline + service.period
+    now = time.time()
+    if deadline < now:
+      service.overruns += 1
+      deadline = now
+    self._Schedule(service, deadline)
+
+  def Status(self):
+    """Return a dict of the timing of each service."""
+    return dict([(service.name, service.Status())
+                 for service in self.services])
 
 
 class FidoService(object):
 
-  """A FidoService runs in a separate thread and can be started and stopped."""
+  """A FidoService runs Loop every 'period' seconds and can be started and
+  stopped.
+
+  All services share the FidoScheduler of their Fido, so Loop should do a
+  single iteration and return rather than sleep.
+
+  """
+  period = 1  # Seconds from the start of one Loop to the start of the next.
 
   def __init__(self, fido):
     self.name = self.__class__.__name__
     self.fido = fido
-    self._join = False
-    self._thread = None
+    self.active = False
+    self.deadline = None  # When Loop is next due.
+    self.runs = 0
+    self.overruns = 0  # Runs that started more than a period late.
+    self.lateness = None  # Seconds the last run started after its deadline.
+    self.duration = None  # Seconds the last run took.
+    self._timer = None
+    self._stopped = threading.Event()
 
   def Loop(self):
     """Should be overridden by subclass to define a single loop iteration."""
     raise NotImplementedError
 
-  def _Loop(self):
-    """Loop until asked to stop."""
-    while not self._join:
-      try:
-        self.Loop()
-      except:
-        logging.info('Exception in service %s.' % self.name)
-        raise
-
   def Start(self):
     """Start up the service."""
-    if self._thread is not None:
+    if self.active:
       logging.info('Restarting service %s.' % self.name)
       self.Stop()
     else:
       logging.info('Starting service %s.' % self.name)
-    self._thread = threading.Thread(target=self._Loop)
-    self._thread.setDaemon(True)
-    self._thread.start()
+    self._stopped.clear()
+    self.fido.scheduler.Schedule(self)
 
   def Stop(self):
     """Stop the service."""
-    self._join = True
-    if self._thread is not None:
-      self._thread.join()
-      self._thread = None
-    self._join = False
+    self._stopped.set()  # Cut short a Delay in progress.
+    self.fido.scheduler.Cancel(self)
 
   def Delay(self, seconds):
-    """Sleep while still checking if Stop was called."""
-    start = time.time()
-    while time.time() - start < seconds and not self._join:
-      time.sleep(0.01)
+    """Sleep in Loop, returning early if Stop is called.
+
+    This holds up every other service, so keep it short.
+
+    """
+    self._stopped.wait(seconds)
+
+  def Status(self):
+    """Return a dict of the service's timing."""
+    return {'active': self.active, 'period': self.period,
+            'deadline': self.deadline, 'runs': self.runs,
+            'overruns': self.overruns, 'lateness': self.lateness,
+            'duration': self.duration}
 
 
 class FidoPowerManager(FidoService):
 
   """Connects the OLPC power when charging sources are available."""
 
+  period = POWER_MANAGER_DELAY
+
+  def __init__(self, fido):
+    super(FidoPowerManager, self).__init__(fido)
+    self._reset = None  # The thread doing a soft reset, if any.
+
   def Loop(self):
     """Connect the OLPC power to the robot if a charging source is available."""
     if 'charging-sources-available' not in self.fido.sensors:
@@ -262,36 +1072,97 @@ class FidoPowerManager(FidoService):
     elif self.fido.sensors['charging-sources-available']:
       logging.info('Charging source available.')
       if self.fido.sensors['charging-state'] == 'not-charging':
-        self.fido.robot.SoftReset()  # Robot won't charge until we reset it.
+        self.StartSoftReset()  # Robot won't charge until we reset it.
       self.fido.arduino.PowerOlpc(True)
     else:
       # No charging sources available.
       self.fido.arduino.PowerOlpc(False)
-    self.Delay(POWER_MANAGER_DELAY)
+
+  def StartSoftReset(self):
+    """Soft reset the robot in the background unless it is already resetting.
+
+    The reset takes at least pyrobot.START_DELAY, which would hold up every
+    other service if it ran in Loop.
+
+    """
+    if self._reset is not None and self._reset.isAlive():
+      return
+    self._reset = threading.Thread(target=self._SoftReset)
+    self._reset.setDaemon(True)
+    self._reset.start()
+
+  def _SoftReset(self):
+    try:
+      self.fido.robot.SoftReset()
+    except pyrobot.PyRobotError, e:
+      logging.warn('Soft reset failed: %s' % e)
+
+
+class FidoOlpcSensors(FidoService):
+
+  """Reads the OLPC's battery sensors as each one comes due."""
+
+  period = OLPC_SENSOR_DELAY
+
+  def Loop(self):
+    self.fido.olpc.sensors.Refresh()
 
 
 class FidoSensors(FidoService):
 
-  """Periodically updates sensor data from the OLPC and the robot."""
+  """Periodically updates the robot's sensor data and serves it along with
+  the OLPC's.
+
+  """
+  period = SENSOR_DELAY
 
   def __init__(self, fido):
     super(FidoSensors, self).__init__(fido)
-    self.data = {}
+    self.history = history.SensorHistory(HISTORY_SENSORS, HISTORY_DURATION,
+                                         SENSOR_DELAY)
 
   def Loop(self):
-    """Get sensor data from robot and OLPC."""
-    self.fido.olpc.sensors.GetAll()
+    """Get sensor data from the robot.
+
+    OLPC sensor data is updated separately by FidoOlpcSensors.
+
+    """
     try:
       self.fido.robot.sensors.GetAll()
     except pyrobot.PyRobotError, e:
-      logging.warn(e)
+      # Already retried. The SCI's LinkHealth warns if the link goes down.
+      logging.debug('Dropped sensor update: %s' % e)
     else:
-      self.data.update(self.fido.robot.sensors.data)
-      self.data.update(self.fido.olpc.sensors.data)
-    self.Delay(SENSOR_DELAY)
+      self.history.Append(time.time(), self)
+
+  @property
+  def odometry(self):
+    """The robot's dead reckoning odometry."""
+    return self.fido.robot.sensors.odometry
+
+  @property
+  def pose(self):
+    """The robot's (x, y, theta) pose estimate in mm and radians."""
+    return self.odometry.pose
+
+  @property
+  def data(self):
+    """A dict of the latest robot and OLPC sensor data."""
+    data = self.fido.robot.sensors.snapshot.AsDict()
+    data.update(self.fido.olpc.sensors.data)
+    return data
 
   def __getitem__(self, name):
-    return self.data[name]
+    snapshot = self.fido.robot.sensors.snapshot
+    if name in snapshot:
+      return snapshot[name]
+    return self.fido.olpc.sensors.data[name]
 
   def __contains__(self, name):
-    return name in self.data
+    return (name in self.fido.robot.sensors.snapshot or
+            name in self.fido.olpc.sensors.data)
+
+  def get(self, name, default=None):
+    if name in self:
+      return self[name]
+    return default
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+
+# The MIT License
+#
+# Copyright (c) 2007 Damon Kohler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Tests Fido's teleoperation against a simulated Create."""
+
+__author__ = "damonkohler@gmail.com (Damon Kohler)"
+
+import time
+import unittest
+import fido  # Requires the OLPC's gst module.
+import pyrobot
+import simulator
+
+VELOCITY = 200  # mm/s
+
+
+class TeleopTest(unittest.TestCase):
+
+  def setUp(self):
+    self.sim = simulator.SimulatedRobot()
+    self.robot = pyrobot.Create(simulator.LoopbackSerial(self.sim))
+    self.robot.sci.StartWriter()
+    fido.ConfigureRobot(self.robot)
+    self.robot.Control()
+    self.robot.sci.full()  # Like Fido, no cliff protection from the robot.
+    self.robot.StartStream()
+    self.motion = fido.MotionExecutor(self.robot)
+    self.motion.Start()
+    self.teleop = fido.Teleop(self.motion, self.robot)
+
+  def tearDown(self):
+    self.motion.Stop()
+    self.robot.StopStream()
+    self.robot.sci.StopWriter()
+
+  def Drive(self, seconds):
+    """Send setpoints for 'seconds' and return the wheel velocities seen."""
+    velocities = set()
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+      self.teleop.Set(VELOCITY, VELOCITY)
+      time.sleep(self.teleop.period)
+      velocities.add((self.sim.left_velocity, self.sim.right_velocity))
+    return velocities
+
+  def Wait(self, seconds):
+    """Wait without setpoints and return the wheel velocities seen."""
+    velocities = set()
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+      time.sleep(self.teleop.period)
+      velocities.add((self.sim.left_velocity, self.sim.right_velocity))
+    return velocities
+
+  def testCliffStopsTeleop(self):
+    self.Drive(0.2)
+    self.assertEqual((VELOCITY, VELOCITY),
+                     (self.sim.left_velocity, self.sim.right_velocity))
+    self.sim.SetCliffs(left=True)
+    self.Wait(0.1)
+    self.assertEqual(set([(0, 0)]), self.Drive(0.3))
+    self.assertEqual(1, self.teleop.reflex_stops)
+    self.assertTrue(self.teleop.ignored)
+    # Clearing the cliff alone doesn't drive the robot again.
+    self.sim.SetCliffs()
+    self.assertEqual(set([(0, 0)]), self.Wait(0.1))
+    self.Drive(0.2)
+    self.assertEqual((VELOCITY, VELOCITY),
+                     (self.sim.left_velocity, self.sim.right_velocity))
+
+  def testBackOffIsNotUndone(self):
+    self.Drive(0.2)
+    self.sim.SetBumps(True, False)
+    self.Wait(0.1)
+    velocities = self.Drive(0.2)
+    self.sim.SetBumps(False, False)
+    velocities |= self.Drive(0.3)  # Still backing off.
+    self.assertEqual(set([(-pyrobot.VELOCITY_SLOW, -pyrobot.VELOCITY_SLOW)]),
+                     velocities)
+    self.Wait(fido.MOVE_DELAY)
+    self.assertEqual((0, 0), (self.sim.left_velocity, self.sim.right_velocity))
+    self.Drive(0.2)
+    self.assertEqual((VELOCITY, VELOCITY),
+                     (self.sim.left_velocity, self.sim.right_velocity))
+
+  def testWheelDropStopsTeleop(self):
+    self.Drive(0.2)
+    self.sim.SetWheelDrops(False, False, caster=True)
+    self.Wait(0.1)
+    self.assertEqual(set([(0, 0)]), self.Drive(0.3))
+    self.assertEqual(1, self.teleop.reflex_stops)
+
+
+if __name__ == '__main__':
+  unittest.main()
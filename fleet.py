@@ -0,0 +1,206 @@
+#!/usr/bin/python
+
+# The MIT License
+#
+# Copyright (c) 2007 Damon Kohler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Control a fleet of robots from a single process.
+
+All robots share one EventLoop, so the fleet costs one thread no matter how
+many robots it has. Group commands are sent to every robot in a single pass.
+
+"""
+__author__ = "damonkohler@gmail.com (Damon Kohler)"
+
+import logging
+import time
+
+import async_pyrobot
+import pyrobot
+
+DEFAULT_POLL_PERIOD = 0.1  # Seconds between sensor polls.
+LATENCY_SMOOTHING = 0.1  # Weight of the newest sample in the mean latency.
+POLLED_SENSORS = ('bump-left', 'bump-right', 'charging-state', 'voltage',
+                  'oi-mode')
+
+
+class LinkStats(object):
+
+  """Round trip latency of sensor queries to one robot.
+
+  Successes and failures are counted by the robot's sci.health.
+
+  """
+  __slots__ = ('last', 'mean', 'max')
+
+  def __init__(self):
+    self.last = None
+    self.mean = None
+    self.max = None
+
+  def Add(self, latency):
+    self.last = latency
+    if self.mean is None:
+      self.mean = latency
+    else:
+      self.mean += LATENCY_SMOOTHING * (latency - self.mean)
+    self.max = max(self.max, latency)
+
+  def AsDict(self):
+    return dict([(name, getattr(self, name)) for name in self.__slots__])
+
+
+class Fleet(object):
+
+  """Owns the connections to a number of robots and drives them together.
+
+  Group methods return a Future for a dict mapping each robot's name to its
+  result, or to the PyRobotError it raised.
+
+  """
+  def __init__(self, loop=None, poll_period=DEFAULT_POLL_PERIOD,
+               polled_sensors=POLLED_SENSORS):
+    self.loop = loop or async_pyrobot.EventLoop()
+    self.poll_period = poll_period
+    self.polled_sensors = tuple(polled_sensors)
+    self.robots = {}  # Maps names to AsyncRoombas or AsyncCreates.
+    self.links = {}  # Maps names to LinkStats.
+    self._polling = False
+
+  def Add(self, name, tty, model='create'):
+    """Connect to the robot on 'tty' and add it to the fleet as 'name'."""
+    if name in self.robots:
+      raise pyrobot.PyRobotError('Robot %s is already in the fleet.' % name)
+    robot_classes = {'roomba': async_pyrobot.AsyncRoomba,
+                     'create': async_pyrobot.AsyncCreate}
+    if model not in robot_classes:
+      raise pyrobot.PyRobotError('Unknown robot model %s.' % model)
+    robot = robot_classes[model](self.loop, tty)
+    self.robots[name] = robot
+    self.links[name] = LinkStats()
+    logging.info('Added robot %s on %s.' % (name, tty))
+    return robot
+
+  def Remove(self, name):
+    """Disconnect from robot 'name'."""
+    robot = self.robots.pop(name)
+    del self.links[name]
+    robot.Close()
+
+  def __getitem__(self, name):
+    return self.robots[name]
+
+  def __len__(self):
+    return len(self.robots)
+
+  @async_pyrobot.Coroutine
+  def _Gather(self, futures):
+    """Wait for a dict of 'futures' and return a dict of their results."""
+    results = {}
+    for name, future in futures.iteritems():
+      try:
+        results[name] = yield future
+      except (AttributeError, pyrobot.PyRobotError), e:
+        logging.warn('Robot %s failed: %s' % (name, e))
+        results[name] = e
+    raise async_pyrobot.Return(results)
+
+  def ForEach(self, method, *args):
+    """Call 'method' with 'args' on every robot at once.
+
+    A robot that fails, or has no such method, gets its error as its result
+    and doesn't keep the call from reaching the others.
+
+    """
+    futures = {}
+    for name, robot in self.robots.iteritems():
+      try:
+        future = getattr(robot, method)(*args)
+      except (AttributeError, pyrobot.PyRobotError):
+        future = async_pyrobot.Future()
+        future.SetException(None)
+      if not isinstance(future, async_pyrobot.Future):
+        result, future = future, async_pyrobot.Future()
+        future.SetResult(result)
+      futures[name] = future
+    return self._Gather(futures)
+
+  def StopAll(self):
+    """Stop every robot. The commands are sent before this returns."""
+    return self.ForEach('Stop')
+
+  def ControlAll(self):
+    return self.ForEach('Control')
+
+  def DockAll(self):
+    return self.ForEach('Dock')
+
+  def SoftResetAll(self):
+    return self.ForEach('SoftReset')
+
+  @async_pyrobot.Coroutine
+  def _Query(self, name, names):
+    sensors = self.robots[name].sensors
+    start = time.time()
+    if hasattr(sensors, 'Query'):
+      values = yield sensors.Query(names)
+    else:
+      # Roombas can only send all of their sensors at once.
+      yield sensors.GetAll()
+      values = dict([(sensor, sensors[sensor]) for sensor in names
+                     if sensor in sensors])
+    self.links[name].Add(time.time() - start)
+    raise async_pyrobot.Return(values)
+
+  def QueryAll(self, names=None):
+    """Query sensors 'names' (polled_sensors by default) on every robot."""
+    names = names or self.polled_sensors
+    futures = dict([(name, self._Query(name, names))
+                    for name in self.robots])
+    return self._Gather(futures)
+
+  @async_pyrobot.Coroutine
+  def _Poll(self):
+    while self._polling:
+      start = time.time()
+      yield self.QueryAll()
+      yield self.loop.Sleep(max(0, self.poll_period - (time.time() - start)))
+
+  def StartPolling(self):
+    """Keep each robot's sensors up to date by polling them periodically."""
+    if not self._polling:
+      self._polling = True
+      self._Poll()
+
+  def StopPolling(self):
+    self._polling = False
+
+  def Status(self):
+    """Return a dict of each robot's last sensor readings, link health and
+    query latency.
+
+    """
+    status = {}
+    for name, robot in self.robots.iteritems():
+      status[name] = {'sensors': robot.sensors.data,
+                      'link': robot.sci.health.AsDict(),
+                      'latency': self.links[name].AsDict()}
+    return status
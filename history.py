@@ -0,0 +1,157 @@
+#!/usr/bin/python
+
+# The MIT License
+#
+# Copyright (c) 2007 Damon Kohler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Fixed-memory history of numeric sensor readings.
+
+Readings are kept in preallocated NumPy arrays that are used as a ring
+buffer, so appending is O(1) and memory use does not grow over time. Queries
+over the last few seconds or minutes are vectorized.
+
+"""
+__author__ = "damonkohler@gmail.com (Damon Kohler)"
+
+import threading
+import time
+
+import numpy
+
+DEFAULT_DURATION = 600  # Seconds of history to keep.
+DEFAULT_PERIOD = 0.05  # Expected seconds between readings.
+STATISTICS = {
+    'min': numpy.nanmin,
+    'max': numpy.nanmax,
+    'mean': numpy.nanmean,
+    }
+
+
+class SensorHistory(object):
+
+  """Keeps the last few minutes of readings for a fixed set of sensors.
+
+  All sensors share a single timestamp column. Sensors that are missing from
+  a reading are stored as NaN and ignored by the statistics.
+
+  """
+
+  def __init__(self, names, duration=DEFAULT_DURATION, period=DEFAULT_PERIOD):
+    self.names = tuple(names)
+    self.capacity = int(duration / period)
+    self._columns = dict([(name, i) for i, name in enumerate(self.names)])
+    self._timestamps = numpy.zeros(self.capacity, dtype=numpy.float64)
+    self._values = numpy.empty((self.capacity, len(self.names)),
+                               dtype=numpy.float32)
+    self._values.fill(numpy.nan)
+    self._row = numpy.empty(len(self.names), dtype=numpy.float32)
+    self._head = 0  # Next row to write.
+    self._count = 0  # Rows written, up to capacity.
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return self._count
+
+  def Append(self, timestamp, sensors):
+    """Record the readings in 'sensors' (anything with a get method)."""
+    row = self._row
+    for i, name in enumerate(self.names):
+      value = sensors.get(name)
+      if value is None:
+        row[i] = numpy.nan
+      else:
+        row[i] = value
+    with self._lock:
+      self._timestamps[self._head] = timestamp
+      self._values[self._head] = row
+      self._head = (self._head + 1) % self.capacity
+      if self._count < self.capacity:
+        self._count += 1
+
+  def Window(self, seconds, names=None, now=None):
+    """Return (timestamps, values) for the last 'seconds' of history.
+
+    The values array has one row per timestamp and one column per sensor in
+    'names' (all sensors by default), oldest first. The arrays are copies and
+    can be used without holding any locks.
+
+    """
+    if now is None:
+      now = time.time()
+    if names is None:
+      columns = slice(None)
+    else:
+      columns = [self._columns[name] for name in names]
+    start = now - seconds
+    with self._lock:
+      if self._count < self.capacity:
+        segments = [slice(0, self._count)]
+      else:
+        segments = [slice(self._head, self.capacity), slice(0, self._head)]
+      timestamps = []
+      values = []
+      for segment in segments:
+        segment_timestamps = self._timestamps[segment]
+        first = numpy.searchsorted(segment_timestamps, start)
+        timestamps.append(segment_timestamps[first:])
+        values.append(self._values[segment][first:, columns])
+      return numpy.concatenate(timestamps), numpy.concatenate(values)
+
+  def Query(self, seconds, names=None, points=None, now=None,
+            statistics=('min', 'max', 'mean')):
+    """Summarize the last 'seconds' of history.
+
+    Returns a dict mapping each sensor name to a dict of the requested
+    'statistics'. If 'points' is given, the window is also downsampled into
+    that many equal time buckets, each holding the mean of its readings, and
+    returned under 'samples' along with the bucket start times.
+
+    """
+    if now is None:
+      now = time.time()
+    if names is None:
+      names = self.names
+    timestamps, values = self.Window(seconds, names, now)
+    result = {'timestamps': [], 'sensors': {}}
+    if points:
+      bucket_size = float(seconds) / points
+      buckets = ((timestamps - (now - seconds)) / bucket_size).astype(int)
+      buckets = buckets.clip(0, points - 1)
+      result['timestamps'] = list(now - seconds +
+                                  numpy.arange(points) * bucket_size)
+    for i, name in enumerate(names):
+      column = values[:, i]
+      valid = ~numpy.isnan(column)
+      summary = {}
+      for statistic in statistics:
+        if valid.any():
+          summary[statistic] = float(STATISTICS[statistic](column))
+        else:
+          summary[statistic] = None
+      if points:
+        counts = numpy.bincount(buckets[valid], minlength=points)
+        sums = numpy.bincount(buckets[valid], column[valid], minlength=points)
+        samples = sums / numpy.maximum(counts, 1)
+        summary['samples'] = [None] * points
+        for bucket in numpy.flatnonzero(counts):
+          summary['samples'][bucket] = float(samples[bucket])
+      result['sensors'][name] = summary
+    return result
@@ -0,0 +1,173 @@
+#!/usr/bin/python
+
+# The MIT License
+#
+# Copyright (c) 2007 Damon Kohler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Dead reckoning from the robot's distance and angle sensors.
+
+The robot reports how far it has driven and turned since the last time the
+distance and angle were read. Odometry integrates those increments into an
+(x, y, theta) pose along with an estimate of its covariance, which grows as
+wheel slip and encoder errors accumulate.
+
+"""
+__author__ = "damonkohler@gmail.com (Damon Kohler)"
+
+import math
+import threading
+
+import numpy
+
+# Multiply raw angle readings by these to get radians. The Create reports
+# degrees while the Roomba reports half the difference in wheel travel (mm).
+CREATE_ANGLE_SCALE = math.pi / 180
+ROOMBA_ANGLE_SCALE = 2.0 / 258
+
+# Error model. Variances grow in proportion to the distance driven and the
+# angle turned in each increment.
+DISTANCE_VARIANCE = 0.05  # mm^2 per mm driven.
+ANGLE_VARIANCE = 0.01  # rad^2 per rad turned.
+DRIFT_VARIANCE = 1e-5  # rad^2 per mm driven.
+
+
+class Odometry(object):
+
+  """Integrates distance and angle increments into a pose estimate.
+
+  Positions are in millimeters and headings are in radians, counter-clockwise
+  from the x axis. Update is cheap enough to be called for every sensor
+  packet in a 15ms stream. Batch integrates many recorded increments at once.
+
+  """
+
+  def __init__(self, angle_scale=CREATE_ANGLE_SCALE, x=0.0, y=0.0, theta=0.0):
+    self.angle_scale = angle_scale
+    self.lock = threading.Lock()
+    self.Reset(x, y, theta)
+
+  def Reset(self, x=0.0, y=0.0, theta=0.0):
+    """Set the pose and clear the covariance."""
+    with self.lock:
+      self.x = x
+      self.y = y
+      self.theta = theta
+      # The unique elements of the symmetric covariance matrix of x, y and
+      # theta, in the order xx, xy, xt, yy, yt, tt.
+      self._covariance = (0.0,) * 6
+      self.samples = 0
+
+  @property
+  def pose(self):
+    """The current (x, y, theta) pose."""
+    with self.lock:
+      return self.x, self.y, self.theta
+
+  @property
+  def covariance(self):
+    """The 3x3 covariance matrix of the current pose."""
+    with self.lock:
+      xx, xy, xt, yy, yt, tt = self._covariance
+    return numpy.array([[xx, xy, xt], [xy, yy, yt], [xt, yt, tt]])
+
+  def UpdateFromSensors(self, values):
+    """Integrate the 'distance' and 'angle' in decoded sensor 'values'."""
+    if 'distance' in values or 'angle' in values:
+      self.Update(values.get('distance', 0),
+                  values.get('angle', 0) * self.angle_scale)
+
+  def Update(self, distance, angle):
+    """Integrate a 'distance' (mm) and 'angle' (radians) increment."""
+    with self.lock:
+      heading = self.theta + angle / 2.0
+      cos = math.cos(heading)
+      sin = math.sin(heading)
+      dx = distance * cos
+      dy = distance * sin
+      carried = _Shear(self._covariance, -dy, dx)
+      added = _IncrementCovariance(distance, angle, cos, sin)
+      self._covariance = tuple([a + b for a, b in zip(carried, added)])
+      self.x += dx
+      self.y += dy
+      self.theta += angle
+      self.samples += 1
+
+  def Batch(self, distances, angles):
+    """Integrate arrays of 'distances' (mm) and raw 'angles' at once.
+
+    The result is the same as calling UpdateFromSensors for each pair of
+    readings in turn. Returns an array with the (x, y, theta) pose after each
+    increment.
+
+    """
+    distances = numpy.asarray(distances, dtype=numpy.float64)
+    angles = numpy.asarray(angles, dtype=numpy.float64) * self.angle_scale
+    if not len(distances):
+      return numpy.zeros((0, 3))
+    with self.lock:
+      thetas = self.theta + numpy.cumsum(angles)
+      headings = thetas - angles / 2.0
+      cos = numpy.cos(headings)
+      sin = numpy.sin(headings)
+      xs = self.x + numpy.cumsum(distances * cos)
+      ys = self.y + numpy.cumsum(distances * sin)
+      # The Jacobians only shear heading error into position error, so their
+      # product over any run of increments is a single shear by the total
+      # displacement over that run.
+      carried = _Shear(self._covariance, self.y - ys[-1], xs[-1] - self.x)
+      added = _Shear(_IncrementCovariance(distances, angles, cos, sin),
+                     ys - ys[-1], xs[-1] - xs)
+      self._covariance = tuple([a + b.sum() for a, b in zip(carried, added)])
+      self.x = xs[-1]
+      self.y = ys[-1]
+      self.theta = thetas[-1]
+      self.samples += len(distances)
+      return numpy.column_stack((xs, ys, thetas))
+
+
+def _IncrementCovariance(distance, angle, cos, sin):
+  """The covariance added by a single increment (or arrays of them)."""
+  distance_variance = DISTANCE_VARIANCE * abs(distance)
+  angle_variance = ANGLE_VARIANCE * abs(angle) + DRIFT_VARIANCE * abs(distance)
+  half = distance / 2.0
+  return (cos * cos * distance_variance + (half * sin) ** 2 * angle_variance,
+          cos * sin * (distance_variance - half * half * angle_variance),
+          -half * sin * angle_variance,
+          sin * sin * distance_variance + (half * cos) ** 2 * angle_variance,
+          half * cos * angle_variance,
+          angle_variance)
+
+
+def _Shear(covariance, a, b):
+  """Carry 'covariance' through a move whose heading Jacobian is a shear.
+
+  Turning by a small angle at the start of a move of (dx, dy) moves its end
+  by (-dy, dx) times that angle, so the Jacobian is the identity plus 'a' =
+  -dy and 'b' = dx in the theta column. Works elementwise on arrays too.
+
+  """
+  xx, xy, xt, yy, yt, tt = covariance
+  return (xx + 2 * a * xt + a * a * tt,
+          xy + a * yt + b * xt + a * b * tt,
+          xt + a * tt,
+          yy + 2 * b * yt + b * b * tt,
+          yt + b * tt,
+          tt)
@@ -38,11 +38,27 @@ import traceback
 import os
 import logging
 
+OLPC_BATTERY_DIR = '/sys/class/power_supply/olpc-battery'
+# (name, sysfs file, conversion, seconds between reads) for each OLPC battery
+# sensor. Battery values change slowly, so they are read much less often than
+# the robot's sensors.
+OLPC_BATTERY_FIELDS = (
+    ('olpc_capacity', 'capacity', int, 5),
+    ('olpc_capacity_level', 'capacity_level', None, 5),
+    ('olpc_current_avg', 'current_avg', int, 1),
+    ('olpc_voltage_avg', 'voltage_avg', int, 1),
+    ('olpc_health', 'health', None, 5),
+    ('olpc_temp', 'temp', int, 5),
+    ('olpc_temp_ambient', 'temp_ambient', int, 5),
+    ('olpc_status', 'status', None, 1),
+    )
+SYSFS_READ_SIZE = 4096  # sysfs attributes are at most a page.
+
 
 class OlpcController(object):
 
-  def __init__(self):
-    self.sensors = OlpcSensors()
+  def __init__(self, battery_dir=OLPC_BATTERY_DIR):
+    self.sensors = OlpcSensors(battery_dir)
 
   def SetDconSleep(self, sleep):
     if sleep:
@@ -82,48 +98,121 @@ class OlpcController(object):
     os.system(cmd)
 
 
+class SysfsFile(object):
+
+  """A sysfs attribute that is kept open and read again from the start.
+
+  The file is reopened if reading it fails (e.g. the battery was removed).
+
+  """
+  def __init__(self, path):
+    self.path = path
+    self._fd = None
+
+  def Read(self):
+    """Return the contents of the file."""
+    try:
+      if self._fd is None:
+        self._fd = os.open(self.path, os.O_RDONLY)
+      os.lseek(self._fd, 0, os.SEEK_SET)
+      return os.read(self._fd, SYSFS_READ_SIZE)
+    except OSError:
+      self.Close()
+      raise
+
+  def Close(self):
+    if self._fd is not None:
+      try:
+        os.close(self._fd)
+      except OSError:
+        pass
+      self._fd = None
+
+
 class OlpcSensors(object):
 
-  """Access sysfs information about the OLPC's power."""
+  """Access sysfs information about the OLPC's power.
+
+  Each field in 'fields' (see OLPC_BATTERY_FIELDS) is read from its file in
+  'battery_dir' no more often than its own interval. The latest values are
+  in self.data, which is replaced rather than changed so that other threads
+  can read it without locking.
 
-  def __init__(self):
+  """
+  def __init__(self, battery_dir=OLPC_BATTERY_DIR,
+               fields=OLPC_BATTERY_FIELDS):
+    self.battery_dir = battery_dir
     self.data = {}
+    self._fields = []  # [name, SysfsFile, conversion, interval, due] lists.
+    self._files = {}  # Maps sysfs file names to fields.
+    for name, filename, convert, interval in fields:
+      field = [name, SysfsFile(os.path.join(battery_dir, filename)), convert,
+               interval, 0]
+      self._fields.append(field)
+      self._files[filename] = field
+
+  def _Read(self, field):
+    unused_name, sysfs_file, convert, unused_interval, unused_due = field
+    value = sysfs_file.Read()
+    if convert is not None:
+      value = convert(value)
+    return value
+
+  def _ReadFile(self, filename):
+    return self._Read(self._files[filename])
 
   def GetCapacity(self):
-    return int(open('/sys/class/power_supply/olpc-battery/capacity').read())
+    return self._ReadFile('capacity')
 
   def GetCapacityLevel(self):
-    return open('/sys/class/power_supply/olpc-battery/capacity_level').read()
+    return self._ReadFile('capacity_level')
 
   def GetCurrentAvg(self):
-    return int(open('/sys/class/power_supply/olpc-battery/current_avg').read())
+    return self._ReadFile('current_avg')
 
   def GetVoltageAvg(self):
-    return int(open('/sys/class/power_supply/olpc-battery/voltage_avg').read())
+    return self._ReadFile('voltage_avg')
 
   def GetHealth(self):
-    return open('/sys/class/power_supply/olpc-battery/health').read()
-
+    return self._ReadFile('health')
 
   def GetTemp(self):
-    return int(open('/sys/class/power_supply/olpc-battery/temp').read())
+    return self._ReadFile('temp')
 
   def GetTempAmbient(self):
-    return int(open('/sys/class/power_supply/olpc-battery/temp_ambient').read())
+    return self._ReadFile('temp_ambient')
 
   def GetStatus(self):
-    return open('/sys/class/power_supply/olpc-battery/status').read()
+    return self._ReadFile('status')
+
+  def Refresh(self, now=None):
+    """Read the fields that are due and return when the next one is due."""
+    if now is None:
+      now = time.time()
+    data = None
+    for field in self._fields:
+      if field[4] > now:
+        continue
+      field[4] = now + field[3]
+      try:
+        value = self._Read(field)
+      except (OSError, ValueError), e:
+        logging.debug('Failed to read %s: %s' % (field[1].path, e))
+        continue
+      if data is None:
+        data = dict(self.data)
+      data[field[0]] = value
+    if data is not None:
+      self.data = data
+    return min([field[4] for field in self._fields])
 
   def GetAll(self):
-    """Update data dict with all sensor data."""
-    self.data['olpc_capacity'] = self.GetCapacity()
-    self.data['olpc_capacity_level'] = self.GetCapacityLevel()
-    self.data['olpc_current_avg'] = self.GetCurrentAvg()
-    self.data['olpc_voltage_avg'] = self.GetVoltageAvg()
-    self.data['olpc_health'] = self.GetHealth()
-    self.data['olpc_temp'] = self.GetTemp()
-    self.data['olpc_temp_ambient'] = self.GetTempAmbient()
-    self.data['olpc_status'] = self.GetStatus()
+    """Update data dict with all sensor data that is due to be read."""
+    self.Refresh()
+
+  def Close(self):
+    for field in self._fields:
+      field[1].Close()
 
 
 class AudioStream(object):
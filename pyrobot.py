@@ -40,13 +40,17 @@ SerialCommandInterface class is also used for OI.
 """
 __author__ = "damonkohler@gmail.com (Damon Kohler)"
 
+import bisect
+import collections
 import logging
 import math
 import serial
 import struct
+import sys
 import time
 import threading
 import traceback
+import types
 
 ROOMBA_OPCODES = dict(
     start = 128,
@@ -147,6 +151,9 @@ OI_MODES = (
 
 SENSOR_GROUP_PACKET_LENGTHS = (26, 10, 6, 10, 14, 12, 52)
 
+STREAM_HEADER = 19  # First byte of every frame sent in stream mode.
+STREAM_PERIOD = 0.015  # The Create sends a stream frame every 15ms.
+
 # From: http://www.harmony-central.com/MIDI/Doc/table2.html
 MIDI_TABLE = {'rest': 0, 'R': 0, 'pause': 0,
               'G1': 31, 'G#1': 32, 'A1': 33,
@@ -203,28 +210,494 @@ VELOCITY_FAST = int(VELOCITY_MAX * 0.66)
 
 WHEEL_SEPARATION = 298  # mm
 
+DEFAULT_BAUD_RATE = 57600
+NEGOTIATED_BAUD_RATES = (115200, 57600)  # Tried fastest first.
+BAUD_RATE_CHANGE_DELAY = 0.1  # Wait before sending at the new baud rate.
+VOLTAGE_RANGE = (5000, 25000)  # mV. Anything else is line noise.
+LINK_VERIFICATION_REQUESTS = 3
+
 SERIAL_TIMEOUT = 2  # Number of seconds to wait for reads. 2 is generous.
+RETRIES = 2  # Times a lost or garbled sensor request is retried.
+RETRY_BACKOFF = 0.015  # Seconds before the first retry. Doubles after that.
+
+# The state of the serial link, see LinkHealth.
+LINK_OK = 'ok'
+LINK_DEGRADED = 'degraded'  # Recent errors, but the link is still working.
+LINK_DOWN = 'down'  # Nothing is getting through.
+LINK_DEGRADED_PERIOD = 10  # Seconds an error keeps the link degraded.
+LINK_DOWN_FAILURES = 5  # Failures in a row before the link is down.
 START_DELAY = 5  # Time it takes the Roomba/Create to boot.
+MAX_COMMAND_QUEUE_SIZE = 32  # Commands a CommandWriter will hold.
+
+# When a SensorSubscription triggers, based on the value of its predicate.
+TRIGGER_RISING = 'rising'  # When it becomes true.
+TRIGGER_LEVEL = 'level'  # For every decode while it is true.
+TRIGGER_CHANGE = 'change'  # When it changes.
+TRIGGERS = (TRIGGER_RISING, TRIGGER_LEVEL, TRIGGER_CHANGE)
+
+# Conditions that a Reflex can react to. Maps names to the sensors they
+# depend on and a predicate on a SensorSnapshot.
+REFLEX_CONDITIONS = {
+    'bump': (('bump-left', 'bump-right'),
+             lambda s: s['bump-left'] or s['bump-right']),
+    'wheel-drop': (('wheel-drop-caster', 'wheel-drop-left',
+                    'wheel-drop-right'),
+                   lambda s: (s['wheel-drop-caster'] or s['wheel-drop-left'] or
+                              s['wheel-drop-right'])),
+    'cliff': (('cliff-left', 'cliff-front-left', 'cliff-front-right',
+               'cliff-right'),
+              lambda s: (s['cliff-left'] or s['cliff-front-left'] or
+                         s['cliff-front-right'] or s['cliff-right'])),
+    'virtual-wall': (('virtual-wall',), lambda s: s['virtual-wall']),
+    }
+
+# Upper bounds (in seconds) of the buckets of a LatencyHistogram. Anything
+# slower goes in an extra overflow bucket.
+LATENCY_BUCKETS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.015,
+                   0.02, 0.05, 0.1)
+# Serial reads can take up to SERIAL_TIMEOUT.
+SERIAL_LATENCY_BUCKETS = LATENCY_BUCKETS + (0.2, 0.5, 1, 2)
+
+# Commands that only set the wheel velocities. A newer one completely
+# supersedes an older one that has not been sent yet.
+COALESCED_OPCODES = frozenset([ROOMBA_OPCODES['drive'],
+                               CREATE_OPCODES['direct_drive']])
+
+# Number of argument bytes that follow each opcode. Variable length commands
+# are given as (prefix length, function of the prefix returning the number of
+# bytes that follow the prefix).
+ARGUMENT_LENGTHS = dict(
+    start = 0,
+    baud = 1,
+    control = 0,
+    safe = 0,
+    full = 0,
+    power = 0,
+    spot = 0,
+    clean = 0,
+    max = 0,
+    drive = 4,
+    motors = 1,
+    leds = 3,
+    song = (2, lambda prefix: 2 * prefix[1]),
+    play = 1,
+    sensors = 1,
+    force_seeking_dock = 0,
+    soft_reset = 0,
+    low_side_drivers = 1,
+    pwm_low_side_drivers = 3,
+    direct_drive = 4,
+    digital_outputs = 1,
+    stream = (1, lambda prefix: prefix[0]),
+    query_list = (1, lambda prefix: prefix[0]),
+    pause_resume_stream = 1,
+    send_ir = 1,
+    script = (1, lambda prefix: prefix[0]),
+    play_script = 0,
+    show_script = 0,
+    wait_time = 1,
+    wait_distance = 2,
+    wait_angle = 2,
+    wait_event = 1,
+    )
 
 
 assert struct.calcsize('H') == 2, 'Expecting 2-byte shorts.'
 
+# Precompiled encoders for commands with multi-byte arguments. The opcode is
+# packed along with its arguments so that each command is a single pack.
+DRIVE_COMMAND = struct.Struct('>BHH')  # Velocity, radius.
+DIRECT_DRIVE_COMMAND = struct.Struct('>BHH')  # Right velocity, left velocity.
+LEDS_COMMAND = struct.Struct('>BBBB')  # LED bits, power color and intensity.
+SONG_COMMANDS = {}  # Maps the number of notes in a song to its encoder.
+STOP_COMMAND = DRIVE_COMMAND.pack(ROOMBA_OPCODES['drive'], 0, 0)
+
 
 class PyRobotError(Exception):
   pass
 
 
+class Return(Exception):
+
+  """Raised by a step generator to return 'value' (generators can't return
+  one). See RunSteps.
+
+  """
+  def __init__(self, value=None):
+    Exception.__init__(self)
+    self.value = value
+
+
+class Sleep(object):
+
+  """Yielded by a step generator to wait for 'seconds'. See RunSteps."""
+
+  __slots__ = ('seconds',)
+
+  def __init__(self, seconds):
+    self.seconds = seconds
+
+
+def RunSteps(steps):
+  """Run the step generator 'steps' with blocking calls and return its result.
+
+  Sequences that wait on the robot (mode changes, baud rate negotiation,
+  stream framing, etc.) are written once as step generators so that
+  async_pyrobot can run the very same steps from an EventLoop. A step
+  generator yields one of:
+
+    Sleep(seconds) to wait.
+    Another step generator to run it and get back its result.
+    Anything else, which is sent straight back. This is how steps call
+      methods that block here but return a Future in async_pyrobot (e.g.
+      sensors.RequestPacket). The async runner waits for the Future instead.
+
+  It returns a result by raising Return. Exceptions raised by a nested step
+  generator are raised in the one that yielded it.
+
+  """
+  value = None
+  exc_info = None
+  while True:
+    try:
+      if exc_info is not None:
+        step = steps.throw(*exc_info)
+      else:
+        step = steps.send(value)
+    except StopIteration:
+      return None
+    except Return, e:
+      return e.value
+    value = exc_info = None
+    try:
+      if isinstance(step, Sleep):
+        time.sleep(step.seconds)
+      elif isinstance(step, types.GeneratorType):
+        value = RunSteps(step)
+      else:
+        value = step
+    except Exception:
+      exc_info = sys.exc_info()
+
+
+def ParseCommands(data, opcodes):
+  """Yield (name, arguments, remaining data) for each command in 'data'.
+
+  'opcodes' maps opcodes to names. Unknown opcodes are skipped. Stops once
+  the remaining data does not hold a complete command.
+
+  """
+  while data:
+    name = opcodes.get(ord(data[0]))
+    if name is None:
+      logging.debug('Ignoring unknown opcode %d.' % ord(data[0]))
+      data = data[1:]
+      continue
+    length = ARGUMENT_LENGTHS[name]
+    if isinstance(length, tuple):
+      prefix_length, GetLength = length
+      if len(data) < 1 + prefix_length:
+        return
+      length = prefix_length + GetLength(map(ord, data[1:1 + prefix_length]))
+    if len(data) < 1 + length:
+      return
+    arguments = map(ord, data[1:1 + length])
+    data = data[1 + length:]
+    yield name, arguments, data
+
+
+class SensorBitfield(object):
+
+  """A sensor byte whose bits are decoded as individual bools.
+
+  The decoded form of all 256 possible values is computed once up front so
+  that decoding a byte is a single tuple index.
+
+  """
+  def __init__(self, bits):
+    self.bits = bits  # Sequence of (name, mask) pairs.
+    self.table = tuple([dict([(name, bool(byte & mask)) for name, mask in bits])
+                        for byte in range(256)])
+
+  def __getitem__(self, byte):
+    return self.table[byte]
+
+
+BUMPS_WHEELDROPS = SensorBitfield((
+    ('wheel-drop-caster', 0x10),
+    ('wheel-drop-left', 0x08),
+    ('wheel-drop-right', 0x04),
+    ('bump-left', 0x02),
+    ('bump-right', 0x01)))
+
+MOTOR_OVERCURRENTS = SensorBitfield((
+    ('drive-left', 0x10),
+    ('drive-right', 0x08),
+    ('main-brush', 0x04),
+    ('vacuum', 0x02),
+    ('side-brush', 0x01)))
+
+BUTTONS = SensorBitfield((
+    ('power', 0x08),
+    ('spot', 0x04),
+    ('clean', 0x02),
+    ('max', 0x01)))
+
+
+class SensorGroupDecoder(object):
+
+  """Decodes a sensor group packet with a single precompiled struct.
+
+  'fields' is a sequence of (name, format, decode) tuples in the order the
+  robot sends them. 'decode' is None for raw values, a SensorBitfield for bytes
+  that expand into several bools, a callable, or a lookup table (e.g.
+  CHARGING_STATES) used to make the raw value human readable.
+
+  """
+  def __init__(self, fields):
+    self.fields = tuple(fields)
+    self.struct = struct.Struct('>' + ''.join([f[1] for f in self.fields]))
+    self.length = self.struct.size
+    self._names = tuple([f[0] for f in self.fields])
+    self._bitfields = []
+    self._conversions = []
+    for name, unused_format, decode in self.fields:
+      if decode is None:
+        continue
+      if isinstance(decode, SensorBitfield):
+        self._bitfields.append((name, decode.table))
+      elif callable(decode):
+        self._conversions.append((name, decode))
+      else:
+        self._conversions.append((name, decode.__getitem__))
+
+  def Decode(self, data, offset=0):
+    """Decode a packet from the string 'data' and return a dict of values."""
+    values = dict(zip(self._names, self.struct.unpack_from(data, offset)))
+    try:
+      for name, convert in self._conversions:
+        values[name] = convert(values[name])
+    except (KeyError, IndexError):
+      logging.debug(traceback.format_exc())
+      raise PyRobotError('Invalid sensor data.')
+    for name, table in self._bitfields:
+      values.update(table[values.pop(name)])
+    return values
+
+
+# Packets 7 through 26 in the order they are sent by the robot.
+SENSOR_GROUP_PACKET_0_FIELDS = (
+    ('bumps-wheeldrops', 'B', BUMPS_WHEELDROPS),
+    ('wall', 'B', bool),
+    ('cliff-left', 'B', bool),
+    ('cliff-front-left', 'B', bool),
+    ('cliff-front-right', 'B', bool),
+    ('cliff-right', 'B', bool),
+    ('virtual-wall', 'B', bool),
+    ('motor-overcurrents', 'B', MOTOR_OVERCURRENTS),
+    ('dirt-detector-left', 'B', None),
+    ('dirt-detector-right', 'B', None),
+    ('remote-opcode', 'B', REMOTE_OPCODES),
+    ('buttons', 'B', BUTTONS),
+    ('distance', 'h', None),  # mm
+    ('angle', 'h', None),  # Create: degrees, Roomba: see RoombaSensors.Angle.
+    ('charging-state', 'B', CHARGING_STATES),
+    ('voltage', 'H', None),  # mV
+    ('current', 'h', None),  # mA
+    ('temperature', 'b', None),  # C
+    ('charge', 'H', None),  # mAh
+    ('capacity', 'H', None),  # mAh
+    )
+
+# Packets 27 through 42 in the order they are sent by the Create. Group 6 is
+# group 0 followed by these.
+SENSOR_GROUP_PACKET_6_FIELDS = SENSOR_GROUP_PACKET_0_FIELDS + (
+    ('wall-signal', 'H', None),
+    ('cliff-left-signal', 'H', None),
+    ('cliff-front-left-signal', 'H', None),
+    ('cliff-front-right-signal', 'H', None),
+    ('cliff-right-signal', 'H', None),
+    ('user-digital-inputs', 'B', None),
+    ('user-analog-input', 'H', None),
+    ('charging-sources-available', 'B', None),
+    ('oi-mode', 'B', OI_MODES),
+    ('song-number', 'B', None),
+    ('song-playing', 'B', bool),
+    ('number-of-stream-packets', 'B', None),
+    ('velocity', 'h', None),  # mm/s
+    ('radius', 'h', None),  # mm
+    ('right-velocity', 'h', None),  # mm/s
+    ('left-velocity', 'h', None),  # mm/s
+    )
+
+SENSOR_GROUP_DECODERS = {
+    0: SensorGroupDecoder(SENSOR_GROUP_PACKET_0_FIELDS),
+    1: SensorGroupDecoder(SENSOR_GROUP_PACKET_6_FIELDS[0:10]),
+    2: SensorGroupDecoder(SENSOR_GROUP_PACKET_6_FIELDS[10:14]),
+    3: SensorGroupDecoder(SENSOR_GROUP_PACKET_6_FIELDS[14:20]),
+    4: SensorGroupDecoder(SENSOR_GROUP_PACKET_6_FIELDS[20:28]),
+    5: SensorGroupDecoder(SENSOR_GROUP_PACKET_6_FIELDS[28:36]),
+    6: SensorGroupDecoder(SENSOR_GROUP_PACKET_6_FIELDS),
+    }
+
+for _packet_id, _decoder in SENSOR_GROUP_DECODERS.items():
+  assert _decoder.length == SENSOR_GROUP_PACKET_LENGTHS[_packet_id], (
+      'Sensor group %d decoder does not match packet length.' % _packet_id)
+del _packet_id, _decoder
+
+
+def _MakeSensorPacketDecoders(first_packet_id, fields):
+  """Make a decoder for each single-field packet in 'fields'.
+
+  Returns a dict mapping packet IDs to decoders and a dict mapping sensor
+  names to the packet ID that carries them.
+
+  """
+  decoders = {}
+  names = {}
+  for packet_id, field in zip(range(first_packet_id, 256), fields):
+    name, unused_format, decode = field
+    decoders[packet_id] = SensorGroupDecoder((field,))
+    if isinstance(decode, SensorBitfield):
+      for bit_name, unused_mask in decode.bits:
+        names[bit_name] = packet_id
+    else:
+      names[name] = packet_id
+  return decoders, names
+
+# Packets 7 through 42 each carry exactly one of the group 6 fields. These
+# can be requested individually with query_list or stream.
+SENSOR_PACKET_DECODERS, SENSOR_NAME_PACKETS = _MakeSensorPacketDecoders(
+    7, SENSOR_GROUP_PACKET_6_FIELDS)
+SENSOR_PACKET_DECODERS.update(SENSOR_GROUP_DECODERS)
+
+
+class PendingResponse(object):
+
+  """A response owed by the robot for a request sent with
+  SerialCommandInterface.Request.
+
+  'length' bytes are expected. If 'extend' is given, it is called with the
+  first 'length' bytes and returns how many more bytes follow them.
+
+  """
+  def __init__(self, sci, length, extend=None, timeout=SERIAL_TIMEOUT):
+    self.sci = sci
+    self.length = length
+    self.extend = extend
+    self.started = time.time()
+    self.deadline = self.started + timeout
+    self.data = ''
+    self.error = None
+    self.done = False
+
+  def Wait(self):
+    """Wait for the response and return it.
+
+    Raises PyRobotError if it doesn't arrive by the deadline.
+
+    """
+    return self.sci.WaitForResponse(self)
+
+
+class LinkHealth(object):
+
+  """Tracks how well requests and stream frames are getting through.
+
+  Only changes to and from LINK_DOWN are logged as warnings so that a noisy
+  cable doesn't flood the log.
+
+  """
+  def __init__(self):
+    self.successes = 0
+    self.failures = 0
+    self.consecutive_failures = 0
+    self.last_failure = None  # Time of the last failure.
+    self.last_error = None
+
+  @property
+  def state(self):
+    if self.consecutive_failures >= LINK_DOWN_FAILURES:
+      return LINK_DOWN
+    if (self.last_failure is not None and
+        time.time() - self.last_failure < LINK_DEGRADED_PERIOD):
+      return LINK_DEGRADED
+    return LINK_OK
+
+  def Success(self):
+    """Count something that got through."""
+    self.successes += 1
+    if self.consecutive_failures:
+      if self.consecutive_failures >= LINK_DOWN_FAILURES:
+        logging.warn('Serial link recovered after %d failures.' %
+                     self.consecutive_failures)
+      self.consecutive_failures = 0
+
+  def Failure(self, error):
+    """Count something that didn't get through because of 'error'."""
+    self.failures += 1
+    self.consecutive_failures += 1
+    self.last_failure = time.time()
+    self.last_error = str(error)
+    if self.consecutive_failures == LINK_DOWN_FAILURES:
+      logging.warn('Serial link is down: %s' % error)
+    else:
+      logging.debug('Serial link error: %s' % error)
+
+  def AsDict(self):
+    return {'state': self.state, 'successes': self.successes,
+            'failures': self.failures,
+            'consecutive_failures': self.consecutive_failures,
+            'last_failure': self.last_failure, 'last_error': self.last_error}
+
+
 class SerialCommandInterface(object):
 
   """A higher-level wrapper around PySerial specifically designed for use with
   iRobot's SCI.
 
+  Transmitting and receiving are independent. Commands only take the
+  transmit lock for the duration of a write, so they never wait behind a
+  response. Requests (see Request) may be pipelined. The robot answers them
+  in order, so responses are matched to requests first in first out by
+  their expected lengths. Whichever waiting thread gets the receive lock
+  reads responses on behalf of the others.
+
   """
   def __init__(self, tty, baudrate):
-    self.ser = serial.Serial(tty, baudrate=baudrate, timeout=SERIAL_TIMEOUT)
-    self.ser.open()
+    if isinstance(tty, basestring):
+      self.ser = serial.Serial(tty, baudrate=baudrate, timeout=SERIAL_TIMEOUT)
+      if not self.ser.isOpen():
+        self.ser.open()
+    else:
+      # Already open serial port like object (e.g. simulator.LoopbackSerial).
+      self.ser = tty
+    self.baudrate = baudrate
     self.opcodes = {}
-    self.lock = threading.RLock()
+    self.tx_lock = threading.Lock()
+    self.rx_lock = threading.Lock()
+    # PendingResponses in the order they were requested. The condition also
+    # signals when they are done.
+    self._pending = collections.deque()
+    self._responses = threading.Condition(threading.Lock())
+    self.writer = None  # The running CommandWriter, if any.
+    self.metrics = None  # SerialMetrics, if enabled.
+    self.health = LinkHealth()
+    # Reflexes holding drive commands off (see SendNow). A set is only ever
+    # replaced, never changed, so it can be checked without a lock.
+    self.drive_latches = frozenset()
+    self.drive_latch_count = 0  # Times a reflex latched drive commands off.
+
+  def EnableMetrics(self, enabled=True):
+    """Start (or stop) collecting SerialMetrics in self.metrics.
+
+    Enabling metrics again starts over with fresh ones.
+
+    """
+    if enabled:
+      self.metrics = SerialMetrics()
+    else:
+      self.metrics = None
 
   def Wake(self):
     """Wake up robot."""
@@ -234,44 +707,797 @@ class SerialCommandInterface(object):
     time.sleep(1)  # Technically it should wake after 500ms.
 
   def AddOpcodes(self, opcodes):
-    """Add available opcodes to the SCI."""
+    """Add available opcodes to the SCI.
+
+    A method is bound to the SCI for each opcode (e.g. sci.start()). Each
+    opcode method sends the opcode optionally followed by a string of bytes.
+
+    """
     self.opcodes.update(opcodes)
+    for name, opcode in opcodes.items():
+      setattr(self, name, self._MakeOpcodeMethod(name, opcode))
+
+  def _MakeOpcodeMethod(self, name, opcode):
+    """Return a function that sends 'opcode' followed by its arguments."""
+    prefix = chr(opcode)
+    def SendOpcode(*bytes):
+      logging.debug('Sending opcode %s.', name)
+      if bytes:
+        self.Send(prefix + ''.join(map(chr, bytes)))
+      else:
+        self.Send(prefix)
+    SendOpcode.__name__ = name
+    return SendOpcode
 
   def Send(self, bytes):
-    """Send a string of bytes to the robot."""
-    with self.lock:
-      self.ser.write(struct.pack('B' * len(bytes), *bytes))
+    """Send bytes to the robot.
+
+    'bytes' is either a string (or bytearray) that is written as is, or a
+    sequence of integers.
+
+    """
+    if isinstance(bytes, bytearray):
+      bytes = str(bytes)  # Metrics, latches and the writer expect a string.
+    elif not isinstance(bytes, str):
+      bytes = struct.pack('%dB' % len(bytes), *bytes)
+    metrics = self.metrics
+    if metrics is not None:
+      metrics.CountCommand(bytes)
+    if self.writer is not None:
+      self.writer.Put(bytes)
+      return
+    if metrics is None:
+      with self.tx_lock:
+        if not self.Latched(bytes):
+          self.ser.write(bytes)
+      return
+    start = time.time()
+    with self.tx_lock:
+      locked = time.time()
+      if not self.Latched(bytes):
+        self.ser.write(bytes)
+    metrics.tx_lock_wait.Add(locked - start)
+    metrics.send.Add(time.time() - start)
+
+  def Request(self, bytes, length, extend=None, timeout=SERIAL_TIMEOUT):
+    """Send the request 'bytes' and return a PendingResponse for its answer.
+
+    See PendingResponse for 'length' and 'extend'. Several requests can be
+    outstanding at once. Stale input is flushed first if none are.
+
+    """
+    response = PendingResponse(self, length, extend, timeout)
+    with self._responses:
+      # Sending while holding the condition keeps the order of the pending
+      # responses the same as the order the robot sees the requests.
+      if not self._pending:
+        self.FlushInput()
+      self._pending.append(response)
+      self.Send(bytes)
+    return response
+
+  def WaitForResponse(self, response):
+    """Wait for the PendingResponse 'response' and return its data."""
+    while not response.done:
+      if self.rx_lock.acquire(False):
+        try:
+          self._ReadResponses(response)
+        finally:
+          self.rx_lock.release()
+        if self._pending:
+          with self._responses:
+            self._responses.notifyAll()  # Someone else needs to read now.
+        continue
+      with self._responses:
+        # The reader notifies after releasing the receive lock, so checking
+        # it here while holding the condition can't miss that notification.
+        if response.done or not self.rx_lock.locked():
+          continue
+        remaining = response.deadline - time.time()
+        if remaining <= 0:
+          if self.metrics is not None:
+            self.metrics.timeouts += 1
+          self._FailPending('Timed out waiting for response.')
+        else:
+          self._responses.wait(remaining)
+    if response.error is not None:
+      raise PyRobotError(response.error)
+    if self.metrics is not None:
+      self.metrics.round_trip.Add(time.time() - response.started)
+    return response.data
+
+  def _ReadResponses(self, response):
+    """Read responses in order until 'response' is done.
+
+    Must be called with the receive lock held.
+
+    """
+    while not response.done:
+      try:
+        head = self._pending[0]
+      except IndexError:
+        return
+      data = self.ser.read(head.length - len(head.data))
+      with self._responses:
+        if head.done:
+          return  # Timed out while we were reading.
+        metrics = self.metrics
+        if not data:
+          # A missing or partial response means the responses after it can't
+          # be trusted to line up either.
+          if metrics is not None:
+            metrics.timeouts += 1
+          self._FailPending('Error reading from SCI port. No data.')
+          return
+        head.data += data
+        if metrics is not None:
+          metrics.bytes_received += len(data)
+        if len(head.data) < head.length:
+          if metrics is not None:
+            metrics.short_reads += 1
+          continue
+        if head.extend is not None:
+          head.length += head.extend(head.data)
+          head.extend = None
+          if len(head.data) < head.length:
+            continue
+        self._pending.popleft()
+        head.done = True
+        self._responses.notifyAll()
+
+  def Retry(self, request, retries=RETRIES, backoff=RETRY_BACKOFF):
+    """Call 'request' until it doesn't raise PyRobotError and return its
+    result.
+
+    'request' is retried at most 'retries' times, waiting 'backoff' seconds
+    before the first retry and twice as long before each one after that. The
+    last error is raised if every try fails. Since a request flushes stale
+    input when nothing else is pending, a retry also gets the responses
+    lined up again after a stray byte. Each try is counted in self.health.
 
-  def Read(self, num_bytes):
-    """Read a string of 'num_bytes' bytes from the robot."""
+    """
+    return RunSteps(self._RetrySteps(request, retries, backoff))
+
+  def _RetrySteps(self, request, retries=RETRIES, backoff=RETRY_BACKOFF):
+    """Like Retry, but 'request' may also return a step generator."""
+    while True:
+      try:
+        result = yield request()
+      except PyRobotError, e:
+        self.health.Failure(e)
+        if retries <= 0:
+          raise
+        retries -= 1
+        yield Sleep(backoff)
+        backoff *= 2
+      else:
+        self.health.Success()
+        raise Return(result)
+
+  def _FailPending(self, error):
+    """Fail all pending responses. Must be called holding the condition."""
+    logging.debug('Failing %d pending responses: %s' %
+                  (len(self._pending), error))
+    while self._pending:
+      pending = self._pending.popleft()
+      pending.error = error
+      pending.done = True
+    self._responses.notifyAll()
+
+  def SendNow(self, bytes, latch=None):
+    """Write the string 'bytes' immediately, ahead of any queued commands.
+
+    If 'latch' is given (e.g. the Reflex sending an emergency stop), drive
+    commands are held off from now until ReleaseDrives(latch) so that
+    nothing undoes the stop. That includes drives that are already queued
+    and any drive that is being written by another thread. Since tx_lock
+    is only held while bytes are written, the write is never held up by a
+    request waiting for its response.
+
+    """
+    bytes = str(bytes)  # E.g. a bytearray.
+    if latch is not None and latch not in self.drive_latches:
+      self.drive_latches = self.drive_latches | frozenset([latch])
+      self.drive_latch_count += 1
+    if self.metrics is not None:
+      self.metrics.CountCommand(bytes)
+    if self.writer is not None:
+      self.writer.DiscardDrives()
+    with self.tx_lock:
+      self.ser.write(bytes)
+
+  def ReleaseDrives(self, latch):
+    """Let drive commands through again once no other latch holds them."""
+    self.drive_latches = self.drive_latches - frozenset([latch])
+
+  def Latched(self, bytes):
+    """Return True if the command 'bytes' is a drive held off by a latch.
+
+    Stops always get through. Must be checked while holding tx_lock, right
+    before writing.
+
+    """
+    if (self.drive_latches and ord(bytes[0]) in COALESCED_OPCODES and
+        bytes != STOP_COMMAND):
+      logging.debug('Dropping drive command held off by a reflex.')
+      return True
+    return False
+
+  def StartWriter(self, max_queue_size=MAX_COMMAND_QUEUE_SIZE):
+    """Send all commands from a background CommandWriter.
+
+    Send then returns as soon as the command is queued. See CommandWriter.
+
+    """
+    if self.writer is None:
+      self.writer = CommandWriter(self, max_queue_size)
+      self.writer.Start()
+
+  def StopWriter(self):
+    """Send any queued commands and go back to sending synchronously."""
+    if self.writer is not None:
+      writer, self.writer = self.writer, None
+      writer.Stop()
+
+  def Read(self, num_bytes, partial=False):
+    """Read a string of 'num_bytes' bytes from the robot.
+
+    If 'partial', a short read returns whatever did arrive instead of failing.
+    Only a read that times out without any data fails.
+
+    """
     logging.debug('Attempting to read %d bytes from SCI port.' % num_bytes)
-    with self.lock:
+    # Raw reads (e.g. by a SensorStream) bypass the pending responses and
+    # must not be mixed with Request.
+    metrics = self.metrics
+    if metrics is None:
       data = self.ser.read(num_bytes)
+    else:
+      start = time.time()
+      data = self.ser.read(num_bytes)
+      metrics.read.Add(time.time() - start)
+      metrics.bytes_received += len(data)
     logging.debug('Read %d bytes from SCI port.' % len(data))
     if not data:
+      if metrics is not None:
+        metrics.timeouts += 1
       raise PyRobotError('Error reading from SCI port. No data.')
     if len(data) != num_bytes:
-      raise PyRobotError('Error reading from SCI port. Wrong data length.')
+      if metrics is not None:
+        metrics.short_reads += 1
+      if not partial:
+        raise PyRobotError('Error reading from SCI port. Wrong data length.')
     return data
 
+  def Reopen(self, baudrate):
+    """Close the serial port and open it again at 'baudrate'.
+
+    Any queued commands are sent at the old baud rate first.
+
+    """
+    if self.writer is not None:
+      self.writer.Flush()
+    # Locks are always taken in the order rx_lock, _responses, tx_lock.
+    with self.rx_lock:
+      with self._responses:
+        self._FailPending('SCI port reopened.')
+        with self.tx_lock:
+          logging.info('Reopening SCI port at %d bps.' % baudrate)
+          self.ser.flush()  # Wait for output to be transmitted.
+          self.ser.close()
+          self.ser.baudrate = baudrate
+          self.ser.open()
+          self.baudrate = baudrate
+
   def FlushInput(self):
     """Flush input buffer, discarding all its contents."""
     logging.debug('Flushing serial input buffer.')
+    if self.metrics is None:
+      self.ser.flushInput()
+      return
+    start = time.time()
     self.ser.flushInput()
+    self.metrics.flush_input.Add(time.time() - start)
+
+
+_MISSING = object()  # Marks sensors that have not been read yet.
+
+
+def _SensorNames(fields):
+  """Return the names of the sensors decoded from 'fields'."""
+  names = []
+  for name, unused_format, decode in fields:
+    if isinstance(decode, SensorBitfield):
+      names.extend([bit_name for bit_name, unused_mask in decode.bits])
+    else:
+      names.append(name)
+  return tuple(names)
+
+
+class SensorSnapshot(object):
+
+  """An immutable set of sensor readings.
+
+  Each snapshot has a fixed set of fields (see subclasses) stored in a tuple,
+  a sequence number that increases with each update and the time it was
+  captured. Index it like a dict, e.g. snapshot['bump-left']. Sensors that
+  have not been read yet raise KeyError.
+
+  """
+  __slots__ = ('_values', 'sequence', 'timestamp')
+
+  FIELDS = ()
+  _INDEX = {}
+
+  def __init__(self, values=None, sequence=0, timestamp=None):
+    if values is None:
+      values = (_MISSING,) * len(self.FIELDS)
+    object.__setattr__(self, '_values', values)
+    object.__setattr__(self, 'sequence', sequence)
+    object.__setattr__(self, 'timestamp', timestamp)
+
+  def __setattr__(self, name, value):
+    raise AttributeError('SensorSnapshots are immutable.')
+
+  def Update(self, values, timestamp):
+    """Return a new snapshot with the readings in the dict 'values'."""
+    new_values = list(self._values)
+    index = self._INDEX
+    for name, value in values.iteritems():
+      new_values[index[name]] = value
+    return self.__class__(tuple(new_values), self.sequence + 1, timestamp)
+
+  def __getitem__(self, name):
+    value = self._values[self._INDEX[name]]
+    if value is _MISSING:
+      raise KeyError(name)
+    return value
+
+  def __contains__(self, name):
+    index = self._INDEX.get(name)
+    return index is not None and self._values[index] is not _MISSING
+
+  def get(self, name, default=None):
+    if name in self:
+      return self[name]
+    return default
+
+  def AsDict(self):
+    """Return the readings as a new dict."""
+    return dict([(name, value) for name, value in zip(self.FIELDS, self._values)
+                 if value is not _MISSING])
+
+
+class RoombaSensorSnapshot(SensorSnapshot):
+
+  """Sensor readings available from the Roomba."""
+
+  __slots__ = ()
+
+  FIELDS = _SensorNames(SENSOR_GROUP_PACKET_0_FIELDS)
+  _INDEX = dict([(name, i) for i, name in enumerate(FIELDS)])
+
+
+class CreateSensorSnapshot(SensorSnapshot):
+
+  """Sensor readings available from the Create."""
+
+  __slots__ = ()
+
+  FIELDS = _SensorNames(SENSOR_GROUP_PACKET_6_FIELDS)
+  _INDEX = dict([(name, i) for i, name in enumerate(FIELDS)])
+
+
+class SensorSubscription(object):
+
+  """Watches decoded sensor readings for a condition.
+
+  The 'predicate' is called with each new SensorSnapshot right after a packet
+  is decoded, in the thread that decoded it. When it triggers (see TRIGGERS),
+  threads blocked in Wait are woken and 'callback' is called with the
+  snapshot. Callbacks must be quick since they hold up decoding.
 
-  def __getattr__(self, name):
-    """Creates methods for opcodes on the fly.
+  If 'names' is given, the predicate is only checked when one of those
+  sensors was decoded. Predicates that index missing sensors are false.
 
-    Each opcode method sends the opcode optionally followed by a string of
-    bytes.
+  """
+  def __init__(self, predicate, callback=None, trigger=TRIGGER_RISING,
+               names=None):
+    if trigger not in TRIGGERS:
+      raise PyRobotError('Unknown trigger %s.' % trigger)
+    self.predicate = predicate
+    self.callback = callback
+    self.trigger = trigger
+    self.names = names and frozenset(names)
+    self.value = None  # The predicate's value for the last snapshot checked.
+    self.snapshot = None  # The last snapshot that triggered.
+    self.count = 0  # Number of times triggered.
+    self._pending = False  # Triggered since the last Wait.
+    self._condition = threading.Condition()
+
+  def Evaluate(self, snapshot):
+    """Return the value of the predicate for 'snapshot'."""
+    try:
+      return self.predicate(snapshot)
+    except KeyError:
+      return False
+
+  def Check(self, snapshot, values=None):
+    """Check 'snapshot', decoded from 'values', and trigger if it matches."""
+    if (values is not None and self.names is not None and
+        self.names.isdisjoint(values)):
+      return
+    value = self.Evaluate(snapshot)
+    if self.trigger == TRIGGER_RISING:
+      triggered = value and not self.value
+    elif self.trigger == TRIGGER_LEVEL:
+      triggered = value
+    else:
+      triggered = value != self.value
+    self.value = value
+    if triggered:
+      self._Trigger(snapshot)
+
+  def _Trigger(self, snapshot):
+    with self._condition:
+      self.snapshot = snapshot
+      self.count += 1
+      self._pending = True
+      self._condition.notifyAll()
+    if self.callback is not None:
+      try:
+        self.callback(snapshot)
+      except Exception:
+        logging.error('Exception in sensor subscription callback.\n%s' %
+                      traceback.format_exc())
+
+  def Wait(self, timeout=None):
+    """Wait for the subscription to trigger and return the snapshot.
+
+    Returns at once if it triggered since the last Wait. Returns None if it
+    doesn't trigger within 'timeout' seconds.
+
+    """
+    with self._condition:
+      if timeout is not None:
+        deadline = time.time() + timeout
+      while not self._pending:
+        if timeout is None:
+          self._condition.wait()
+        else:
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            return None
+          self._condition.wait(remaining)
+      self._pending = False
+      return self.snapshot
+
+
+class LatencyHistogram(object):
+
+  """Counts latencies in fixed buckets (see LATENCY_BUCKETS)."""
+
+  def __init__(self, buckets=LATENCY_BUCKETS):
+    self.buckets = tuple(buckets)
+    self.counts = [0] * (len(self.buckets) + 1)
+    self.count = 0
+    self.total = 0.0
+    self.max = None
+
+  def Add(self, latency):
+    """Count a latency in seconds."""
+    self.counts[bisect.bisect_left(self.buckets, latency)] += 1
+    self.count += 1
+    self.total += latency
+    self.max = max(self.max, latency)
+
+  def Percentile(self, percentile):
+    """Return an upper bound on the latency at 'percentile' (0 to 100)."""
+    if not self.count:
+      return None
+    rank = percentile / 100.0 * self.count
+    seen = 0
+    for bucket, count in zip(self.buckets, self.counts):
+      seen += count
+      if seen >= rank:
+        return min(bucket, self.max)
+    return self.max
+
+  def AsDict(self):
+    """Return the histogram and some summary statistics in seconds."""
+    return {
+        'buckets': list(self.buckets),
+        'counts': list(self.counts),
+        'count': self.count,
+        'mean': self.count and self.total / self.count or None,
+        'max': self.max,
+        'p50': self.Percentile(50),
+        'p99': self.Percentile(99),
+        }
+
+
+class SerialMetrics(object):
+
+  """Counts what a SerialCommandInterface sends and receives and times it.
+
+  Counters are updated without locking to keep them cheap, so updates made
+  at the same moment from different threads are occasionally lost.
+
+  """
+  def __init__(self):
+    self.started = time.time()
+    self.commands = {}  # Maps opcodes to [commands sent, bytes sent].
+    self.bytes_received = 0
+    self.short_reads = 0  # Reads that returned fewer bytes than asked for.
+    self.timeouts = 0  # Reads and responses that never arrived.
+    self.resyncs = 0  # Times bytes were skipped to find a stream frame.
+    self.send = LatencyHistogram(SERIAL_LATENCY_BUCKETS)
+    self.tx_lock_wait = LatencyHistogram(SERIAL_LATENCY_BUCKETS)
+    self.read = LatencyHistogram(SERIAL_LATENCY_BUCKETS)
+    self.flush_input = LatencyHistogram(SERIAL_LATENCY_BUCKETS)
+    self.round_trip = LatencyHistogram(SERIAL_LATENCY_BUCKETS)
+
+  def CountCommand(self, bytes):
+    """Count the command string 'bytes'."""
+    counts = self.commands.get(bytes[0])
+    if counts is None:
+      counts = self.commands[bytes[0]] = [0, 0]
+    counts[0] += 1
+    counts[1] += len(bytes)
+
+  def AsDict(self, opcodes=None):
+    """Return the metrics as a dict.
+
+    Commands are keyed by name if their opcode is in 'opcodes', a dict of
+    names to opcodes like SerialCommandInterface.opcodes.
 
     """
-    if name in self.opcodes:
-      def SendOpcode(*bytes):
-        logging.debug('Sending opcode %s.' % name)
-        self.Send([self.opcodes[name]] + list(bytes))
-      return SendOpcode
-    raise AttributeError
+    names = {}
+    if opcodes is not None:
+      names = dict([(opcode, name) for name, opcode in opcodes.items()])
+    elapsed = time.time() - self.started
+    commands = {}
+    for opcode, (count, bytes) in self.commands.items():
+      opcode = ord(opcode)
+      commands[names.get(opcode, str(opcode))] = {
+          'count': count, 'bytes': bytes, 'per_sec': count / elapsed}
+    return {
+        'elapsed': elapsed,
+        'commands': commands,
+        'bytes_sent': sum([bytes for unused, bytes in self.commands.values()]),
+        'bytes_received': self.bytes_received,
+        'short_reads': self.short_reads,
+        'timeouts': self.timeouts,
+        'resyncs': self.resyncs,
+        'send': self.send.AsDict(),
+        'tx_lock_wait': self.tx_lock_wait.AsDict(),
+        'read': self.read.AsDict(),
+        'flush_input': self.flush_input.AsDict(),
+        'round_trip': self.round_trip.AsDict(),
+        }
+
+
+class Reflex(SensorSubscription):
+
+  """Writes a command as soon as a condition appears in decoded sensor data.
+
+  The pre-encoded 'command' is written from the decoding thread, ahead of any
+  queued commands (see SerialCommandInterface.SendNow). The time from the
+  packet's arrival to the command being written is recorded in 'latency'.
+  Reflexes trigger when their condition starts (TRIGGER_RISING) and only
+  while 'enabled'.
+
+  Drive commands from anywhere else are dropped while the reflex is
+  'latched', i.e. from the trigger until the condition clears or the reflex
+  is disabled.
+
+  """
+  def __init__(self, sci, predicate, command, callback=None, names=None):
+    super(Reflex, self).__init__(predicate, callback, TRIGGER_RISING, names)
+    self.sci = sci
+    self.command = command
+    self.name = None  # The REFLEX_CONDITIONS name, if any.
+    self.latched = False
+    self.latency = LatencyHistogram()
+    self._enabled = True
+
+  def _GetEnabled(self):
+    return self._enabled
+
+  def _SetEnabled(self, enabled):
+    self._enabled = enabled
+    if not enabled:
+      self.value = None  # Trigger again if still true once re-enabled.
+      self._Abort()
+      self._Release()
+
+  enabled = property(_GetEnabled, _SetEnabled)
+
+  def Check(self, snapshot, values=None):
+    if self._enabled:
+      super(Reflex, self).Check(snapshot, values)
+      if self.latched and not self.value:
+        self._Release()
+
+  def _Latched(self):
+    """Return True if drives must still be held off."""
+    return bool(self.value)
+
+  def _Abort(self):
+    """Called when the reflex is disabled."""
+
+  def _Release(self):
+    if self.latched and not (self._enabled and self._Latched()):
+      self.latched = False
+      self.sci.ReleaseDrives(self)
+
+  def _Write(self, command):
+    try:
+      self.sci.SendNow(command, self)
+    except serial.SerialException, e:
+      logging.warn('Failed to write reflex command: %s' % e)
+      return False
+    return True
+
+  def _Trigger(self, snapshot):
+    self.latched = True
+    if self._Write(self.command):
+      self.latency.Add(time.time() - snapshot.timestamp)
+    super(Reflex, self)._Trigger(snapshot)
+
+
+class BackOffReflex(Reflex):
+
+  """Reverses at 'velocity' for 'seconds' when its condition appears.
+
+  The back off is timed by the host rather than played as a script, since
+  the robot would ignore a cliff or wheel drop stop while a script runs.
+  Drives stay latched off until the back off is over and the condition has
+  cleared. If another reflex already holds drives off (e.g. at a cliff) the
+  robot just stops instead of backing up.
+
+  """
+  def __init__(self, sci, predicate, velocity, seconds, names=None):
+    command = DRIVE_COMMAND.pack(ROOMBA_OPCODES['drive'], -velocity & 0xffff,
+                                 RADIUS_STRAIGHT)
+    super(BackOffReflex, self).__init__(sci, predicate, command, None, names)
+    self.seconds = seconds
+    self._timer = None  # Ends the current back off.
+    self._back_offs = 0  # Identifies the current back off to its timer.
+
+  def _Latched(self):
+    return self._timer is not None or bool(self.value)
+
+  def _Trigger(self, snapshot):
+    command = self.command
+    if self.sci.drive_latches - frozenset([self]):
+      command = STOP_COMMAND
+    if self._timer is not None:
+      self._timer.cancel()
+    self._back_offs += 1
+    self._timer = threading.Timer(self.seconds, self._Stop, [self._back_offs])
+    self._timer.setDaemon(True)
+    self.latched = True
+    if self._Write(command):
+      self.latency.Add(time.time() - snapshot.timestamp)
+    self._timer.start()
+    SensorSubscription._Trigger(self, snapshot)
+
+  def _Stop(self, back_off):
+    """Stop at the end of back off number 'back_off'."""
+    if back_off != self._back_offs or self._timer is None:
+      return  # Superseded by a later back off or aborted.
+    self._timer = None
+    self._Write(STOP_COMMAND)
+    self._Release()
+
+  def _Abort(self):
+    timer, self._timer = self._timer, None
+    if timer is not None:
+      timer.cancel()
+      self._Write(STOP_COMMAND)
+
+
+class CommandWriter(object):
+
+  """Writes commands to the robot from a background thread.
+
+  Commands are written in the order they were queued, except that a drive or
+  direct_drive command replaces one queued directly before it that has not
+  been written yet. Only the newest velocity reaches the robot while
+  ordering-sensitive commands (mode changes, songs, scripts, etc.) are never
+  dropped or reordered. When the queue is full, Put blocks until there is
+  room.
+
+  """
+  def __init__(self, sci, max_queue_size=MAX_COMMAND_QUEUE_SIZE):
+    self.sci = sci
+    self.max_queue_size = max_queue_size
+    self.sent = 0  # Commands written.
+    self.dropped = 0  # Drive commands superseded before they were written.
+    self.max_queue_depth = 0  # Most commands ever queued at once.
+    self._queue = collections.deque()
+    self._condition = threading.Condition()
+    self._writing = False
+    self._join = False
+    self._thread = None
+
+  @property
+  def queue_depth(self):
+    """The number of commands waiting to be written."""
+    return len(self._queue)
+
+  def Put(self, bytes):
+    """Queue the command string 'bytes' to be written."""
+    coalesce = ord(bytes[0]) in COALESCED_OPCODES
+    with self._condition:
+      if (coalesce and self._queue and
+          ord(self._queue[-1][0]) in COALESCED_OPCODES):
+        self._queue[-1] = bytes
+        self.dropped += 1
+      else:
+        while len(self._queue) >= self.max_queue_size:
+          self._condition.wait()
+        self._queue.append(bytes)
+        self.max_queue_depth = max(self.max_queue_depth, len(self._queue))
+      self._condition.notifyAll()
+
+  def DiscardDrives(self):
+    """Drop any queued drive and direct_drive commands."""
+    with self._condition:
+      commands = [bytes for bytes in self._queue
+                  if ord(bytes[0]) not in COALESCED_OPCODES]
+      self.dropped += len(self._queue) - len(commands)
+      self._queue = collections.deque(commands)
+      self._condition.notifyAll()
+
+  def Flush(self):
+    """Wait until all queued commands have been written."""
+    with self._condition:
+      while self._queue or self._writing:
+        self._condition.wait()
+
+  def Start(self):
+    """Start writing queued commands."""
+    self._join = False
+    self._thread = threading.Thread(target=self._Loop)
+    self._thread.setDaemon(True)
+    self._thread.start()
+
+  def Stop(self):
+    """Write any queued commands and then stop."""
+    with self._condition:
+      self._join = True
+      self._condition.notifyAll()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+  def _Loop(self):
+    """Write commands until asked to stop and the queue is empty."""
+    while True:
+      with self._condition:
+        while not self._queue and not self._join:
+          self._condition.wait()
+        if not self._queue:
+          return
+        bytes = self._queue.popleft()
+        self._writing = True
+        self._condition.notifyAll()
+      try:
+        # Other threads may write too (e.g. SendNow), so the command must
+        # not be interleaved with their bytes.
+        with self.sci.tx_lock:
+          if self.sci.Latched(bytes):
+            self.dropped += 1
+          else:
+            self.sci.ser.write(bytes)
+            self.sent += 1
+      except serial.SerialException, e:
+        logging.warn('Failed to write command: %s' % e)
+      with self._condition:
+        self._writing = False
+        self._condition.notifyAll()
 
 
 class RoombaSensors(object):
@@ -282,72 +1508,163 @@ class RoombaSensors(object):
   description, see the Roomba SCI Sepc Manual.
 
   """
+  Snapshot = RoombaSensorSnapshot
+
   def __init__(self, robot):
     self.robot = robot
-    self.data = {}  # Last sensor readings.
+    self.snapshot = self.Snapshot()  # Last sensor readings.
+    # Reentrant so that subscription callbacks can subscribe and unsubscribe.
+    self._publish_lock = threading.RLock()
+    # Replaced rather than changed so that it can be iterated while changing.
+    self._subscriptions = ()
+    # If set, its UpdateFromSensors method is called with each set of decoded
+    # values so that distance and angle increments can be integrated.
+    self.odometry = None
+
+  @property
+  def data(self):
+    """A dict of the last sensor readings."""
+    return self.snapshot.AsDict()
+
+  @property
+  def sequence(self):
+    """Incremented each time new sensor data is decoded."""
+    return self.snapshot.sequence
+
+  @property
+  def timestamp(self):
+    """When the last sensor data was decoded."""
+    return self.snapshot.timestamp
 
   def Clear(self):
     """Clear out old sensor data."""
-    self.data = {}
+    self.snapshot = self.Snapshot()
+
+  def _Publish(self, values, timestamp=None):
+    """Make freshly decoded sensor 'values' available to readers.
+
+    'timestamp' is when the packet arrived, now by default.
+
+    Readers always see a complete snapshot since the new snapshot replaces
+    the old one with a single assignment. The lock only keeps concurrent
+    writers (e.g. a SensorStream and Query) from losing each other's values.
+    Subscriptions are then checked against the new snapshot.
+
+    """
+    with self._publish_lock:
+      if timestamp is None:
+        timestamp = time.time()
+      snapshot = self.snapshot = self.snapshot.Update(values, timestamp)
+      if self.odometry is not None:
+        self.odometry.UpdateFromSensors(values)
+      for subscription in self._subscriptions:
+        subscription.Check(snapshot, values)
+
+  def Subscribe(self, predicate, callback=None, trigger=TRIGGER_RISING,
+                names=None):
+    """Watch for sensor readings matching 'predicate'.
+
+    Returns a SensorSubscription, which is first checked against the current
+    readings without triggering. For example, to be called back whenever the
+    left bumper is pressed:
+
+      sensors.Subscribe(lambda s: s['bump-left'], callback, names=['bump-left'])
+
+    """
+    return self.AddSubscription(
+        SensorSubscription(predicate, callback, trigger, names))
+
+  def AddSubscription(self, subscription):
+    """Start checking the SensorSubscription 'subscription' and return it."""
+    with self._publish_lock:
+      subscription.value = subscription.Evaluate(self.snapshot)
+      self._subscriptions += (subscription,)
+    return subscription
+
+  def Unsubscribe(self, subscription):
+    """Stop checking 'subscription'."""
+    with self._publish_lock:
+      self._subscriptions = tuple([s for s in self._subscriptions
+                                   if s is not subscription])
+
+  def OnChange(self, name, callback):
+    """Call 'callback' with the new snapshot whenever sensor 'name' changes."""
+    return self.Subscribe(lambda snapshot: snapshot.get(name), callback,
+                          TRIGGER_CHANGE, [name])
+
+  def WaitFor(self, predicate, timeout=None, names=None):
+    """Wait until the sensor readings match 'predicate' and return them.
+
+    Returns the current snapshot at once if it already matches, or None if no
+    matching readings are decoded within 'timeout' seconds. Some other thread
+    (e.g. a SensorStream) must be decoding sensor data.
+
+    """
+    subscription = self.Subscribe(predicate, None, TRIGGER_LEVEL, names)
+    try:
+      if subscription.value:
+        return self.snapshot
+      return subscription.Wait(timeout)
+    finally:
+      self.Unsubscribe(subscription)
 
   def __getitem__(self, name):
     """Indexes into sensor data."""
-    return self.data[name]
+    return self.snapshot[name]
 
   def __contains__(self, name):
     """Indexes into sensor data."""
-    return name in self.data
+    return name in self.snapshot
 
   def _MakeHumanReadable(self, sensor, mapping):
     """Change a sensor value to it's human readable form."""
     try:
-      self.data[sensor] = mapping[self.data[sensor]]
+      self._Publish({sensor: mapping[self[sensor]]})
     except (KeyError, IndexError):
       logging.debug(traceback.format_exc())
       raise PyRobotError('Invalid sensor data.')
 
-  def _DecodeGroupPacket0(self, bytes):
-    """Decode sensord data from a request for group 0 (all data)."""
-    # NOTE(damonkohler): We decode sensor data in reverse order for better pop
-    # performance.
-    self.DecodeUnsignedShort('capacity', bytes.pop(), bytes.pop())  # mAh
-    self.DecodeUnsignedShort('charge', bytes.pop(), bytes.pop())  # mAh
-    self.DecodeByte('temperature', bytes.pop())  # C
-    self.DecodeShort('current', bytes.pop(), bytes.pop())  # mA
-    self.DecodeUnsignedShort('voltage', bytes.pop(), bytes.pop())  # mV
-    self.DecodeUnsignedByte('charging-state', bytes.pop())
-    self._MakeHumanReadable('charging-state', CHARGING_STATES)
-    self.Angle(bytes.pop(), bytes.pop(), 'degrees')
-    self.DecodeShort('distance', bytes.pop(), bytes.pop())  # mm
-    self.Buttons(bytes.pop())
-    self.DecodeUnsignedByte('remote-opcode', bytes.pop())
-    self._MakeHumanReadable('remote-opcode', REMOTE_OPCODES)
-    self.DecodeUnsignedByte('dirt-detector-right', bytes.pop())
-    self.DecodeUnsignedByte('dirt-detector-left', bytes.pop())
-    self.MotorOvercurrents(bytes.pop())
-    self.DecodeBool('virtual-wall', bytes.pop())
-    self.DecodeBool('cliff-right', bytes.pop())
-    self.DecodeBool('cliff-front-right', bytes.pop())
-    self.DecodeBool('cliff-front-left', bytes.pop())
-    self.DecodeBool('cliff-left', bytes.pop())
-    self.DecodeBool('wall', bytes.pop())
-    self.BumpsWheeldrops(bytes.pop())
+  def _DecodeGroupPacket0(self, data):
+    """Decode sensor data from a request for group 0 (all data)."""
+    self._Publish(SENSOR_GROUP_DECODERS[0].Decode(data))
 
   def RequestPacket(self, packet_id):
-    """Reqeust a sesnor packet."""
-    with self.robot.sci.lock:
-      logging.debug('Requesting sensor packet %d.' % packet_id)
-      self.robot.sci.FlushInput()
-      self.robot.sci.sensors(packet_id)
-      length = SENSOR_GROUP_PACKET_LENGTHS[packet_id]
-      data = list(self.robot.sci.Read(length))
-      return data
+    """Reqeust a sesnor packet.
+
+    Returns the raw data (a Future for it in async_pyrobot).
+
+    """
+    logging.debug('Requesting sensor packet %d.', packet_id)
+    return self.robot.sci.Request(
+        chr(ROOMBA_OPCODES['sensors']) + chr(packet_id),
+        SENSOR_GROUP_PACKET_LENGTHS[packet_id]).Wait()
+
+  def RequestGroup(self, packet_id):
+    """Request and decode sensor group packet 'packet_id'.
+
+    Lost responses and responses that don't decode to sane values (e.g.
+    because a stray byte shifted them) are retried. See
+    SerialCommandInterface.Retry.
+
+    """
+    return self.robot._Run(self._RequestGroupSteps(packet_id))
+
+  def _RequestGroupSteps(self, packet_id):
+    decoder = SENSOR_GROUP_DECODERS[packet_id]
+    def Request():
+      values = decoder.Decode((yield self.RequestPacket(packet_id)))
+      if ('voltage' in values and
+          not VOLTAGE_RANGE[0] <= values['voltage'] <= VOLTAGE_RANGE[1]):
+        raise PyRobotError('Misaligned sensor data.')
+      raise Return(values)
+    return self.robot.sci._RetrySteps(Request)
 
   def GetAll(self):
     """Request and decode all available sensor data."""
-    bytes = self.RequestPacket(0)
-    if bytes is not None:
-      self._DecodeGroupPacket0(bytes)
+    return self.robot._Run(self._GetAllSteps())
+
+  def _GetAllSteps(self):
+    self._Publish((yield self._RequestGroupSteps(0)))
 
   def Angle(self, low, high, unit=None):
     """The angle that Roomba has turned through since the angle was last
@@ -373,11 +1690,12 @@ class RoombaSensors(object):
     """
     if unit not in (None, 'radians', 'degrees'):
       raise PyRobotError('Invalid angle unit specified.')
-    self.DecodeShort('angle', low, high)
+    angle = struct.unpack('>h', high + low)[0]
     if unit == 'radians':
-      self.data['angle'] = (2 * self.data['angle']) / 258
+      angle = (2.0 * angle) / 258
     if unit == 'degrees':
-      self.data['angle'] /= math.pi
+      angle = (360.0 * angle) / (258 * math.pi)
+    self._Publish({'angle': angle})
 
   def BumpsWheeldrops(self, byte):
     """The state of the bump (0 = no bump, 1 = bump) and wheeldrop sensors
@@ -390,72 +1708,108 @@ class RoombaSensors(object):
     is an 'E' in the serial number.
 
     """
-    byte = struct.unpack('B', byte)[0]
-    self.data.update({
-        'wheel-drop-caster': bool(byte & 0x10),
-        'wheel-drop-left': bool(byte & 0x08),
-        'wheel-drop-right': bool(byte & 0x04),
-        'bump-left': bool(byte & 0x02),
-        'bump-right': bool(byte & 0x01)})
+    self._Publish(BUMPS_WHEELDROPS[struct.unpack('B', byte)[0]])
 
   def MotorOvercurrents(self, byte):
     """The state of the five motors overcurrent sensors are sent as individual
     bits (0 = no overcurrent, 1 = overcurrent).
 
     """
-    byte = struct.unpack('B', byte)[0]
-    self.data.update({
-        'drive-left': bool(byte & 0x10),
-        'drive-right': bool(byte & 0x08),
-        'main-brush': bool(byte & 0x04),
-        'vacuum': bool(byte & 0x02),
-        'side-brush': bool(byte & 0x01)})
+    self._Publish(MOTOR_OVERCURRENTS[struct.unpack('B', byte)[0]])
 
   def Buttons(self, byte):
     """The state of the four Roomba buttons are sent as individual bits
     (0 = button not pressed, 1 = button pressed).
 
     """
-    byte = struct.unpack('B', byte)[0]
-    self.data.update({
-        'power': bool(byte & 0x08),
-        'spot': bool(byte & 0x04),
-        'clean': bool(byte & 0x02),
-        'max': bool(byte & 0x01)})
+    self._Publish(BUTTONS[struct.unpack('B', byte)[0]])
 
   def DecodeBool(self, name, byte):
     """Decode 'byte' as a bool and map it to 'name'."""
-    self.data[name] = bool(struct.unpack('B', byte)[0])
+    self._Publish({name: bool(struct.unpack('B', byte)[0])})
 
   # NOTE(damonkohler): We specify the low byte first to make it easier when
   # popping bytes off a list.
   def DecodeUnsignedShort(self, name, low, high):
     """Map an unsigned short from a 'high' and 'low' bytes to 'name'."""
-    self.data[name] = struct.unpack('>H', high + low)[0]
+    self._Publish({name: struct.unpack('>H', high + low)[0]})
 
   def DecodeShort(self, name, low, high):
     """Map a short from a 'high' and 'low' bytes to 'name'."""
-    self.data[name] = struct.unpack('>h', high + low)[0]
+    self._Publish({name: struct.unpack('>h', high + low)[0]})
 
   def DecodeByte(self, name, byte):
     """Map signed 'byte' to 'name'."""
-    self.data[name] = struct.unpack('b', byte)[0]
+    self._Publish({name: struct.unpack('b', byte)[0]})
 
   def DecodeUnsignedByte(self, name, byte):
     """Map unsigned 'byte' to 'name'."""
-    self.data[name] = struct.unpack('B', byte)[0]
+    self._Publish({name: struct.unpack('B', byte)[0]})
 
 
 class Roomba(object):
 
   """Represents a Roomba robot."""
 
+  Sensors = RoombaSensors
+
   def __init__(self, tty='/dev/ttyUSB0'):
     self.tty = tty
-    self.sci = SerialCommandInterface(tty, 57600)
+    self.sci = self._OpenSerialCommandInterface(tty)
     self.sci.AddOpcodes(ROOMBA_OPCODES)
-    self.sensors = RoombaSensors(self)
+    self.sensors = self.Sensors(self)
+    self.reflexes = []
     self.safe = True
+    # The baud rate the robot should be using. It is restored after resets.
+    self.baud_rate = DEFAULT_BAUD_RATE
+
+  def _OpenSerialCommandInterface(self, tty):
+    """Return the SCI to talk to the robot over."""
+    return SerialCommandInterface(tty, DEFAULT_BAUD_RATE)
+
+  def _Run(self, steps):
+    """Run the step generator 'steps' and return its result.
+
+    See RunSteps. AsyncRoomba returns a Future for the result instead.
+
+    """
+    return RunSteps(steps)
+
+  def AddReflex(self, condition, command=STOP_COMMAND, callback=None):
+    """Write 'command' (stop by default) as soon as 'condition' is decoded.
+
+    'condition' is a name from REFLEX_CONDITIONS. Sensor data must be
+    decoded (e.g. streamed) for the reflex to trigger. Returns the Reflex.
+
+    """
+    if condition not in REFLEX_CONDITIONS:
+      raise PyRobotError('Unknown reflex condition %s.' % condition)
+    names, predicate = REFLEX_CONDITIONS[condition]
+    reflex = Reflex(self.sci, predicate, command, callback, names)
+    reflex.name = condition
+    self.sensors.AddSubscription(reflex)
+    self.reflexes.append(reflex)
+    return reflex
+
+  def AddBackOffReflex(self, condition, velocity=VELOCITY_SLOW, seconds=1):
+    """Back off at 'velocity' for 'seconds' as soon as 'condition' is decoded.
+
+    Returns the BackOffReflex.
+
+    """
+    if condition not in REFLEX_CONDITIONS:
+      raise PyRobotError('Unknown reflex condition %s.' % condition)
+    names, predicate = REFLEX_CONDITIONS[condition]
+    reflex = BackOffReflex(self.sci, predicate, velocity, seconds, names)
+    reflex.name = condition
+    self.sensors.AddSubscription(reflex)
+    self.reflexes.append(reflex)
+    return reflex
+
+  def RemoveReflex(self, reflex):
+    reflex.enabled = False  # Let go of any drives it holds off.
+    self.sensors.Unsubscribe(reflex)
+    self.reflexes.remove(reflex)
 
   def ChangeBaudRate(self, baud_rate):
     """Sets the baud rate in bits per second (bps) at which SCI commands and
@@ -470,23 +1824,126 @@ class Roomba(object):
     command. This command puts the SCI in passive mode.
 
     """
+    return self._Run(self._ChangeBaudRateSteps(baud_rate))
+
+  def _ChangeBaudRateSteps(self, baud_rate):
     if baud_rate not in BAUD_RATES:
       raise PyRobotError('Invalid baud rate specified.')
-    self.sci.baud(baud_rate)
-    self.sci = SerialCommandInterface(self.tty, baud_rate)
+    self.sci.baud(BAUD_RATES.index(baud_rate))
+    self.sci.Reopen(baud_rate)
+    yield Sleep(BAUD_RATE_CHANGE_DELAY)
+
+  def VerifyLink(self):
+    """Return True if the robot sensibly answers a few sensor requests.
+
+    At a mismatched baud rate the robot either doesn't answer or the answer
+    is garbage, so the battery readings are checked for plausibility and the
+    capacity must be the same in every answer.
+
+    """
+    return self._Run(self._VerifyLinkSteps())
+
+  def _VerifyLinkSteps(self):
+    capacities = set()
+    for unused_i in range(LINK_VERIFICATION_REQUESTS):
+      try:
+        data = yield self.sensors.RequestPacket(3)
+        values = SENSOR_GROUP_DECODERS[3].Decode(data)
+      except PyRobotError, e:
+        logging.debug('Link verification failed: %s' % e)
+        raise Return(False)
+      if not (VOLTAGE_RANGE[0] <= values['voltage'] <= VOLTAGE_RANGE[1] and
+              values['charge'] <= values['capacity']):
+        raise Return(False)
+      capacities.add(values['capacity'])
+    raise Return(len(capacities) == 1)
+
+  def _FindBaudRateSteps(self):
+    """Find the baud rate the robot is using and reopen the port at it.
+
+    This puts the robot in passive mode.
+
+    """
+    candidates = []
+    for baud_rate in ((self.sci.baudrate, self.baud_rate, DEFAULT_BAUD_RATE) +
+                      NEGOTIATED_BAUD_RATES):
+      if baud_rate not in candidates:
+        candidates.append(baud_rate)
+    for baud_rate in candidates:
+      if baud_rate != self.sci.baudrate:
+        self.sci.Reopen(baud_rate)
+      yield self._PassiveSteps()
+      verified = yield self._VerifyLinkSteps()
+      if verified:
+        raise Return(baud_rate)
+    raise PyRobotError('Unable to find the baud rate of the robot.')
+
+  def NegotiateBaudRate(self, baud_rates=NEGOTIATED_BAUD_RATES):
+    """Switch the robot and the port to the fastest of 'baud_rates' that
+    works and return it.
+
+    Each rate is verified with a sensor request. If verification fails, the
+    next fastest rate is tried. The chosen rate is restored by SoftReset.
+    This puts the robot in passive mode.
+
+    """
+    return self._Run(self._NegotiateBaudRateSteps(baud_rates))
+
+  def _NegotiateBaudRateSteps(self, baud_rates):
+    current = yield self._FindBaudRateSteps()
+    for baud_rate in sorted(baud_rates, reverse=True):
+      if baud_rate != current:
+        yield self._ChangeBaudRateSteps(baud_rate)
+        verified = yield self._VerifyLinkSteps()
+        if not verified:
+          logging.warn('Failed to verify link at %d bps.' % baud_rate)
+          # The robot may still understand us even if we can't understand
+          # it, so ask it to go back to the default rate before looking.
+          yield self._ChangeBaudRateSteps(DEFAULT_BAUD_RATE)
+          current = yield self._FindBaudRateSteps()
+          continue
+      logging.info('Using %d bps.' % baud_rate)
+      self.baud_rate = baud_rate
+      raise Return(baud_rate)
+    raise PyRobotError('Unable to negotiate a baud rate.')
+
+  def RestoreBaudRate(self):
+    """Switch the robot and port back to self.baud_rate (e.g. after a reset).
+
+    Falls back to whatever rate the robot is using if that fails.
+
+    """
+    return self._Run(self._RestoreBaudRateSteps())
+
+  def _RestoreBaudRateSteps(self):
+    current = yield self._FindBaudRateSteps()
+    if current == self.baud_rate:
+      return
+    yield self._ChangeBaudRateSteps(self.baud_rate)
+    verified = yield self._VerifyLinkSteps()
+    if not verified:
+      logging.warn('Failed to restore %d bps.' % self.baud_rate)
+      yield self._ChangeBaudRateSteps(DEFAULT_BAUD_RATE)
+      self.baud_rate = yield self._FindBaudRateSteps()
 
   def Passive(self):
     """Put the robot in passive mode."""
+    return self._Run(self._PassiveSteps())
+
+  def _PassiveSteps(self):
     self.sci.start()
-    time.sleep(0.5)
+    yield Sleep(0.5)
 
   def Control(self):
     """Start the robot's SCI interface and place it in safe mode."""
-    self.Passive()
+    return self._Run(self._ControlSteps())
+
+  def _ControlSteps(self):
+    yield self._PassiveSteps()
     self.sci.control()  # Also puts the Roomba in to safe mode.
     if not self.safe:
       self.sci.full()
-    time.sleep(0.5)
+    yield Sleep(0.5)
 
   def Drive(self, velocity, radius):
     """Controls Roomba's drive wheels.
@@ -512,26 +1969,58 @@ class Roomba(object):
 
     """
     # Mask integers to 2 bytes.
-    velocity = int(velocity) & 0xffff
-    radius = int(radius) & 0xffff
-    # Pack as shorts to get 2 x 2 byte integers. Unpack as 4 bytes to send.
-    # TODO(damonkohler): The 4 unpacked bytes will just be repacked later,
-    # that seems dumb to me.
-    bytes = struct.unpack('4B', struct.pack('>2H', velocity, radius))
-    self.sci.drive(*bytes)
+    self.sci.Send(DRIVE_COMMAND.pack(ROOMBA_OPCODES['drive'],
+                                     int(velocity) & 0xffff,
+                                     int(radius) & 0xffff))
 
   def Stop(self):
     """Set velocity and radius to 0 to stop movement."""
     self.Drive(0, 0)
 
+  def Leds(self, bits, color, intensity):
+    """Controls Roomba's LEDs.
+
+    'bits' turns the status, spot, clean, max and dirt detect LEDs on or off.
+    The power LED's 'color' ranges from green (0) to red (255) and its
+    'intensity' from off (0) to full (255).
+
+    """
+    self.sci.Send(LEDS_COMMAND.pack(ROOMBA_OPCODES['leds'], bits, color,
+                                    intensity))
+
+  def Song(self, song_number, notes):
+    """Specify a song to be played later with Play.
+
+    'notes' is a sequence of (note, duration) pairs. Notes are either MIDI
+    note numbers or names from MIDI_TABLE (e.g. 'C#4'). Durations are in
+    1/64ths of a second.
+
+    """
+    encoder = SONG_COMMANDS.get(len(notes))
+    if encoder is None:
+      encoder = SONG_COMMANDS[len(notes)] = struct.Struct(
+          '>%dB' % (3 + 2 * len(notes)))
+    values = [ROOMBA_OPCODES['song'], song_number, len(notes)]
+    for note, duration in notes:
+      values.append(MIDI_TABLE.get(note, note))
+      values.append(duration)
+    self.sci.Send(encoder.pack(*values))
+
+  def Play(self, song_number):
+    """Play a song previously specified with Song."""
+    self.sci.play(song_number)
+
   def SlowStop(self, velocity):
     """Slowly reduce the velocity to 0 to stop movement."""
+    return self._Run(self._SlowStopSteps(velocity))
+
+  def _SlowStopSteps(self, velocity):
     velocities = xrange(velocity, VELOCITY_SLOW, -25)
     if velocity < 0:
       velocities = xrange(velocity, -VELOCITY_SLOW, 25)
     for v in velocities:
       self.Drive(v, RADIUS_STRAIGHT)
-      time.sleep(0.05)
+      yield Sleep(0.05)
     self.Stop()
 
   def DriveStraight(self, velocity):
@@ -546,10 +2035,12 @@ class Roomba(object):
 
   def Dock(self):
     """Start looking for the dock and then dock."""
+    return self._Run(self._DockSteps())
+
+  def _DockSteps(self):
     # NOTE(damonkohler): We should be able to call dock from any mode, however
     # it only seems to work from passive.
-    self.sci.start()
-    time.sleep(0.5)
+    yield self._PassiveSteps()
     self.sci.force_seeking_dock()
 
 
@@ -557,54 +2048,164 @@ class CreateSensors(RoombaSensors):
 
   """Handles retrieving and decoding the Create's sensor data."""
 
-  def _DecodeGroupPacket6(self, bytes):
+  Snapshot = CreateSensorSnapshot
+
+  def __init__(self, robot):
+    super(CreateSensors, self).__init__(robot)
+    self._queries = {}  # Maps sets of sensor names to (packet IDs, decoder).
+
+  def _GetQuery(self, names):
+    """Return the packet IDs, decoder and encoded query_list command needed
+    to query sensors 'names'.
+
+    """
+    names = frozenset(names)
+    if names not in self._queries:
+      try:
+        packet_ids = sorted(set([SENSOR_NAME_PACKETS[name] for name in names]))
+      except KeyError, e:
+        raise PyRobotError('Unknown sensor %s.' % e)
+      fields = []
+      for packet_id in packet_ids:
+        fields.extend(SENSOR_PACKET_DECODERS[packet_id].fields)
+      command = ''.join(map(chr, [CREATE_OPCODES['query_list'],
+                                  len(packet_ids)] + packet_ids))
+      self._queries[names] = (tuple(packet_ids), SensorGroupDecoder(fields),
+                              command)
+    return self._queries[names]
+
+  def Query(self, names):
+    """Request and decode only the sensors in 'names'.
+
+    Only the packets that carry the named sensors are requested using the
+    query_list opcode. Requesting a single bit of a bitfield (e.g. bump-left)
+    also decodes the other bits sent in the same byte. Returns a dict of the
+    decoded values for 'names'.
+
+    While the robot is streaming, the latest streamed values are returned
+    instead. Raises PyRobotError if the stream doesn't carry all of 'names'.
+
+    """
+    return self.robot._Run(self._QuerySteps(names))
+
+  def _QuerySteps(self, names):
+    # Unknown sensors fail the steps, so async_pyrobot reports them through
+    # the Future like any other error.
+    raise Return((yield self.StartQuery(names)._WaitSteps()))
+
+  def StartQuery(self, names):
+    """Request the sensors in 'names' without waiting for the response.
+
+    Returns a PendingQuery whose Wait method decodes the response and
+    returns what Query would. Several queries can be outstanding at once.
+
+    """
+    packet_ids, decoder, command = self._GetQuery(names)
+    stream = self.robot.stream
+    response = None
+    if stream is None:
+      logging.debug('Querying sensor packets %r.', packet_ids)
+      response = self.robot.sci.Request(command, decoder.length)
+    else:
+      missing = set(names) - stream.names
+      if missing:
+        raise PyRobotError('Sensors %s are not being streamed.' %
+                           ', '.join(sorted(missing)))
+    return PendingQuery(self, names, decoder, command, response)
+
+  def _DecodeGroupPacket6(self, data):
     """Decode sensor group packet 6."""
-    self.DecodeShort('left-velocity', bytes.pop(), bytes.pop())  # mm/s
-    self.DecodeShort('right-velocity', bytes.pop(), bytes.pop())  # mm/s
-    self.DecodeShort('radius', bytes.pop(), bytes.pop())  # mm
-    self.DecodeShort('velocity', bytes.pop(), bytes.pop())  # mm/s
-    self.DecodeUnsignedByte('number-of-stream-packets', bytes.pop())
-    self.DecodeBool('song-playing', bytes.pop())
-    self.DecodeUnsignedByte('song-number', bytes.pop())
-    self.DecodeUnsignedByte('oi-mode', bytes.pop())
-    self._MakeHumanReadable('oi-mode', OI_MODES)
-    self.DecodeUnsignedByte('charging-sources-available', bytes.pop())
-    self.DecodeUnsignedShort('user-analog-input', bytes.pop(), bytes.pop())
-    self.DecodeUnsignedByte('user-digital-inputs', bytes.pop())
-    self.DecodeUnsignedShort('cliff-right-signal', bytes.pop(), bytes.pop())
-    self.DecodeUnsignedShort(
-        'cliff-front-right-signal', bytes.pop(), bytes.pop())
-    self.DecodeUnsignedShort(
-        'cliff-front-left-signal', bytes.pop(), bytes.pop())
-    self.DecodeUnsignedShort('cliff-left-signal', bytes.pop(), bytes.pop())
-    self.DecodeUnsignedShort('wall-signal', bytes.pop(), bytes.pop())
-    self._DecodeGroupPacket0(bytes)
+    self._Publish(SENSOR_GROUP_DECODERS[6].Decode(data))
 
   def GetAll(self):
-    """Request and decode all available sensor data."""
-    bytes = self.RequestPacket(6)
-    if bytes is not None:
-      self._DecodeGroupPacket6(bytes)
+    """Request and decode all available sensor data.
+
+    Does nothing while the robot is streaming sensor data since the stream
+    keeps the data up to date on its own.
+
+    """
+    return self.robot._Run(self._GetAllSteps())
+
+  def _GetAllSteps(self):
+    if self.robot.stream is not None:
+      return
+    self._Publish((yield self._RequestGroupSteps(6)))
+
+
+class PendingQuery(object):
+
+  """A sensor query started with CreateSensors.StartQuery."""
+
+  def __init__(self, sensors, names, decoder, command, response):
+    self.sensors = sensors
+    self.names = names
+    self.decoder = decoder
+    self.command = command
+    self.response = response  # None if the values are already streaming in.
+
+  def Wait(self):
+    """Wait for the response, decode it and return a dict of the values.
+
+    If the response is lost or garbled, the query is sent again. See
+    SerialCommandInterface.Retry.
+
+    """
+    return self.sensors.robot._Run(self._WaitSteps())
+
+  def _WaitSteps(self):
+    if self.response is not None:
+      sci = self.sensors.robot.sci
+      def Request():
+        response, self.response = self.response, None
+        if response is None:
+          response = sci.Request(self.command, self.decoder.length)
+        raise Return(self.decoder.Decode((yield response.Wait())))
+      values = yield sci._RetrySteps(Request)
+      self.sensors._Publish(values, time.time())
+    snapshot = self.sensors.snapshot
+    try:
+      values = dict([(name, snapshot[name]) for name in self.names])
+    except KeyError, e:
+      raise PyRobotError('No streamed value for sensor %s yet.' % e)
+    raise Return(values)
 
 
 class Create(Roomba):
 
   """Represents a Create robot."""
 
+  Sensors = CreateSensors
+
   def __init__(self, tty='/dev/ttyUSB0'):
     super(Create, self).__init__(tty)
     self.sci.AddOpcodes(CREATE_OPCODES)
-    self.sensors = CreateSensors(self)
+    self.stream = None  # The running SensorStream, if any.
 
   def Control(self):
     """Start the robot's SCI interface and place it in safe or full mode."""
+    return self._Run(self._ControlSteps())
+
+  def _ControlSteps(self):
     logging.info('Sending control opcodes.')
-    self.Passive()
+    yield self._PassiveSteps()
     if self.safe:
       self.sci.safe()
     else:
       self.sci.full()
-    time.sleep(0.5)
+    yield Sleep(0.5)
+
+  def DirectDrive(self, right, left):
+    """Control the forward and backward motion of the Create's drive wheels
+    independently.
+
+    Each velocity is in millimeters per second (mm/s) and ranges from -500 to
+    500. A positive velocity makes that wheel drive forward.
+
+    """
+    # Mask integers to 2 bytes.
+    self.sci.Send(DIRECT_DRIVE_COMMAND.pack(CREATE_OPCODES['direct_drive'],
+                                            int(right) & 0xffff,
+                                            int(left) & 0xffff))
 
   def PowerLowSideDrivers(self, drivers):
     """Enable or disable power to low side drivers.
@@ -620,8 +2221,176 @@ class Create(Roomba):
     self.sci.low_side_drivers(byte)
 
   def SoftReset(self):
-    """Do a soft reset of the Create."""
+    """Do a soft reset of the Create.
+
+    A running sensor stream is stopped during the reset and started again
+    afterwards.
+
+    """
+    return self._Run(self._SoftResetSteps())
+
+  def _SoftResetSteps(self):
+    stream = self.stream
+    self.StopStream()
     logging.info('Sending soft reset.')
     self.sci.soft_reset()
-    time.sleep(START_DELAY)
-    self.Passive()
+    yield Sleep(START_DELAY)
+    if self.baud_rate != DEFAULT_BAUD_RATE:
+      yield self._RestoreBaudRateSteps()
+    yield self._PassiveSteps()
+    if stream is not None:
+      self.StartStream(stream.packet_ids)
+
+  def StartStream(self, packet_ids=(6,)):
+    """Start streaming the sensor packets in 'packet_ids'.
+
+    The Create sends the requested packets every 15ms and a SensorStream
+    decodes them into self.sensors in the background. Only packets with a
+    known decoder (see SENSOR_PACKET_DECODERS) may be streamed.
+
+    """
+    if self.stream is not None:
+      self.StopStream()
+    self.stream = SensorStream(self, packet_ids)
+    self.stream.Start()
+
+  def StopStream(self):
+    """Stop streaming sensor data."""
+    if self.stream is not None:
+      self.stream.Stop()
+      self.stream = None
+
+
+class SensorStream(object):
+
+  """Decodes the Create's sensor stream in a background thread.
+
+  In stream mode the Create sends a frame every 15ms of the form:
+
+    [19][N][Packet ID 1][Packet 1 data]...[Packet ID n][Packet n data][Checksum]
+
+  where N is the number of bytes between N and the checksum. The checksum is
+  chosen so that the 8-bit sum of all bytes in the frame is 0.
+
+  A frame with the wrong length or checksum only costs its header byte. The
+  search for the next header starts right after it, so a real frame that
+  was hiding behind a stray header byte is still decoded.
+
+  """
+  def __init__(self, robot, packet_ids):
+    self.robot = robot
+    self.packet_ids = tuple(packet_ids)
+    for packet_id in self.packet_ids:
+      if packet_id not in SENSOR_PACKET_DECODERS:
+        raise PyRobotError('Unable to stream sensor packet %d.' % packet_id)
+    self.length = sum([SENSOR_PACKET_DECODERS[packet_id].length + 1
+                       for packet_id in self.packet_ids])
+    names = set()  # Sensors the stream keeps up to date.
+    for packet_id in self.packet_ids:
+      names.update(_SensorNames(SENSOR_PACKET_DECODERS[packet_id].fields))
+    self.names = frozenset(names)
+    self.frames = 0  # Frames decoded.
+    self.errors = 0  # Frames dropped because of bad framing or checksums.
+    self._buffer = ''  # Bytes read but not decoded yet.
+    self._join = False
+    self._thread = None
+
+  def Start(self):
+    """Ask the robot to start streaming and begin decoding."""
+    logging.info('Starting sensor stream of packets %r.' % (self.packet_ids,))
+    self.robot.sci.FlushInput()
+    self.robot.sci.stream(len(self.packet_ids), *self.packet_ids)
+    self._buffer = ''
+    self._join = False
+    self._thread = threading.Thread(target=self._Loop)
+    self._thread.setDaemon(True)
+    self._thread.start()
+
+  def Stop(self):
+    """Ask the robot to stop streaming and wait for the reader to exit."""
+    logging.info('Stopping sensor stream.')
+    self.robot.sci.pause_resume_stream(0)
+    self._join = True
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+  def _Loop(self):
+    """Decode frames until asked to stop."""
+    health = self.robot.sci.health
+    while not self._join:
+      try:
+        if self.ReadFrame() is not None:
+          health.Success()
+      except PyRobotError, e:
+        if not self._join:  # The last read times out once the stream stops.
+          self.errors += 1
+          health.Failure(e)
+
+  def _Read(self, num_bytes):
+    """Read up to 'num_bytes' more bytes of the stream.
+
+    Bytes that arrived before a timeout are kept rather than dropped with
+    the rest of the frame. AsyncSensorStream returns a Future instead.
+
+    """
+    return self.robot.sci.Read(num_bytes, partial=True)
+
+  def ReadFrame(self):
+    """Read, verify, and decode a single frame from the stream.
+
+    Returns the decoded values, or None if asked to stop first.
+
+    """
+    return RunSteps(self._ReadFrameSteps())
+
+  def _ReadFrameSteps(self):
+    size = self.length + 3  # Include the header, length and checksum.
+    # Discard bytes until a whole frame starting with a header is buffered.
+    while True:
+      while len(self._buffer) < size:
+        if self._join:
+          return
+        data = yield self._Read(size - len(self._buffer))
+        self._buffer += data
+      header = self._buffer.find(chr(STREAM_HEADER))
+      if not header:
+        break
+      if header == -1:
+        header = len(self._buffer)
+      self._buffer = self._buffer[header:]
+      metrics = self.robot.sci.metrics
+      if metrics is not None:
+        metrics.resyncs += 1
+    frame = self._buffer[:size]
+    try:
+      if ord(frame[1]) != self.length:
+        raise PyRobotError('Unexpected stream frame length %d.' %
+                           ord(frame[1]))
+      values = self.DecodeFrame(frame[1], frame[2:], time.time())
+    except PyRobotError:
+      self._buffer = self._buffer[1:]  # Look for a header after this one.
+      raise
+    self._buffer = self._buffer[size:]
+    raise Return(values)
+
+  def DecodeFrame(self, length, frame, timestamp=None):
+    """Verify, decode and publish a frame read after its 'length' byte.
+
+    Returns the decoded values.
+
+    """
+    if (STREAM_HEADER + ord(length) + sum(map(ord, frame))) & 0xff:
+      raise PyRobotError('Invalid stream frame checksum.')
+    values = {}
+    offset = 0
+    for packet_id in self.packet_ids:
+      if ord(frame[offset]) != packet_id:
+        raise PyRobotError('Unexpected packet %d in stream frame.' %
+                           ord(frame[offset]))
+      decoder = SENSOR_PACKET_DECODERS[packet_id]
+      values.update(decoder.Decode(frame, offset + 1))
+      offset += decoder.length + 1
+    self.robot.sensors._Publish(values, timestamp)
+    self.frames += 1
+    return values
@@ -0,0 +1,245 @@
+#!/usr/bin/python
+
+# The MIT License
+#
+# Copyright (c) 2007 Damon Kohler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Tests PyRobot against a simulated Create."""
+
+__author__ = "damonkohler@gmail.com (Damon Kohler)"
+
+import threading
+import time
+import unittest
+import pyrobot
+import simulator
+
+DRIVE = bytearray([pyrobot.ROOMBA_OPCODES['drive'], 0, 200, 0x80, 0])
+TIMEOUT = 0.1  # Seconds to wait for reads that are meant to time out.
+
+
+def StreamFrame(bumps):
+  """Return a stream frame of packet 7 (bumps and wheel drops)."""
+  data = chr(2) + chr(7) + chr(bumps)
+  checksum = -(pyrobot.STREAM_HEADER + sum(map(ord, data))) & 0xff
+  return chr(pyrobot.STREAM_HEADER) + data + chr(checksum)
+
+
+class SendTest(unittest.TestCase):
+
+  def setUp(self):
+    self.sim = simulator.SimulatedRobot()
+    self.robot = pyrobot.Create(simulator.LoopbackSerial(self.sim))
+    self.robot.Control()
+    self.robot.sci.EnableMetrics()
+
+  def tearDown(self):
+    self.robot.sci.StopWriter()
+
+  def testBytearrayMetrics(self):
+    self.robot.sci.Send(DRIVE)
+    commands = self.robot.sci.metrics.AsDict(self.robot.sci.opcodes)['commands']
+    self.assertEqual(1, commands['drive']['count'])
+    self.assertEqual(len(DRIVE), commands['drive']['bytes'])
+    self.assertEqual(200, self.sim.left_velocity)
+
+  def testBytearrayMetricsWithWriter(self):
+    self.robot.sci.StartWriter()
+    self.robot.sci.Send(DRIVE)
+    self.robot.sci.writer.Flush()
+    commands = self.robot.sci.metrics.AsDict(self.robot.sci.opcodes)['commands']
+    self.assertEqual(1, commands['drive']['count'])
+    self.assertEqual(200, self.sim.left_velocity)
+
+  def testLatchedBytearrayDriveIsDropped(self):
+    latch = object()
+    self.robot.sci.SendNow(bytearray(pyrobot.STOP_COMMAND), latch)
+    self.robot.sci.Send(DRIVE)
+    self.assertEqual(0, self.sim.left_velocity)
+    self.robot.sci.ReleaseDrives(latch)
+    self.robot.sci.Send(DRIVE)
+    self.assertEqual(200, self.sim.left_velocity)
+
+
+class SensorStreamTest(unittest.TestCase):
+
+  def setUp(self):
+    self.ser = simulator.LoopbackSerial(simulator.SimulatedRobot(), TIMEOUT)
+    self.robot = pyrobot.Create(self.ser)
+    self.robot.sci.EnableMetrics()
+    self.stream = pyrobot.SensorStream(self.robot, (7,))
+
+  def testResyncAfterStrayHeader(self):
+    self.ser._Receive(chr(pyrobot.STREAM_HEADER) + StreamFrame(0x02))
+    self.assertRaises(pyrobot.PyRobotError, self.stream.ReadFrame)
+    self.assertTrue(self.stream.ReadFrame()['bump-left'])
+    self.assertEqual(1, self.stream.frames)
+
+  def testChecksumFailure(self):
+    frame = StreamFrame(0x02)
+    bad_frame = frame[:-1] + chr((ord(frame[-1]) + 1) & 0xff)
+    self.ser._Receive(bad_frame + StreamFrame(0x01))
+    self.assertRaises(pyrobot.PyRobotError, self.stream.ReadFrame)
+    values = self.stream.ReadFrame()
+    self.assertFalse(values['bump-left'])
+    self.assertTrue(values['bump-right'])
+    self.assertEqual(1, self.robot.sci.metrics.resyncs)
+
+  def testPartialFrameIsKept(self):
+    frame = StreamFrame(0x02)
+    self.ser._Receive(frame[:2])
+    self.assertRaises(pyrobot.PyRobotError, self.stream.ReadFrame)
+    self.ser._Receive(frame[2:])
+    self.assertTrue(self.stream.ReadFrame()['bump-left'])
+    self.assertEqual(0, self.robot.sci.metrics.resyncs)
+
+  def testStopIsNotAnError(self):
+    self.robot.Control()
+    self.robot.StartStream((7,))
+    time.sleep(0.1)
+    stream = self.robot.stream
+    self.robot.StopStream()
+    self.assertTrue(stream.frames)
+    self.assertEqual(0, stream.errors)
+    self.assertEqual(pyrobot.LINK_OK, self.robot.sci.health.state)
+
+
+class StreamQueryTest(unittest.TestCase):
+
+  def setUp(self):
+    self.sim = simulator.SimulatedRobot()
+    self.robot = pyrobot.Create(simulator.LoopbackSerial(self.sim, TIMEOUT))
+    self.robot.Control()
+    self.robot.StartStream((7,))
+    time.sleep(0.1)  # Let the first frames arrive.
+
+  def tearDown(self):
+    self.robot.StopStream()
+
+  def testQueryFromStream(self):
+    self.assertEqual({'bump-left': False, 'bump-right': False},
+                     self.robot.sensors.Query(['bump-left', 'bump-right']))
+
+  def testQueryNotInStream(self):
+    self.assertRaises(pyrobot.PyRobotError, self.robot.sensors.Query,
+                      ['bump-left', 'voltage'])
+    self.assertRaises(pyrobot.PyRobotError, self.robot.sensors.StartQuery,
+                      ['voltage'])
+
+
+class RetryTest(unittest.TestCase):
+
+  def setUp(self):
+    self.sim = simulator.SimulatedRobot()
+    self.ser = simulator.LoopbackSerial(self.sim, TIMEOUT)
+    self.robot = pyrobot.Create(self.ser)
+    self.robot.Control()
+
+  def Truncate(self, count):
+    """Drop the last byte of the next 'count' responses."""
+    remaining = [count]
+    def Output(data):
+      if remaining[0]:
+        remaining[0] -= 1
+        data = data[:-1]
+      self.ser._Receive(data)
+    self.sim.output = Output
+
+  def testRetryAfterShortRead(self):
+    self.Truncate(1)
+    self.assertEqual({'voltage': 16000}, self.robot.sensors.Query(['voltage']))
+    health = self.robot.sci.health
+    self.assertEqual((1, 1), (health.failures, health.successes))
+
+  def testGiveUpAfterRetries(self):
+    self.Truncate(pyrobot.RETRIES + 1)
+    self.assertRaises(pyrobot.PyRobotError, self.robot.sensors.GetAll)
+    health = self.robot.sci.health
+    self.assertEqual(pyrobot.RETRIES + 1, health.consecutive_failures)
+    self.robot.sensors.GetAll()
+    self.assertEqual(0, health.consecutive_failures)
+
+
+
+class PipelineTest(unittest.TestCase):
+
+  def setUp(self):
+    self.sim = simulator.SimulatedRobot()
+    self.ser = simulator.LoopbackSerial(self.sim, TIMEOUT)
+    self.robot = pyrobot.Create(self.ser)
+    self.robot.Control()
+    self.held = None
+
+  def Hold(self):
+    """Hold back the robot's responses until Release."""
+    self.held = []
+    self.sim.output = self.held.append
+
+  def Release(self):
+    self.sim.output = self.ser._Receive
+    self.ser._Receive(''.join(self.held))
+
+  def Request(self, names):
+    unused_packet_ids, decoder, command = self.robot.sensors._GetQuery(names)
+    return self.robot.sci.Request(command, decoder.length)
+
+  def testResponsesInOrder(self):
+    first = self.robot.sensors.StartQuery(['bump-left'])
+    self.sim.SetBumps(True, False)
+    second = self.robot.sensors.StartQuery(['bump-left', 'voltage'])
+    self.sim.SetBumps(False, False)
+    third = self.robot.sensors.StartQuery(['bump-left'])
+    self.assertEqual({'bump-left': False}, third.Wait())
+    self.assertEqual({'bump-left': True, 'voltage': 16000}, second.Wait())
+    self.assertEqual({'bump-left': False}, first.Wait())
+
+  def testTimeoutFailsLaterResponses(self):
+    self.Hold()
+    first = self.Request(['voltage'])
+    second = self.Request(['bump-left'])
+    self.assertRaises(pyrobot.PyRobotError, second.Wait)
+    self.assertTrue(first.done)
+    self.assertRaises(pyrobot.PyRobotError, first.Wait)
+    # Late responses are flushed by the next request.
+    self.Release()
+    self.assertEqual({'voltage': 16000},
+                     self.robot.sensors.Query(['voltage']))
+
+  def testDriveWhileReading(self):
+    self.ser.timeout = 1
+    self.Hold()
+    query = self.robot.sensors.StartQuery(['voltage'])
+    values = []
+    thread = threading.Thread(target=lambda: values.append(query.Wait()))
+    thread.start()
+    time.sleep(0.05)  # Let the thread start reading.
+    self.assertTrue(self.robot.sci.rx_lock.locked())
+    start = time.time()
+    self.robot.DriveStraight(pyrobot.VELOCITY_SLOW)
+    self.assertTrue(time.time() - start < 0.05)
+    self.assertEqual(pyrobot.VELOCITY_SLOW, self.sim.left_velocity)
+    self.Release()
+    thread.join()
+    self.assertEqual([{'voltage': 16000}], values)
+
+
+if __name__ == '__main__':
+  unittest.main()
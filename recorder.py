@@ -0,0 +1,518 @@
+#!/usr/bin/python
+
+# The MIT License
+#
+# Copyright (c) 2007 Damon Kohler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Records serial traffic to and from the robot and replays it.
+
+A traffic log is a compact binary file of every string written to (TX) and
+read from (RX) the robot's serial port. It is laid out so that it can be
+mmapped and read in place:
+
+  [file header]
+  [chunk header][record][record]...
+  [chunk header][record][record]...
+  ...
+  [index][trailer]
+
+Each record is a header giving the length, direction and timestamp of the
+data that follows it. Records are buffered into chunks which are written
+whole, so a crash loses at most the last chunk. The index maps the time of
+the first record in each chunk to the chunk's offset and is written when the
+log is closed. Logs that were never closed are indexed by scanning their
+chunk headers instead.
+
+Only what the host actually read is recorded as RX, so a replay sees exactly
+the bytes the original run decoded.
+
+"""
+__author__ = "damonkohler@gmail.com (Damon Kohler)"
+
+import bisect
+import logging
+import mmap
+import optparse
+import struct
+import threading
+import time
+import pyrobot
+
+TX = 0
+RX = 1
+DIRECTIONS = {TX: 'TX', RX: 'RX'}
+
+FILE_MAGIC = 'PRTL'
+CHUNK_MAGIC = 'CHNK'
+INDEX_MAGIC = 'PRTI'
+VERSION = 1
+# Magic and version.
+FILE_HEADER = struct.Struct('<4sI')
+# Magic, length of the records, number of records, first and last timestamps.
+CHUNK_HEADER = struct.Struct('<4sIIdd')
+# Length of the data, direction and timestamp.
+RECORD_HEADER = struct.Struct('<HBd')
+# First timestamp and file offset of a chunk.
+INDEX_ENTRY = struct.Struct('<dQ')
+# Magic, offset of the index and number of chunks.
+TRAILER = struct.Struct('<4sQI')
+
+MAX_RECORD_LENGTH = 0xffff
+CHUNK_SIZE = 64 * 1024  # Bytes of records buffered before a chunk is written.
+FLUSH_PERIOD = 1  # Seconds of records buffered before a chunk is written.
+
+
+class TrafficLogWriter(object):
+
+  """Appends serial traffic to a traffic log.
+
+  Timestamps never go backwards, even if the system clock does, so that the
+  log can be searched by time.
+
+  """
+  def __init__(self, path, chunk_size=CHUNK_SIZE, flush_period=FLUSH_PERIOD):
+    self.path = path
+    self.chunk_size = chunk_size
+    self.flush_period = flush_period
+    self.records = 0  # Records appended.
+    self._file = open(path, 'wb')
+    self._file.write(FILE_HEADER.pack(FILE_MAGIC, VERSION))
+    self._lock = threading.Lock()
+    self._index = []  # (first timestamp, offset) of each chunk written.
+    self._chunk = []
+    self._chunk_length = 0
+    self._chunk_records = 0
+    self._first = None
+    self._last = 0
+
+  def Append(self, direction, data, timestamp=None):
+    """Append a record of 'data' sent in 'direction' (TX or RX)."""
+    if timestamp is None:
+      timestamp = time.time()
+    with self._lock:
+      timestamp = max(timestamp, self._last)
+      if self._first is None:
+        self._first = timestamp
+      self._last = timestamp
+      for offset in xrange(0, len(data), MAX_RECORD_LENGTH):
+        part = data[offset:offset + MAX_RECORD_LENGTH]
+        self._chunk.append(RECORD_HEADER.pack(len(part), direction, timestamp))
+        self._chunk.append(part)
+        self._chunk_length += RECORD_HEADER.size + len(part)
+        self._chunk_records += 1
+        self.records += 1
+      if (self._chunk_length >= self.chunk_size or
+          timestamp - self._first >= self.flush_period):
+        self._WriteChunk()
+
+  def _WriteChunk(self):
+    """Write out the buffered records. Must be called holding the lock."""
+    if not self._chunk:
+      return
+    self._index.append((self._first, self._file.tell()))
+    self._file.write(CHUNK_HEADER.pack(CHUNK_MAGIC, self._chunk_length,
+                                       self._chunk_records, self._first,
+                                       self._last))
+    self._file.write(''.join(self._chunk))
+    self._file.flush()
+    self._chunk = []
+    self._chunk_length = 0
+    self._chunk_records = 0
+    self._first = None
+
+  def Flush(self):
+    """Write out any buffered records."""
+    with self._lock:
+      self._WriteChunk()
+
+  def Close(self):
+    """Write out any buffered records and the index and close the log."""
+    with self._lock:
+      if self._file.closed:
+        return
+      self._WriteChunk()
+      offset = self._file.tell()
+      for entry in self._index:
+        self._file.write(INDEX_ENTRY.pack(*entry))
+      self._file.write(TRAILER.pack(INDEX_MAGIC, offset, len(self._index)))
+      self._file.close()
+
+
+class RecordingSerial(object):
+
+  """Wraps a serial port and records everything written to and read from it.
+
+  Everything else is passed through to the wrapped port.
+
+  """
+  def __init__(self, ser, log):
+    object.__setattr__(self, 'ser', ser)
+    object.__setattr__(self, 'log', log)
+
+  def __getattr__(self, name):
+    return getattr(self.ser, name)
+
+  def __setattr__(self, name, value):
+    setattr(self.ser, name, value)  # E.g. baudrate when reopening.
+
+  def write(self, data):
+    # Log before writing so that the request is always recorded ahead of the
+    # response that a reader on another thread may log.
+    self.log.Append(TX, str(data))
+    return self.ser.write(data)
+
+  def read(self, size=1):
+    data = self.ser.read(size)
+    if data:
+      self.log.Append(RX, data)
+    return data
+
+
+def Record(sci, path):
+  """Record the traffic of SerialCommandInterface 'sci' to the log 'path'.
+
+  Returns the TrafficLogWriter, which should be closed when done.
+
+  """
+  log = TrafficLogWriter(path)
+  sci.ser = RecordingSerial(sci.ser, log)
+  logging.info('Recording serial traffic to %s.' % path)
+  return log
+
+
+class TrafficLogReader(object):
+
+  """Reads a traffic log in place through mmap."""
+
+  def __init__(self, path):
+    self.path = path
+    self._file = open(path, 'rb')
+    self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(self._map) < FILE_HEADER.size:
+      raise pyrobot.PyRobotError('%s is not a traffic log.' % path)
+    magic, version = FILE_HEADER.unpack_from(self._map)
+    if magic != FILE_MAGIC:
+      raise pyrobot.PyRobotError('%s is not a traffic log.' % path)
+    if version != VERSION:
+      raise pyrobot.PyRobotError('Unsupported traffic log version %d.' %
+                                 version)
+    self.offsets = []  # File offset of each chunk.
+    self.times = []  # Timestamp of the first record in each chunk.
+    if not self._ReadIndex():
+      logging.info('Indexing unclosed traffic log %s.' % path)
+      self._ScanChunks()
+
+  def _ReadIndex(self):
+    """Load the index written when the log was closed, if there is one."""
+    if len(self._map) < FILE_HEADER.size + TRAILER.size:
+      return False
+    magic, offset, count = TRAILER.unpack_from(self._map,
+                                               len(self._map) - TRAILER.size)
+    if magic != INDEX_MAGIC:
+      return False
+    for i in xrange(count):
+      timestamp, chunk = INDEX_ENTRY.unpack_from(
+          self._map, offset + i * INDEX_ENTRY.size)
+      self.times.append(timestamp)
+      self.offsets.append(chunk)
+    return True
+
+  def _ScanChunks(self):
+    """Index the log by walking its chunk headers."""
+    offset = FILE_HEADER.size
+    while offset + CHUNK_HEADER.size <= len(self._map):
+      magic, length, unused_records, first, unused_last = (
+          CHUNK_HEADER.unpack_from(self._map, offset))
+      end = offset + CHUNK_HEADER.size + length
+      if magic != CHUNK_MAGIC or end > len(self._map):
+        break  # A partly written chunk.
+      self.times.append(first)
+      self.offsets.append(offset)
+      offset = end
+
+  def Close(self):
+    self._map.close()
+    self._file.close()
+
+  @property
+  def start_time(self):
+    """The timestamp of the first record, or None if the log is empty."""
+    if self.times:
+      return self.times[0]
+
+  @property
+  def end_time(self):
+    """The timestamp of the last record, or None if the log is empty."""
+    if self.offsets:
+      return CHUNK_HEADER.unpack_from(self._map, self.offsets[-1])[4]
+
+  def __len__(self):
+    return sum([CHUNK_HEADER.unpack_from(self._map, offset)[2]
+                for offset in self.offsets])
+
+  def Seek(self, timestamp):
+    """Return the number of the chunk holding the first record at or after
+    'timestamp'.
+
+    """
+    return max(0, bisect.bisect_right(self.times, timestamp) - 1)
+
+  def Records(self, start=None, end=None):
+    """Yield (timestamp, direction, data) for records from 'start' until
+    'end'.
+
+    """
+    first = 0
+    if start is not None:
+      first = self.Seek(start)
+    for offset in self.offsets[first:]:
+      unused_magic, length, records, unused_first, unused_last = (
+          CHUNK_HEADER.unpack_from(self._map, offset))
+      offset += CHUNK_HEADER.size
+      for i in xrange(records):
+        size, direction, timestamp = RECORD_HEADER.unpack_from(self._map,
+                                                               offset)
+        offset += RECORD_HEADER.size
+        if end is not None and timestamp > end:
+          return
+        if start is None or timestamp >= start:
+          yield timestamp, direction, self._map[offset:offset + size]
+        offset += size
+
+
+class ReplaySerial(object):
+
+  """A serial port for a replayed robot that keeps whatever is written to it.
+
+  Nothing is ever read from it, since the Replayer decodes the recorded
+  responses itself.
+
+  """
+  def __init__(self):
+    self.baudrate = pyrobot.DEFAULT_BAUD_RATE
+    self.timeout = pyrobot.SERIAL_TIMEOUT
+    self.sent = []  # (timestamp, data) for every write.
+
+  def isOpen(self):
+    return True
+
+  def open(self):
+    pass
+
+  def close(self):
+    pass
+
+  def flush(self):
+    pass
+
+  def setRTS(self, level):
+    pass
+
+  def write(self, data):
+    self.sent.append((time.time(), str(data)))
+    return len(data)
+
+  def read(self, size=1):
+    return ''
+
+  def inWaiting(self):
+    return 0
+
+  def flushInput(self):
+    pass
+
+
+class Replayer(object):
+
+  """Feeds a recorded session back through a robot's sensor decoding.
+
+  The recorded requests (sensors, query_list, stream, etc.) tell the
+  Replayer how to decode the recorded responses, which are then published to
+  'robot'.sensors just as they were during the run. Subscriptions, reflexes
+  and odometry on 'robot' see every reading. Whatever they send is kept by
+  the robot's serial port, normally a ReplaySerial.
+
+  If 'speed' is given, records are replayed at that multiple of the original
+  speed (1 for wall clock speed). Otherwise they are replayed as fast as
+  possible.
+
+  """
+  def __init__(self, log, robot, speed=None):
+    self.log = log
+    self.robot = robot
+    self.speed = speed
+    self.records = 0  # Records replayed.
+    self.decoded = 0  # Responses and stream frames decoded.
+    self.errors = 0  # Responses and stream frames that failed to decode.
+    self._queries = {}  # Maps query_list packet IDs to decoders.
+    self._opcodes = dict([(opcode, name) for name, opcode in
+                          pyrobot.ROOMBA_OPCODES.items() +
+                          pyrobot.CREATE_OPCODES.items()])
+    self._transmitted = ''  # The start of a command split across records.
+    self._Expect(None)
+
+  def _Expect(self, decode, length=0):
+    """Decode the next 'length' bytes received with 'decode'."""
+    self._decode = decode
+    self._length = length
+    self._buffer = ''  # A new request flushes stale input.
+
+  def _OnTransmit(self, data):
+    """Work out how the responses to the commands in 'data' are decoded.
+
+    A record may hold several commands (e.g. a script upload followed by
+    play_script) or only part of one.
+
+    """
+    self._transmitted += data
+    for name, args, self._transmitted in pyrobot.ParseCommands(
+        self._transmitted, self._opcodes):
+      self._OnCommand(name, args)
+
+  def _OnCommand(self, name, args):
+    if name == 'sensors':
+      decoder = pyrobot.SENSOR_PACKET_DECODERS.get(args[0])
+      if decoder is not None:
+        self._Expect(self._DecodeResponse, decoder.length)
+        self._decoder = decoder
+    elif name == 'query_list':
+      packet_ids = tuple(args[1:1 + args[0]])
+      decoder = self._queries.get(packet_ids)
+      if decoder is None:
+        fields = []
+        for packet_id in packet_ids:
+          fields.extend(pyrobot.SENSOR_PACKET_DECODERS[packet_id].fields)
+        decoder = self._queries[packet_ids] = pyrobot.SensorGroupDecoder(
+            fields)
+      self._Expect(self._DecodeResponse, decoder.length)
+      self._decoder = decoder
+    elif name == 'stream':
+      self._stream = pyrobot.SensorStream(self.robot, args[1:1 + args[0]])
+      self._Expect(self._DecodeFrame, self._stream.length + 3)
+    elif name == 'pause_resume_stream':
+      if not args[0]:
+        self._Expect(None)
+    elif name == 'show_script':
+      self._Expect(None)  # The script itself isn't sensor data.
+
+  def _DecodeResponse(self, data):
+    self.robot.sensors._Publish(self._decoder.Decode(data))
+    self._Expect(None)
+
+  def _DecodeFrame(self, data):
+    """Decode a stream frame, resynchronizing on its header if needed."""
+    if ord(data[0]) != pyrobot.STREAM_HEADER:
+      data += self._buffer
+      header = data.find(chr(pyrobot.STREAM_HEADER), 1)
+      if header == -1:
+        self._buffer = ''
+      else:
+        self._buffer = data[header:]
+      raise pyrobot.PyRobotError('Lost sync with the sensor stream.')
+    self._stream.DecodeFrame(data[1], data[2:])
+
+  def _OnReceive(self, data):
+    """Decode whatever complete responses have been received."""
+    self._buffer += data
+    while self._decode is not None and len(self._buffer) >= self._length:
+      response = self._buffer[:self._length]
+      self._buffer = self._buffer[self._length:]
+      try:
+        self._decode(response)
+      except (pyrobot.PyRobotError, KeyError), e:
+        self.errors += 1
+        logging.debug('Failed to decode replayed response: %s' % e)
+      else:
+        self.decoded += 1
+
+  def Run(self, start=None, end=None):
+    """Replay the records from 'start' until 'end'."""
+    started = time.time()
+    first = None
+    for timestamp, direction, data in self.log.Records(start, end):
+      if first is None:
+        first = timestamp
+      if self.speed:
+        delay = (timestamp - first) / self.speed - (time.time() - started)
+        if delay > 0:
+          time.sleep(delay)
+      if direction == TX:
+        self._OnTransmit(data)
+      else:
+        self._OnReceive(data)
+      self.records += 1
+
+
+def ReplayRobot(model='create'):
+  """Return a robot whose commands go to a ReplaySerial."""
+  if model == 'create':
+    return pyrobot.Create(ReplaySerial())
+  return pyrobot.Roomba(ReplaySerial())
+
+
+def main():
+  parser = optparse.OptionParser(usage='%prog [options] LOG')
+  parser.add_option('--model', default='create',
+                    help='Robot that was recorded, roomba or create.')
+  parser.add_option('--speed', type='float', default=None,
+                    help='Replay at this multiple of wall clock speed '
+                    'instead of as fast as possible.')
+  parser.add_option('--start', type='float', default=None,
+                    help='Replay from this many seconds into the log.')
+  parser.add_option('--end', type='float', default=None,
+                    help='Replay until this many seconds into the log.')
+  parser.add_option('--fido', action='store_true', default=False,
+                    help='Run the replay through Fido\'s reflexes.')
+  parser.add_option('--dump', action='store_true', default=False,
+                    help='Print the records instead of replaying them.')
+  options, args = parser.parse_args()
+  if len(args) != 1:
+    parser.error('Expected a traffic log.')
+  logging.basicConfig(level=logging.INFO)
+  log = TrafficLogReader(args[0])
+  start = end = None
+  if options.start is not None:
+    start = log.start_time + options.start
+  if options.end is not None:
+    end = log.start_time + options.end
+  if options.dump:
+    for timestamp, direction, data in log.Records(start, end):
+      print '%.6f %s %s' % (timestamp - log.start_time, DIRECTIONS[direction],
+                            ' '.join(['%02x' % ord(c) for c in data]))
+    return
+  robot = ReplayRobot(options.model)
+  if options.fido:
+    import fido  # Requires the OLPC's gst module.
+    fido.ConfigureRobot(robot)
+  replayer = Replayer(log, robot, options.speed)
+  started = time.time()
+  replayer.Run(start, end)
+  elapsed = time.time() - started
+  print 'Replayed %d records in %.3fs (%d decoded, %d errors).' % (
+      replayer.records, elapsed, replayer.decoded, replayer.errors)
+  if elapsed:
+    print '%.0f records/s, %.0f decoded/s.' % (replayer.records / elapsed,
+                                               replayer.decoded / elapsed)
+  print 'Robot sent %d commands.' % len(robot.sci.ser.sent)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,547 @@
+#!/usr/bin/python
+
+# The MIT License
+#
+# Copyright (c) 2007 Damon Kohler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from __future__ import with_statement
+
+"""A simulated Roomba/Create that speaks SCI/OI over a pseudo-terminal.
+
+The simulator opens a PTY and prints the name of its slave device. Point
+pyrobot.Roomba or pyrobot.Create at that device to run without a robot:
+
+  $ ./simulator.py --model=create --latency=0.005 --noise=0.001
+  Simulating a create on /dev/pts/5.
+
+  >>> robot = pyrobot.Create('/dev/pts/5')
+
+For benchmarks and tests a LoopbackSerial connects a robot to a simulated
+robot in memory without a PTY:
+
+  >>> robot = pyrobot.Create(LoopbackSerial(SimulatedRobot()))
+
+The simulated robot keeps track of its mode, wheel velocities and odometry,
+and of bump, cliff and wall sensors that can be set by the caller. It answers
+sensors, query_list and stream requests with correctly sized packets.
+
+"""
+__author__ = "damonkohler@gmail.com (Damon Kohler)"
+
+import logging
+import math
+import optparse
+import os
+import random
+import select
+import struct
+import termios
+import threading
+import time
+import tty
+import pyrobot
+
+# The single packets that make up each sensor group.
+SENSOR_GROUP_PACKETS = {
+    0: range(7, 27),
+    1: range(7, 17),
+    2: range(17, 21),
+    3: range(21, 27),
+    4: range(27, 35),
+    5: range(35, 43),
+    6: range(7, 43),
+    }
+
+# Raw (wire format) values of the sensors when the simulator starts.
+INITIAL_SENSOR_VALUES = {
+    'remote-opcode': 255,  # none
+    'voltage': 16000,
+    'temperature': 25,
+    'charge': 2700,
+    'capacity': 2700,
+    }
+
+SHORT_MIN = -32768
+SHORT_MAX = 32767
+
+
+def _Clamp(value, minimum=SHORT_MIN, maximum=SHORT_MAX):
+  return max(minimum, min(maximum, int(value)))
+
+
+class SimulatedRobot(object):
+
+  """The state and command interpreter of a simulated Roomba or Create.
+
+  Bytes received from the host are passed to Receive. Anything the robot has
+  to say is passed to the 'output' callable, which is set by the transport.
+
+  """
+  def __init__(self, model='create', latency=0, noise=0, arena=None,
+               seed=None):
+    if model not in ('roomba', 'create'):
+      raise ValueError('Unknown robot model %r.' % model)
+    self.model = model
+    self.latency = latency  # Seconds to wait before each response.
+    self.noise = noise  # Probability that each byte sent is corrupted.
+    self.arena = arena  # (width, height) in mm of the walls around the robot.
+    self.output = None
+    self.opcodes = dict([(v, k) for k, v in pyrobot.ROOMBA_OPCODES.items()])
+    self.packet_ids = range(4)  # Sensor packets the robot can send.
+    if model == 'create':
+      self.opcodes.update(
+          dict([(v, k) for k, v in pyrobot.CREATE_OPCODES.items()]))
+      self.packet_ids = pyrobot.SENSOR_PACKET_DECODERS.keys()
+    self.mode = 'off'
+    self.baud_code = pyrobot.BAUD_RATES.index(pyrobot.DEFAULT_BAUD_RATE)
+    self.left_velocity = 0  # mm/s
+    self.right_velocity = 0  # mm/s
+    self.x = 0.0  # mm
+    self.y = 0.0  # mm
+    self.theta = 0.0  # radians
+    self.raw = {}
+    for name, unused_format, unused_decode in (
+        pyrobot.SENSOR_GROUP_PACKET_6_FIELDS):
+      self.raw[name] = INITIAL_SENSOR_VALUES.get(name, 0)
+    self.commands = 0  # Number of commands executed.
+    self.script = ''
+    self.stream_packet_ids = ()
+    self._streaming = False
+    self._distance = 0.0  # Distance traveled since last requested.
+    self._angle = 0.0  # Wheel difference since the angle was last requested.
+    self._last_update = time.time()
+    self._buffer = ''
+    self._random = random.Random(seed)
+    self._lock = threading.RLock()
+    self._output_lock = threading.Lock()
+    self._stream_thread = None
+
+  def Receive(self, data):
+    """Interpret bytes sent by the host."""
+    with self._lock:
+      self._buffer += data
+      for name, arguments, self._buffer in self._ParseCommands(self._buffer):
+        self._Execute(name, arguments)
+
+  def _ParseCommands(self, data):
+    """Yield (name, arguments, remaining data) for each command in 'data'."""
+    return pyrobot.ParseCommands(data, self.opcodes)
+
+  def _Execute(self, name, arguments):
+    """Execute a single command."""
+    logging.debug('Simulating %s%r.' % (name, tuple(arguments)))
+    self.commands += 1
+    self._Update()
+    if name == 'start':
+      self.mode = 'passive'
+    elif name == 'baud':
+      self.baud_code = arguments[0]
+      self.mode = 'passive'
+    elif name == 'control' or name == 'safe':
+      self.mode = 'safe'
+    elif name == 'full':
+      self.mode = 'full'
+    elif name in ('power', 'soft_reset'):
+      self.mode = 'off'
+      self.baud_code = pyrobot.BAUD_RATES.index(pyrobot.DEFAULT_BAUD_RATE)
+      self._StopStream()
+      self._SetWheels(0, 0)
+    elif name in ('spot', 'clean', 'max', 'force_seeking_dock'):
+      self.mode = 'passive'
+    elif name == 'drive':
+      velocity, radius = struct.unpack('>hh', ''.join(map(chr, arguments)))
+      self.Drive(velocity, radius)
+    elif name == 'direct_drive':
+      right, left = struct.unpack('>hh', ''.join(map(chr, arguments)))
+      self.DirectDrive(right, left)
+    elif name == 'sensors':
+      self._Send(self.EncodePackets([arguments[0]]))
+    elif name == 'query_list':
+      self._Send(self.EncodePackets(arguments[1:]))
+    elif name == 'stream':
+      self._StartStream(arguments[1:])
+    elif name == 'pause_resume_stream':
+      if arguments[0]:
+        self._StartStream(self.stream_packet_ids)
+      else:
+        self._StopStream()
+    elif name == 'script':
+      self.script = ''.join(map(chr, arguments[1:]))
+    elif name == 'show_script':
+      self._Send(chr(len(self.script)) + self.script)
+    elif name == 'play_script':
+      thread = threading.Thread(target=self._PlayScript, args=(self.script,))
+      thread.setDaemon(True)
+      thread.start()
+
+  def _Update(self):
+    """Integrate the robot's motion since the last update."""
+    now = time.time()
+    dt = now - self._last_update
+    self._last_update = now
+    if self.mode not in ('safe', 'full'):
+      return
+    left = self.left_velocity * dt
+    right = self.right_velocity * dt
+    distance = (left + right) / 2.0
+    self.theta += (right - left) / pyrobot.WHEEL_SEPARATION
+    self.x += distance * math.cos(self.theta)
+    self.y += distance * math.sin(self.theta)
+    self._distance += distance
+    self._angle += (right - left) / 2.0
+    if self.arena is not None:
+      self._CheckArena()
+    if self.mode == 'safe' and self._SafetyFault():
+      # Safe mode stops the robot and drops to passive mode on a cliff or
+      # wheel drop.
+      self._SetWheels(0, 0)
+      self.mode = 'passive'
+
+  def _CheckArena(self):
+    """Stop at the arena walls and trip the bumpers."""
+    width, height = self.arena
+    x = max(-width / 2.0, min(width / 2.0, self.x))
+    y = max(-height / 2.0, min(height / 2.0, self.y))
+    bumped = (x, y) != (self.x, self.y)
+    self.x, self.y = x, y
+    self.SetBumps(bumped, bumped)
+
+  def _SafetyFault(self):
+    return (self.raw['bumps-wheeldrops'] & 0x1c or
+            self.raw['cliff-left'] or self.raw['cliff-front-left'] or
+            self.raw['cliff-front-right'] or self.raw['cliff-right'])
+
+  def _SetWheels(self, left, right):
+    self.left_velocity = left
+    self.right_velocity = right
+    self.raw['left-velocity'] = _Clamp(left)
+    self.raw['right-velocity'] = _Clamp(right)
+
+  def Drive(self, velocity, radius):
+    """Set the wheel velocities from a drive command."""
+    if self.mode not in ('safe', 'full'):
+      return
+    self.raw['velocity'] = velocity
+    self.raw['radius'] = radius
+    if radius in (-32768, 32767, 0):  # Stop sends a radius of 0.
+      self._SetWheels(velocity, velocity)
+    elif radius == pyrobot.RADIUS_TURN_IN_PLACE_CW:
+      self._SetWheels(velocity, -velocity)
+    elif radius == pyrobot.RADIUS_TURN_IN_PLACE_CCW:
+      self._SetWheels(-velocity, velocity)
+    else:
+      half = pyrobot.WHEEL_SEPARATION / 2.0
+      self._SetWheels(velocity * (radius - half) / radius,
+                      velocity * (radius + half) / radius)
+
+  def DirectDrive(self, right, left):
+    """Set the wheel velocities from a direct_drive command."""
+    if self.mode not in ('safe', 'full'):
+      return
+    self._SetWheels(left, right)
+
+  def _SetBits(self, field, bits):
+    """Set or clear the bits of a raw bitfield sensor.
+
+    'bits' maps masks to bools.
+
+    """
+    for mask, value in bits.items():
+      if value:
+        self.raw[field] |= mask
+      else:
+        self.raw[field] &= ~mask
+
+  def SetBumps(self, left, right):
+    with self._lock:
+      self._SetBits('bumps-wheeldrops', {0x02: left, 0x01: right})
+
+  def SetWheelDrops(self, left, right, caster=False):
+    with self._lock:
+      self._SetBits('bumps-wheeldrops',
+                    {0x08: left, 0x04: right, 0x10: caster})
+
+  def SetCliffs(self, left=False, front_left=False, front_right=False,
+                right=False):
+    with self._lock:
+      for name, value in (('cliff-left', left),
+                          ('cliff-front-left', front_left),
+                          ('cliff-front-right', front_right),
+                          ('cliff-right', right)):
+        self.raw[name] = int(value)
+        self.raw[name + '-signal'] = value and 100 or 2000
+
+  def SetWall(self, wall, virtual_wall=False):
+    with self._lock:
+      self.raw['wall'] = int(wall)
+      self.raw['wall-signal'] = wall and 200 or 0
+      self.raw['virtual-wall'] = int(virtual_wall)
+
+  def EncodePackets(self, packet_ids):
+    """Return the raw sensor data for 'packet_ids' as a string."""
+    packet_ids = [i for i in packet_ids if i in self.packet_ids]
+    with self._lock:
+      self._Update()
+      self.raw['oi-mode'] = pyrobot.OI_MODES.index(self.mode)
+      self.raw['number-of-stream-packets'] = len(self.stream_packet_ids)
+      single_ids = []
+      for packet_id in packet_ids:
+        single_ids.extend(SENSOR_GROUP_PACKETS.get(packet_id, [packet_id]))
+      # Like the wheel encoders, only whole units are reported and the
+      # remainder carries over to the next reading.
+      if 19 in single_ids:
+        self.raw['distance'] = _Clamp(self._distance)
+        self._distance -= self.raw['distance']
+      if 20 in single_ids:
+        if self.model == 'create':
+          scale = math.degrees(2.0 / pyrobot.WHEEL_SEPARATION)
+        else:
+          scale = 1.0
+        self.raw['angle'] = _Clamp(self._angle * scale)
+        self._angle -= self.raw['angle'] / scale
+      # Group packets are just their single packets one after the other.
+      return ''.join([self._EncodePacket(i) for i in single_ids])
+
+  def _EncodePacket(self, packet_id):
+    decoder = pyrobot.SENSOR_PACKET_DECODERS[packet_id]
+    return decoder.struct.pack(
+        *[self.raw[name] for name, unused_format, unused_decode
+          in decoder.fields])
+
+  def _StartStream(self, packet_ids):
+    self.stream_packet_ids = tuple(packet_ids)
+    if not self._streaming:
+      self._streaming = True
+      self._stream_thread = threading.Thread(target=self._Stream)
+      self._stream_thread.setDaemon(True)
+      self._stream_thread.start()
+
+  def _StopStream(self):
+    self._streaming = False
+
+  def _Stream(self):
+    """Send a stream frame every 15ms until the stream is stopped."""
+    next_frame = time.time()
+    while self._streaming:
+      body = []
+      for packet_id in self.stream_packet_ids:
+        body.append(chr(packet_id) + self.EncodePackets([packet_id]))
+      body = ''.join(body)
+      frame = chr(pyrobot.STREAM_HEADER) + chr(len(body)) + body
+      frame += chr(-sum(map(ord, frame)) & 0xff)
+      self._Send(frame)
+      next_frame += pyrobot.STREAM_PERIOD
+      time.sleep(max(0, next_frame - time.time()))
+
+  def _PlayScript(self, script):
+    """Execute the commands in 'script', honoring the wait commands."""
+    for name, arguments, unused_rest in self._ParseCommands(script):
+      if name == 'wait_time':
+        time.sleep(arguments[0] / 10.0)
+      elif name == 'wait_distance':
+        self._WaitFor(lambda start: abs(self.x - start[0]) +
+                      abs(self.y - start[1]) >= abs(self._Short(arguments)))
+      elif name == 'wait_angle':
+        self._WaitFor(lambda start: abs(math.degrees(self.theta - start[2])) >=
+                      abs(self._Short(arguments)))
+      elif name == 'wait_event':
+        pass  # Events are not simulated.
+      else:
+        with self._lock:
+          self._Execute(name, arguments)
+
+  def _Short(self, arguments):
+    return struct.unpack('>h', ''.join(map(chr, arguments)))[0]
+
+  def _WaitFor(self, Done):
+    start = (self.x, self.y, self.theta)
+    while True:
+      with self._lock:
+        self._Update()
+        if Done(start) or not (self.left_velocity or self.right_velocity):
+          return
+      time.sleep(0.005)
+
+  def _Send(self, data):
+    """Pass 'data' to the output after applying latency and line noise."""
+    if self.latency:
+      time.sleep(self.latency)
+    if self.noise:
+      data = ''.join([self._Corrupt(c) for c in data])
+    with self._output_lock:
+      if self.output is not None:
+        self.output(data)
+
+  def _Corrupt(self, byte):
+    if self._random.random() < self.noise:
+      return chr(self._random.randint(0, 255))
+    return byte
+
+
+class LoopbackSerial(object):
+
+  """An in-memory serial port connected to a SimulatedRobot.
+
+  Can be passed as the tty of pyrobot.Roomba or pyrobot.Create. Responses to
+  requests are available as soon as the write returns.
+
+  """
+  def __init__(self, robot, timeout=pyrobot.SERIAL_TIMEOUT):
+    self.robot = robot
+    self.robot.output = self._Receive
+    self.timeout = timeout
+    self.baudrate = 57600
+    self._buffer = ''
+    self._ready = threading.Condition()
+
+  def _Receive(self, data):
+    with self._ready:
+      self._buffer += data
+      self._ready.notifyAll()
+
+  def isOpen(self):
+    return True
+
+  def open(self):
+    pass
+
+  def close(self):
+    pass
+
+  def flush(self):
+    pass
+
+  def setRTS(self, level):
+    pass
+
+  def write(self, data):
+    self.robot.Receive(str(data))
+    return len(data)
+
+  def read(self, size=1):
+    deadline = time.time() + self.timeout
+    with self._ready:
+      while len(self._buffer) < size and time.time() < deadline:
+        self._ready.wait(deadline - time.time())
+      data = self._buffer[:size]
+      self._buffer = self._buffer[size:]
+    return data
+
+  def inWaiting(self):
+    return len(self._buffer)
+
+  def flushInput(self):
+    with self._ready:
+      self._buffer = ''
+
+
+class PtySimulator(object):
+
+  """Serves a SimulatedRobot on a pseudo-terminal."""
+
+  def __init__(self, robot):
+    self.robot = robot
+    self.master, self._slave = os.openpty()
+    # Keep the slave open so that reads from the master do not fail between
+    # clients, and make it raw so nothing is echoed back to the robot.
+    tty.setraw(self._slave)
+    self.tty = os.ttyname(self._slave)
+    self.robot.output = self._Write
+    self._host_speed = self._HostSpeed()  # As of the last read.
+    self._join = False
+    self._thread = None
+
+  def _HostSpeed(self):
+    """Return the termios speed the host has set on the port."""
+    return termios.tcgetattr(self.master)[5]
+
+  def _RobotSpeed(self):
+    """Return the termios speed matching the robot's baud rate."""
+    return getattr(
+        termios, 'B%d' % pyrobot.BAUD_RATES[self.robot.baud_code], None)
+
+  def _Write(self, data):
+    if self._HostSpeed() != self._RobotSpeed():
+      return  # The host would only see garbage.
+    while data:
+      data = data[os.write(self.master, data):]
+
+  def _Loop(self):
+    while not self._join:
+      ready, unused_w, unused_x = select.select([self.master], [], [], 0.1)
+      speed = self._HostSpeed()
+      if ready:
+        data = os.read(self.master, 1024)
+        # The host may have changed speed after writing the data (e.g. right
+        # after sending a baud command), so data sent at the speed seen
+        # before it was read is accepted too.
+        if self._RobotSpeed() in (speed, self._host_speed):
+          self.robot.Receive(data)
+        else:
+          logging.debug('Ignoring %d bytes sent at the wrong baud rate.' %
+                        len(data))
+      self._host_speed = speed
+
+  def Start(self):
+    """Start serving the robot in a background thread."""
+    self._join = False
+    self._thread = threading.Thread(target=self._Loop)
+    self._thread.setDaemon(True)
+    self._thread.start()
+
+  def Stop(self):
+    """Stop serving and close the pseudo-terminal."""
+    self._join = True
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+    os.close(self.master)
+    os.close(self._slave)
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('--model', default='create',
+                    help='Robot to simulate, roomba or create.')
+  parser.add_option('--latency', type='float', default=0,
+                    help='Seconds to wait before each response.')
+  parser.add_option('--noise', type='float', default=0,
+                    help='Probability that each byte sent is corrupted.')
+  parser.add_option('--arena', type='int', default=None,
+                    help='Size in mm of a square arena around the robot.')
+  options, unused_args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO)
+  arena = None
+  if options.arena:
+    arena = (options.arena, options.arena)
+  robot = SimulatedRobot(options.model, options.latency, options.noise, arena)
+  simulator = PtySimulator(robot)
+  print 'Simulating a %s on %s.' % (options.model, simulator.tty)
+  simulator.Start()
+  try:
+    while True:
+      time.sleep(1)
+  except KeyboardInterrupt:
+    simulator.Stop()
+
+
+if __name__ == '__main__':
+  main()
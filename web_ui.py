@@ -72,8 +72,9 @@ class FidoWeb(gsd.App):
 
   """Control and monitor the Robot through a web interface."""
 
-  def __init__(self, arduino_tty='/dev/ttyUSB0', robot_tty='/dev/ttyUSB1'):
-    self._fido = fido.Fido(arduino_tty, robot_tty)
+  def __init__(self, arduino_tty='/dev/ttyUSB0', robot_tty='/dev/ttyUSB1',
+               traffic_log=None):
+    self._fido = fido.Fido(arduino_tty, robot_tty, traffic_log)
     self._motion = motion.MotionController('localhost', 8082)
     self._lock = threading.Lock()
     self._comet_queues = {}
@@ -126,13 +127,63 @@ class FidoWeb(gsd.App):
     """Turn in place to the right."""
     self._fido.Right()
 
+  def POST_teleop(self, handler):
+    """Drive from the setpoints in the body of this request.
+
+    The body holds one JSON object per line, either {"left": mm/s, "right":
+    mm/s} or {"velocity": mm/s, "radius": mm}. The web UI posts each
+    setpoint as its own request. Other clients may leave out the
+    Content-Length and keep writing setpoints until they close their side of
+    the connection. The robot stops if no setpoint arrives for
+    fido.TELEOP_DEADMAN seconds. Returns a JSON object with the teleop
+    counters.
+
+    """
+    self._fido.CancelDocking()
+    length = handler.headers.getheader('content-length')
+    if length is None:
+      logging.info('Teleoperating for %s.' % handler.client_address[0])
+      body = handler.rfile
+    else:
+      body = StringIO.StringIO(handler.rfile.read(int(length)))
+    try:
+      count = self._fido.teleop.Follow(body)
+    except ValueError, e:
+      handler.Render('400 Bad setpoint: %s' % e, response=400)
+    else:
+      if length is None:
+        logging.info('Teleop ended after %d setpoints.' % count)
+      handler.wfile.write(simplejson.dumps(self._fido.teleop.Status()))
+
   def GET_undock(self, handler):
     """Backup out of dock."""
     self._fido.Undock()
 
   def GET_dock(self, handler):
-    """Start docking procedures."""
-    self._fido.Dock()
+    """Start docking procedures and return a JSON object with their status.
+
+    Docking carries on in the background. Its state transitions are sent to
+    comet clients and any other motion command cancels it.
+
+    """
+    docking = self._fido.Dock(self._OnDockingState)
+    handler.wfile.write(simplejson.dumps(docking.Status()))
+
+  def _OnDockingState(self, docking, state):
+    with self._lock:
+      for queue in self._comet_queues.values():
+        queue.put(('docking', state))
+
+  def GET_docking(self, handler):
+    """Return a JSON object with the status of the last docking attempt."""
+    status = None
+    if self._fido.docking is not None:
+      status = self._fido.docking.Status()
+    handler.wfile.write(simplejson.dumps(status))
+
+  def GET_cancel_docking(self, handler):
+    """Stop docking."""
+    self._fido.CancelDocking()
 
   def GET_restart(self, handler):
     """Restart systems in an emergency to get control of the robot."""
@@ -142,6 +193,67 @@ class FidoWeb(gsd.App):
     """Return a JSON object with various sensor data."""
     handler.wfile.write(simplejson.dumps(self._fido.sensors.data))
 
+  def GET_reflexes(self, handler):
+    """Return a JSON object with the latency histogram of each reflex."""
+    reflexes = dict([(reflex.name, reflex.latency.AsDict())
+                     for reflex in self._fido.robot.reflexes])
+    handler.wfile.write(simplejson.dumps(reflexes))
+
+  def GET_metrics(self, handler):
+    """Return a JSON object with link health, serial, command queue, stream,
+    motion, teleop and service metrics.
+
+    """
+    robot = self._fido.robot
+    metrics = {'link': robot.sci.health.AsDict(), 'serial': None,
+               'writer': None, 'stream': None,
+               'motion': self._fido.motion.Status(),
+               'teleop': self._fido.teleop.Status(),
+               'services': self._fido.scheduler.Status()}
+    if robot.sci.metrics is not None:
+      metrics['serial'] = robot.sci.metrics.AsDict(robot.sci.opcodes)
+    writer = robot.sci.writer
+    if writer is not None:
+      metrics['writer'] = {'sent': writer.sent, 'dropped': writer.dropped,
+                           'queue_depth': writer.queue_depth,
+                           'max_queue_depth': writer.max_queue_depth}
+    stream = robot.stream
+    if stream is not None:
+      metrics['stream'] = {'frames': stream.frames, 'errors': stream.errors}
+    handler.wfile.write(simplejson.dumps(metrics))
+
+  def GET_history(self, handler, seconds=None, points=None, names=None):
+    """Return a JSON object summarizing recent sensor history.
+
+    Accepts the number of seconds of history to summarize (default 60), the
+    number of points to downsample to (default none) and a comma separated
+    list of sensor names (default all). Responds with 400 to a bad value.
+
+    """
+    history = self._fido.sensors.history
+    try:
+      seconds = float((seconds or [60])[0])
+      if points:
+        points = int(points[0])
+    except ValueError, e:
+      handler.Render('400 Bad parameter: %s' % e, response=400)
+      return
+    if not 0 < seconds < float('inf'):
+      handler.Render('400 seconds must be positive.', response=400)
+      return
+    if points is not None and not 0 < points <= history.capacity:
+      handler.Render('400 points must be from 1 to %d.' % history.capacity,
+                     response=400)
+      return
+    if names:
+      names = names[0].split(',')
+    try:
+      summary = history.Query(seconds, names, points)
+    except KeyError, e:
+      handler.Render('400 Unknown sensor %s' % e, response=400)
+    else:
+      handler.wfile.write(simplejson.dumps(summary))
+
   def GET_light_on(self, handler):
     """Turn the light on."""
     logging.info('Turning the light on.')
@@ -176,13 +288,16 @@ class FidoWeb(gsd.App):
 def main():
   arduino_tty = '/dev/ttyUSB0'
   robot_tty = '/dev/ttyUSB1'
-  if len(sys.argv) == 5:
+  traffic_log = None
+  if len(sys.argv) >= 5:
     arduino_tty = sys.argv[3]
     robot_tty = sys.argv[4]
+  if len(sys.argv) == 6:
+    traffic_log = sys.argv[5]
 
   logging.basicConfig(level=logging.INFO, format=FORMAT, datefmt=DATE_FORMAT)
 
-  fido_web = FidoWeb(arduino_tty, robot_tty)
+  fido_web = FidoWeb(arduino_tty, robot_tty, traffic_log)
   fido_web._fido.Start()
   fido_web._motion.Start()
   fido_web.Main()
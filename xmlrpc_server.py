@@ -22,18 +22,72 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-"""Connect to a Roomba/Create and offer up an XMLRPC server interface."""
+"""Connect to a Roomba/Create and offer up an XMLRPC server interface.
+
+Usage: xmlrpc_server.py host port [tty ...]
+
+With one tty (/dev/ttyUSB0 by default) the Roomba's methods are served. With
+several, a fleet of Creates is served instead. The whole fleet is driven from
+a single event loop thread.
+
+"""
 
 import pyrobot
+import fleet
 import sys
+import threading
 
 from SimpleXMLRPCServer import SimpleXMLRPCServer
 
 
+class FleetService(object):
+
+  """Offers a Fleet's group commands to XMLRPC clients."""
+
+  def __init__(self, ttys):
+    self.fleet = fleet.Fleet()
+    for tty in ttys:
+      self.fleet.Add(tty, tty)
+    thread = threading.Thread(target=self.fleet.loop.Run)
+    thread.setDaemon(True)
+    thread.start()
+    self.fleet.loop.CallFromThread(self.fleet.StartPolling)
+
+  def _Run(self, method, *args):
+    results = self.fleet.loop.RunFromThread(getattr(self.fleet, method), *args)
+    for name, result in results.items():
+      if isinstance(result, Exception):
+        results[name] = str(result)
+    return results
+
+  def control_all(self):
+    return self._Run('ControlAll')
+
+  def stop_all(self):
+    return self._Run('StopAll')
+
+  def dock_all(self):
+    return self._Run('DockAll')
+
+  def soft_reset_all(self):
+    return self._Run('SoftResetAll')
+
+  def query_all(self, names):
+    return self._Run('QueryAll', names)
+
+  def status(self):
+    return self.fleet.Status()
+
+
 if __name__ == '__main__':
-  assert len(sys.argv) == 3
-  server = SimpleXMLRPCServer(sys.argv[1:])
+  assert len(sys.argv) >= 3
+  server = SimpleXMLRPCServer((sys.argv[1], int(sys.argv[2])),
+                              allow_none=True)
   server.register_introspection_functions()
-  roomba = pyrobot.Roomba()
-  server.register_instance(roomba)
+  ttys = sys.argv[3:]
+  if len(ttys) > 1:
+    server.register_instance(FleetService(ttys))
+  else:
+    roomba = pyrobot.Roomba(*ttys)
+    server.register_instance(roomba)
   server.serve_forever()